@@ -196,17 +196,17 @@ class ArchiveProcessor:
         self._logger.debug("Found %d datasets", len(datasets))
         pre_existing = 0
         for dataset in datasets:
-            try:
-                scan_obj = self._dataset_processor.lookup_scan(dataset_path)
-            except ObjectDoesNotExist:
+            dataset_path = Path(dataset)
+            scan_obj = self._dataset_processor.lookup_dataset(dataset_path)
+            if scan_obj is None:
                 self._logger.error("Unable to find DB record for scan")
                 success = False
+                continue
             try:
-                dataset_path = Path(dataset)
                 archive = ScanArchive.objects.get(
                     scan=scan_obj,
                     drive=drive,
-                    path=dataset_path)
+                    path=dataset_path.parent)
                 # If we complete the above then the record exists
                 pre_existing += 1
                 continue
@@ -214,12 +214,12 @@ class ArchiveProcessor:
                 #record doesn't exist so create it
                 archive = ScanArchive()
                 archive.drive = drive
-                archive.path = dataset.parent
+                archive.path = dataset_path.parent
                 archive.scan = scan_obj
-                archive.total_size = float(directory_size(dataset_path)) / 1024**3
-                archive.file_count = count_files(dataset_path)
+                archive.total_size = float(directory_size(dataset_path.parent)) / 1024**3
+                archive.file_count = count_files(dataset_path.parent)
                 archive.save()
         self._logger.info(
             "%d/%d (%.1f) records already existed",
-            pre_existing, len(datasets), float(pre_existing) / len(datasets))
+            pre_existing, len(datasets), float(pre_existing) / max(len(datasets), 1))
         return success
@@ -0,0 +1,314 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Persistent queue of the work storing the files associated with a scan.
+
+    Storing the attachments, projections, slices and videos is much slower than reading the
+    dataset itself, so the ingest can queue it here (see AssociatedFileTask) and leave it to
+    process_associated_files.py.  Each parser splits the work into named tasks with a
+    priority (see ASSOCIATED_TASKS), tasks for new or changed datasets are run before
+    routine rechecks.  The ingest only queues new or changed datasets, the tasks of the
+    others are queued again for a routine recheck once RECHECK_INTERVAL has passed since
+    they were last run.  Tasks are claimed with SELECT ... FOR UPDATE SKIP LOCKED so several
+    workers can drain the queue at the same time.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Q, When
+from django.utils import timezone
+
+from ingest_timing import get_ingest_timings
+from xtek_parser import XtekParser
+from vsi_parser import VsiParser
+from scans.models import AssociatedFileTask
+from scans.models.associated_file_task import (
+    TASK_DONE,
+    TASK_FAILED,
+    TASK_QUEUED,
+    TASK_RUNNING,
+)
+from scans.models.dataset_status import DATASET_ONLINE
+
+ROUTINE_PRIORITY = 100 # Added to the priority of tasks for datasets that haven't changed
+RETRY_DELAY = 60 # Wait this long before the first retry, doubled for each further retry (s)
+OFFLINE_DELAY = 60 * 60 # Wait this long before trying again if the dataset is offline (s)
+STALE_TIMEOUT = 6 * 60 * 60 # Tasks running for longer than this are assumed dead (s)
+RECHECK_INTERVAL = 7 * 24 * 60 * 60 # Run the tasks of unchanged datasets this often (s)
+CREATE_BATCH = 1000 # Tasks to insert at once when queueing the missing ones
+DEFAULT_QUEUE_WORKERS = 1
+
+class AssociatedFileQueue():
+    """
+        Queue the associated file tasks for scans and run them
+    """
+
+    def __init__(self, log_level=logging.WARNING):
+        """
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Associated file queue")
+        self._logger.setLevel(log_level)
+        self._log_level = log_level
+        self._parser_classes = [XtekParser, VsiParser]
+        self._thread_data = threading.local()
+        self._timings = get_ingest_timings()
+
+    def enqueue(self, scan, parser, urgent=False):
+        """
+            Queue all of the tasks the parser has for a scan.
+            Tasks already queued are left where they are unless this makes them more urgent,
+            tasks that are running are marked to be run again once they finish.
+            :param Scan scan: The scan to queue the tasks for
+            :param DatasetParser parser: The parser for the scan
+            :param boolean urgent: True if the dataset is new or has changed
+        """
+        priorities = {
+            task: priority if urgent else priority + ROUTINE_PRIORITY
+            for (task, priority) in parser.associated_tasks()}
+        existing = AssociatedFileTask.objects.filter(scan=scan, task__in=priorities.keys())
+        for queued in existing:
+            priority = priorities.pop(queued.task)
+            if queued.status == TASK_RUNNING:
+                queued.rerun = True
+                queued.save(update_fields=["rerun"])
+            elif queued.status == TASK_QUEUED:
+                if priority < queued.priority:
+                    queued.priority = priority
+                    queued.save(update_fields=["priority"])
+            else:
+                queued.status = TASK_QUEUED
+                queued.priority = priority
+                queued.attempts = 0
+                queued.next_attempt = None
+                queued.date_queued = timezone.now()
+                queued.save(update_fields=[
+                    "status", "priority", "attempts", "next_attempt", "date_queued"])
+        AssociatedFileTask.objects.bulk_create(
+            [
+                AssociatedFileTask(scan=scan, task=task, priority=priority)
+                for (task, priority) in priorities.items()],
+            ignore_conflicts=True) # Another worker may have queued it in the meantime
+        self._logger.debug("Queued tasks for %s", scan)
+
+    def recheck(self, interval=RECHECK_INTERVAL):
+        """
+            Queue the routine rechecks: the finished tasks that were last run more than the
+            interval ago, and the tasks of online scans that have never been queued (such as
+            scans ingested before the queue was used)
+            :param int interval: How long to leave finished tasks before running them again (s)
+            :return int: The number of tasks queued
+        """
+        now = timezone.now()
+        count = AssociatedFileTask.objects.filter(
+            status__in=[TASK_DONE, TASK_FAILED],
+            date_completed__lt=now - timedelta(seconds=interval)).update(
+                status=TASK_QUEUED,
+                priority=Case(
+                    When(priority__lt=ROUTINE_PRIORITY, then=F("priority") + ROUTINE_PRIORITY),
+                    default=F("priority"),
+                    output_field=IntegerField()),
+                attempts=0,
+                next_attempt=None,
+                date_queued=now)
+        for parser_class in self._parser_classes:
+            parser = parser_class(self._log_level)
+            for (task, priority) in parser.associated_tasks():
+                missing = parser.get_model().objects.filter(
+                    dataset_status=DATASET_ONLINE).exclude(
+                        associatedfiletask__task=task).values_list("pk", flat=True)
+                created = AssociatedFileTask.objects.bulk_create(
+                    [
+                        AssociatedFileTask(
+                            scan_id=pk, task=task, priority=priority + ROUTINE_PRIORITY)
+                        for pk in missing.iterator()],
+                    batch_size=CREATE_BATCH,
+                    ignore_conflicts=True)
+                count += len(created)
+        if count:
+            self._logger.info("Queued %d tasks for routine rechecks", count)
+        return count
+
+    def count_queued(self):
+        """
+            :return int: The number of tasks waiting to be run
+        """
+        return AssociatedFileTask.objects.filter(status=TASK_QUEUED).count()
+
+    def count_failed(self):
+        """
+            :return int: The number of tasks that have given up
+        """
+        return AssociatedFileTask.objects.filter(status=TASK_FAILED).count()
+
+    def reclaim_stale(self):
+        """
+            Requeue tasks left running by a worker that died
+            :return int: The number of tasks requeued
+        """
+        cutoff = timezone.now() - timedelta(seconds=STALE_TIMEOUT)
+        count = AssociatedFileTask.objects.filter(
+            status=TASK_RUNNING,
+            date_started__lt=cutoff).update(status=TASK_QUEUED, rerun=False)
+        if count:
+            self._logger.warning("Requeued %d stale tasks", count)
+        return count
+
+    def claim(self, worker):
+        """
+            Take the most urgent task that is ready to run
+            :param string worker: Identifies who is running the task
+            :return AssociatedFileTask: The task, or None if there's nothing to do
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            task = AssociatedFileTask.objects.select_for_update(skip_locked=True).filter(
+                Q(next_attempt__isnull=True) | Q(next_attempt__lte=now),
+                status=TASK_QUEUED).order_by("priority", "date_queued").first()
+            if task is None:
+                return None
+            task.status = TASK_RUNNING
+            task.rerun = False
+            task.attempts += 1
+            task.date_started = now
+            task.worker = worker
+            task.save(update_fields=["status", "rerun", "attempts", "date_started", "worker"])
+        return task
+
+    def run_task(self, task):
+        """
+            Run a claimed task and record the outcome
+            :param AssociatedFileTask task: The task to run
+            :return boolean: True if the task succeeded
+        """
+        scan = task.scan.get_real_instance()
+        if scan.dataset_status != DATASET_ONLINE:
+            self._logger.info("%s is not online, trying again later", scan)
+            task.attempts -= 1 # Not the task's fault
+            self._finish(
+                task, TASK_QUEUED, "Dataset status: {}".format(scan.dataset_status),
+                timedelta(seconds=OFFLINE_DELAY))
+            return True
+        try:
+            parser = self._parser_for(scan)
+            self._logger.info("Running %s for %s", task.task, scan)
+            with self._timings.dataset(scan.full_path()):
+                parser.run_associated_task(scan, task.task)
+        except Exception as exp: #pylint: disable=broad-except
+            self._logger.error("Failed to run %s for %s", task.task, scan)
+            self._logger.error(exp)
+            if task.attempts >= task.max_attempts:
+                self._finish(task, TASK_FAILED, traceback.format_exc())
+            else:
+                delay = timedelta(seconds=RETRY_DELAY * 2 ** (task.attempts - 1))
+                self._finish(task, TASK_QUEUED, traceback.format_exc(), delay)
+            return False
+        self._finish(task, TASK_DONE)
+        return True
+
+    def _finish(self, task, status, output=None, delay=None):
+        """
+            Record the outcome of running a task
+            :param AssociatedFileTask task: The task
+            :param string status: The new status
+            :param string output: Any output to record
+            :param timedelta delay: How long to wait before running the task again
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            # The ingest may have asked for it to be run again while it was running
+            rerun = AssociatedFileTask.objects.select_for_update().values_list(
+                "rerun", flat=True).get(pk=task.pk)
+            if rerun and status != TASK_QUEUED:
+                self._logger.debug("%s changed while running, queueing again", task)
+                status = TASK_QUEUED
+                task.attempts = 0
+                delay = None
+            task.status = status
+            task.rerun = False
+            task.output = output
+            task.date_completed = now
+            task.next_attempt = now + delay if delay else None
+            task.save(update_fields=[
+                "status", "rerun", "output", "date_completed", "next_attempt", "attempts"])
+
+    def _parser_for(self, scan):
+        """
+            Get this thread's parser for a scan
+            :param Scan scan: The scan (the real instance not the base class)
+            :return DatasetParser
+        """
+        parsers = getattr(self._thread_data, "parsers", None)
+        if parsers is None:
+            parsers = [parser_class(self._log_level) for parser_class in self._parser_classes]
+            self._thread_data.parsers = parsers
+        for parser in parsers:
+            if isinstance(scan, parser.get_model()):
+                return parser
+        raise ValueError("No parser for {}".format(type(scan).__name__))
+
+    def _worker(self, count=None, deadline=None):
+        """
+            Run tasks until there are none left
+            :param int count: Stop after this many tasks
+            :param float deadline: Don't start any tasks after this time (time.monotonic)
+            :return (int, int): The number of tasks run and the number that failed
+        """
+        worker = "{}:{}:{}".format(
+            socket.gethostname(), os.getpid(), threading.current_thread().name)
+        (processed, failed) = (0, 0)
+        try:
+            while count is None or processed < count:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                task = self.claim(worker)
+                if task is None:
+                    break
+                processed += 1
+                if not self.run_task(task):
+                    failed += 1
+        finally:
+            # Each thread has its own DB connection, don't leave it open once finished
+            connection.close()
+        return (processed, failed)
+
+    def process_queue(self, workers=DEFAULT_QUEUE_WORKERS, count=None, time_limit=None):
+        """
+            Run the queued tasks
+            :param int workers: How many tasks to run at the same time
+            :param int count: Stop after running this many tasks (per worker)
+            :param int time_limit: Don't start any tasks after this long (s)
+            :return (int, int): The number of tasks run and the number that failed
+        """
+        self.reclaim_stale()
+        self.recheck()
+        self._logger.info("Tasks in queue: %d", self.count_queued())
+        deadline = time.monotonic() + time_limit if time_limit else None
+        if workers <= 1:
+            return self._worker(count, deadline)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._worker, count, deadline) for _ in range(workers)]
+            results = [future.result() for future in futures]
+        return (sum(result[0] for result in results), sum(result[1] for result in results))
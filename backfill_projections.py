@@ -0,0 +1,77 @@
+#!/opt/xrhms-venv/xrhms-env/bin/python
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Store the projection thumbnails missing from the CT scans already in the database,
+    the thumbnails are made in parallel rather than one scan at a time
+"""
+
+import logging
+from argparse import ArgumentParser
+from sys import stdout, exit
+from dataset_processor import DatasetProcessor
+from thumbnailer import DEFAULT_WORKERS
+from scans.models import Share
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Store the missing projection thumbnails of existing scans")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of processes to make the thumbnails with (default: %(default)s)")
+    PARSER.add_argument(
+        "-s",
+        "--share",
+        action="store",
+        help="Only check the scans on the share with this name")
+    ARGS = PARSER.parse_args()
+    if ARGS.workers < 1:
+        PARSER.error("--workers must be at least 1")
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    SHARE = None
+    if ARGS.share:
+        try:
+            SHARE = Share.objects.get(name=ARGS.share)
+        except Share.DoesNotExist:
+            PARSER.error("Unknown share {}".format(ARGS.share))
+    PROCESSOR = DatasetProcessor(LOG_LEVEL)
+    if not PROCESSOR.backfill_projections(SHARE, ARGS.workers):
+        exit(1)
+    exit(0)
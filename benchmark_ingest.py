@@ -0,0 +1,274 @@
+#!/opt/xrhms-venv/xrhms-env/bin/python
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Benchmark the ingest against a synthetic CTData tree (see ctdata_generator.py).
+
+    A separate test database is created from the database in mysql.cnf (as manage.py test
+    does) and removed afterwards so the real records are never touched.
+    The benchmarks are run in order as each relies on the state left by the previous ones:
+        process_directory - ingest the whole tree into an empty database
+        reprocess - run the ingest again with nothing changed
+        check_all_exist - check every record is still on disk
+        index_datasets - index the tree as if it were an archive drive
+        move_subtree - move the first project to another share
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from sys import stdout, exit
+from tempfile import mkdtemp
+
+BENCHMARKS = [
+    "process_directory",
+    "reprocess",
+    "check_all_exist",
+    "index_datasets",
+    "move_subtree",
+]
+BENCHMARK_SERIAL = "BENCHMARK" # Serial number of the pretend archive drive
+BENCHMARK_SERVER = "benchmark"
+
+class IngestBenchmark():
+    """
+        Runs the ingest entry points against a synthetic tree and times them
+    """
+
+    def __init__(self, root, dataset_processor, workers=1, log_level=logging.WARNING):
+        """
+            :param Path root: The benchmark root, shares are created below here
+            :param DatasetProcessor dataset_processor: The processor being benchmarked
+            :param int workers: Number of workers to use for process_directory
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Ingest benchmark")
+        self._logger.setLevel(log_level)
+        self._log_level = log_level
+        self._root = root
+        self._processor = dataset_processor
+        self._workers = workers
+        self._timings = get_ingest_timings()
+        self.src = Path(root, "src", "CTData")
+        self.dst = Path(root, "dst", "CTData")
+        self.dataset_count = 0
+
+    def setup_fixtures(self, scanner):
+        """
+            Create the records the ingest expects to find
+            :param string scanner: The name of the scanner used in the dataset names
+        """
+        server = Server.objects.get_or_create(host_name=BENCHMARK_SERVER)[0]
+        for (name, mnt_point) in (("bench-src", self.src.parent), ("bench-dst", self.dst.parent)):
+            Share.objects.get_or_create(
+                name=name,
+                defaults={
+                    "server": server,
+                    "linux_mnt_point": str(mnt_point),
+                    "default_status": DATASET_ONLINE})
+        Machine.objects.get_or_create(name=scanner)
+        os.makedirs(self.dst, exist_ok=True)
+
+    def run(self, name):
+        """
+            Run a single benchmark
+            :param string name: The benchmark to run, see BENCHMARKS
+            :return dict: The result
+        """
+        self._logger.info("Running %s", name)
+        self._timings.reset()
+        started = time.perf_counter()
+        result = getattr(self, "_bench_{}".format(name))()
+        elapsed = time.perf_counter() - started
+        summary = self._timings.summary()
+        self._logger.info("%s took %.3fs", name, elapsed)
+        return {
+            "benchmark": name,
+            "seconds": elapsed,
+            "datasets": self.dataset_count,
+            "datasets_per_second": self.dataset_count / elapsed if elapsed else None,
+            "result": result,
+            "stages": summary["stages"],
+            "slowest": summary["slowest"]}
+
+    def _bench_process_directory(self):
+        return self._processor.process_directory(self.src, self._workers)
+
+    def _bench_reprocess(self):
+        return self._processor.process_directory(self.src, self._workers)
+
+    def _bench_check_all_exist(self):
+        return self._processor.check_all_exist()
+
+    def _bench_index_datasets(self):
+        archive_processor = BenchmarkArchiveProcessor(
+            path=self.src,
+            log_level=self._log_level,
+            dataset_processor=self._processor)
+        archive_processor.create_drive()
+        return archive_processor.index_datasets()
+
+    def _bench_move_subtree(self):
+        projects = sorted(self.src.iterdir())
+        if not projects:
+            raise ValueError("Nothing to move")
+        return self._processor.move_subtree(projects[0], self.dst)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Benchmark the ingest against a synthetic tree of datasets")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-n",
+        "--datasets",
+        action="store",
+        type=int,
+        default=100,
+        help="Number of datasets to generate, 10 to 100000 (default: %(default)s)")
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of workers for process_directory (default: %(default)s)")
+    PARSER.add_argument(
+        "--projections",
+        action="store",
+        type=int,
+        default=16,
+        help="Number of projections per dataset (default: %(default)s)")
+    PARSER.add_argument(
+        "--voxels",
+        action="store",
+        type=int,
+        default=64,
+        help="Width, height and depth of each reconstruction (default: %(default)s)")
+    PARSER.add_argument(
+        "--dense-volumes",
+        action="store_true",
+        help="Fill the reconstructions with data rather than creating sparse files")
+    PARSER.add_argument(
+        "-b",
+        "--benchmark",
+        action="append",
+        choices=BENCHMARKS,
+        help="Only run these benchmarks (default: all of them)")
+    PARSER.add_argument(
+        "--root",
+        action="store",
+        help="Where to build the tree (default: a new temporary directory)")
+    PARSER.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the tree and the test database afterwards")
+    PARSER.add_argument(
+        "-o",
+        "--output",
+        action="store",
+        help="Write the results as JSON to this file")
+    ARGS = PARSER.parse_args()
+    if ARGS.workers < 1:
+        PARSER.error("--workers must be at least 1")
+    if ARGS.datasets < 1:
+        PARSER.error("--datasets must be at least 1")
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    ROOT = Path(ARGS.root) if ARGS.root else Path(mkdtemp(prefix="xrhms-benchmark-"))
+    #The settings and django must be set up before anything that uses the models is imported
+    os.environ["XRHMS_BENCHMARK_ROOT"] = str(ROOT)
+    #Always the benchmark settings, never whatever is in the environment, so the real
+    #private storage isn't written to
+    os.environ["DJANGO_SETTINGS_MODULE"] = "xrhms.benchmark_settings"
+    #pylint: disable=wrong-import-position
+    from dataset_processor import DatasetProcessor
+    from django.db import connection
+    from archive_processor import ArchiveProcessor
+    from ctdata_generator import CTDataGenerator, DEFAULT_SCANNER
+    from ingest_timing import get_ingest_timings
+    from scans.models import Machine, Server, Share
+    from scans.models.dataset_status import DATASET_ONLINE
+
+    class BenchmarkArchiveProcessor(ArchiveProcessor):
+        """
+            Treat the tree as an archive drive without needing smartctl
+        """
+        def get_serial_no(self):
+            return BENCHMARK_SERIAL
+
+        def get_manufacturer(self):
+            return BENCHMARK_SERVER
+
+        def get_capacity(self):
+            return 0
+
+    OLD_DB_NAME = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    RESULTS = []
+    try:
+        BENCHMARK = IngestBenchmark(
+            ROOT, DatasetProcessor(LOG_LEVEL), ARGS.workers, LOG_LEVEL)
+        BENCHMARK.setup_fixtures(DEFAULT_SCANNER)
+        GENERATOR = CTDataGenerator(
+            BENCHMARK.src,
+            projections=ARGS.projections,
+            voxels=ARGS.voxels,
+            dense_volumes=ARGS.dense_volumes,
+            log_level=LOG_LEVEL)
+        GENERATE_STARTED = time.perf_counter()
+        BENCHMARK.dataset_count = len(GENERATOR.generate(ARGS.datasets))
+        logging.info(
+            "Generated %d datasets in %.1fs",
+            BENCHMARK.dataset_count, time.perf_counter() - GENERATE_STARTED)
+        for NAME in BENCHMARKS:
+            if ARGS.benchmark and NAME not in ARGS.benchmark:
+                continue
+            RESULTS.append(BENCHMARK.run(NAME))
+    finally:
+        connection.creation.destroy_test_db(OLD_DB_NAME, verbosity=0, keepdb=ARGS.keep)
+        if not ARGS.keep:
+            shutil.rmtree(ROOT, ignore_errors=True)
+    for RESULT in RESULTS:
+        print("{:20s} {:10.3f}s {:10.1f} datasets/s  result: {}".format(
+            RESULT["benchmark"],
+            RESULT["seconds"],
+            RESULT["datasets_per_second"] or 0,
+            RESULT["result"]))
+    if ARGS.output:
+        with open(ARGS.output, "w") as OUTPUT_FILE:
+            json.dump(RESULTS, OUTPUT_FILE, indent=2)
+    exit(0)
@@ -0,0 +1,281 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Store reconstructed volumes as a directory of zstd compressed chunks.
+
+    The layout is that of a zarr (version 2) directory store so the volumes can also be
+    opened with zarr: the shape, chunk size and type are in .zarray, the scan metadata in
+    .zattrs and each chunk in a file named after its index (z.y.x).  Chunks that are all
+    zero (the air outside the reconstruction) aren't written, a missing chunk reads as zero.
+    Only the chunks holding the slices asked for are read so part of the volume can be
+    read without pulling all of it across the network.
+"""
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy
+import zstandard
+
+STORE_SUFFIX = ".zarr"
+ZARRAY = ".zarray"
+ZATTRS = ".zattrs"
+ZARR_FORMAT = 2
+COMPRESSOR_ID = "zstd"
+DEFAULT_CHUNKS = (32, 256, 256) # z, y, x
+DEFAULT_LEVEL = 3 # zstd compression level
+DEFAULT_WORKERS = 4 # zstd releases the GIL so the chunks are compressed in threads
+PARTIAL_SUFFIX = ".part" # Added to the name while the store is being written
+
+def is_chunked_store(path):
+    """
+        :param Path path: The reconstructed volume
+        :return boolean: True if it is a chunked store rather than a raw file
+    """
+    return Path(path, ZARRAY).is_file()
+
+class ChunkedArray():
+    """
+        Read only access to a chunked store, indexed along z like numpy.memmap
+    """
+
+    def __init__(self, store):
+        """
+            :param Path store: The store directory
+        """
+        self.store = store
+        with open(Path(store, ZARRAY)) as fhandle:
+            meta = json.load(fhandle)
+        if meta.get("zarr_format") != ZARR_FORMAT or meta.get("order", "C") != "C":
+            raise ValueError("{} is not a supported store".format(store))
+        if meta.get("filters"):
+            raise ValueError("{} uses filters which are not supported".format(store))
+        compressor = meta.get("compressor")
+        if compressor is not None and compressor.get("id") != COMPRESSOR_ID:
+            raise ValueError("{} uses an unsupported compressor".format(store))
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = numpy.dtype(meta["dtype"])
+        self.fill_value = meta.get("fill_value") or 0
+        self.attributes = {}
+        if Path(store, ZATTRS).is_file():
+            with open(Path(store, ZATTRS)) as fhandle:
+                self.attributes = json.load(fhandle)
+        self._separator = meta.get("dimension_separator", ".")
+        self._compressed = compressor is not None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(self.shape[0])
+            if step != 1:
+                raise ValueError("Only contiguous ranges of slices can be read")
+            return self.read(start, max(start, stop))
+        index = int(key)
+        if index < 0:
+            index += self.shape[0]
+        if not 0 <= index < self.shape[0]:
+            raise IndexError("Slice {} is outside the volume".format(key))
+        return self.read(index, index + 1)[0]
+
+    def read(self, start, stop):
+        """
+            Read a range of slices, only the chunks holding them are read
+            :param int start: The first slice
+            :param int stop: The slice after the last one
+            :return numpy.ndarray: The slices (z, y, x)
+        """
+        (depth, height, width) = self.chunks
+        result = numpy.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+        decompressor = zstandard.ZstdDecompressor()
+        for row in range(start // depth, -(-stop // depth)):
+            row_start = row * depth
+            (low, high) = (max(start, row_start), min(stop, row_start + depth))
+            for (j, y) in enumerate(range(0, self.shape[1], height)):
+                for (k, x) in enumerate(range(0, self.shape[2], width)):
+                    chunk = self._read_chunk((row, j, k), decompressor)
+                    result[low - start:high - start, y:y + height, x:x + width] = chunk[
+                        low - row_start:high - row_start,
+                        :min(height, self.shape[1] - y),
+                        :min(width, self.shape[2] - x)]
+        return result
+
+    def _read_chunk(self, index, decompressor):
+        """
+            :param tuple index: The index of the chunk (z, y, x)
+            :param zstandard.ZstdDecompressor decompressor: Used to decompress the chunk
+            :return numpy.ndarray: The whole chunk, including any padding at the edges
+        """
+        fname = Path(self.store, self._separator.join(str(i) for i in index))
+        try:
+            with open(fname, "rb") as fhandle:
+                data = fhandle.read()
+        except FileNotFoundError:
+            return numpy.full(self.chunks, self.fill_value, dtype=self.dtype)
+        if self._compressed:
+            data = decompressor.decompress(data)
+        return numpy.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+
+class ChunkedVolumeWriter():
+    """
+        Converts a reconstructed volume into a chunked store
+    """
+
+    def __init__(
+            self, chunks=DEFAULT_CHUNKS, level=DEFAULT_LEVEL, workers=DEFAULT_WORKERS,
+            log_level=logging.WARNING):
+        """
+            :param tuple chunks: The size of each chunk (z, y, x)
+            :param int level: The zstd compression level
+            :param int workers: The number of threads to compress the chunks with
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Chunked volume writer")
+        self._logger.setLevel(log_level)
+        if len(chunks) != 3 or min(chunks) < 1:
+            raise ValueError("Chunks must have a positive z, y and x size")
+        self._chunks = tuple(chunks)
+        self._level = level
+        self._workers = workers
+
+    def convert(self, source, store, attributes=None):
+        """
+            Write the whole of a volume into a new store.
+            The store is written under a temporary name and renamed once complete.
+            :param VolumeReader source: The volume to convert
+            :param Path store: The store directory to create
+            :param dict attributes: Metadata to store alongside the volume
+            :return int: The number of bytes written
+        """
+        if not source.is_complete():
+            raise ValueError("volume not yet complete")
+        if store.exists():
+            raise ValueError("{} already exists".format(store))
+        partial = Path(store.parent, store.name + PARTIAL_SUFFIX)
+        if partial.exists():
+            self._logger.warning("Removing incomplete store %s", partial)
+            shutil.rmtree(partial)
+        partial.mkdir()
+        (depth, height, width) = self._chunks
+        shape = (source.pixels_z, source.pixels_y, source.pixels_x)
+        self._logger.info("Converting %s to %s", source.filename, store)
+        written = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                for (row, start) in enumerate(range(0, shape[0], depth)):
+                    slab = source.xy_slab(start, min(start + depth, shape[0]))
+                    jobs = [
+                        executor.submit(
+                            self._write_chunk,
+                            partial,
+                            (row, j, k),
+                            slab[:, y:y + height, x:x + width])
+                        for (j, y) in enumerate(range(0, shape[1], height))
+                        for (k, x) in enumerate(range(0, shape[2], width))]
+                    written += sum(job.result() for job in jobs)
+            with open(Path(partial, ZATTRS), "w") as fhandle:
+                json.dump(attributes or {}, fhandle, indent=2)
+            # Written last as a store without it can't be opened
+            with open(Path(partial, ZARRAY), "w") as fhandle:
+                json.dump({
+                    "zarr_format": ZARR_FORMAT,
+                    "shape": list(shape),
+                    "chunks": list(self._chunks),
+                    "dtype": numpy.dtype(source.dtype).str,
+                    "compressor": {"id": COMPRESSOR_ID, "level": self._level},
+                    "fill_value": 0,
+                    "order": "C",
+                    "filters": None,
+                    "dimension_separator": ".",
+                }, fhandle, indent=2)
+            os.rename(partial, store)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        self._logger.info(
+            "Wrote %d bytes (%.1f%% of the original)",
+            written, 100 * written / (source.bytes_per_slice * shape[0]))
+        return written
+
+    def _write_chunk(self, directory, index, data):
+        """
+            Compress and write a single chunk, run in a worker thread
+            :param Path directory: The store being written
+            :param tuple index: The index of the chunk (z, y, x)
+            :param numpy.ndarray data: The voxels in the chunk, smaller than the chunk size
+                at the edges of the volume
+            :return int: The number of bytes written
+        """
+        chunk = numpy.zeros(self._chunks, dtype=data.dtype)
+        chunk[:data.shape[0], :data.shape[1], :data.shape[2]] = data
+        if not chunk.any():
+            return 0 # Missing chunks are read as zero
+        compressed = zstandard.ZstdCompressor(level=self._level).compress(chunk.tobytes())
+        with open(Path(directory, ".".join(str(i) for i in index)), "wb") as fhandle:
+            fhandle.write(compressed)
+        return len(compressed)
+
+    def verify(self, source, store):
+        """
+            Check a store holds exactly the same voxels as the volume it was made from
+            :param VolumeReader source: The original volume
+            :param VolumeReader store: The store
+            :return boolean: True if they match
+        """
+        if (source.pixels_x, source.pixels_y, source.pixels_z) != (
+                store.pixels_x, store.pixels_y, store.pixels_z):
+            self._logger.error("%s is not the same size as %s", store.filename, source.filename)
+            return False
+        depth = self._chunks[0]
+        for start in range(0, source.pixels_z, depth):
+            stop = min(start + depth, source.pixels_z)
+            if not numpy.array_equal(source.xy_slab(start, stop), store.xy_slab(start, stop)):
+                self._logger.error("Slices %d to %d of %s differ", start, stop, store.filename)
+                return False
+        return True
+
+def export_volume(source, fname, slices=DEFAULT_CHUNKS[0]):
+    """
+        Write a volume, usually a store, out as a raw volume, the reverse of
+        ChunkedVolumeWriter.convert.  The volume is written under a temporary name and
+        renamed once complete.
+        :param VolumeReader source: The volume to export
+        :param Path fname: The raw volume to create
+        :param int slices: How many slices to read at once, a multiple of the store's chunk
+            depth avoids decompressing chunks twice
+        :return int: The number of bytes written
+    """
+    if not source.is_complete():
+        raise ValueError("volume not yet complete")
+    if fname.exists():
+        raise ValueError("{} already exists".format(fname))
+    partial = Path(fname.parent, fname.name + PARTIAL_SUFFIX)
+    try:
+        with open(partial, "wb") as fhandle:
+            for start in range(0, source.pixels_z, slices):
+                source.xy_slab(start, min(start + slices, source.pixels_z)).tofile(fhandle)
+        os.rename(partial, fname)
+    except BaseException:
+        if partial.exists():
+            partial.unlink()
+        raise
+    return source.bytes_per_slice * source.pixels_z
@@ -0,0 +1,114 @@
+#!/opt/xrhms-venv/xrhms-env/bin/python
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Convert the reconstructions of CT scans into compressed chunked stores
+    (see chunked_volume.py), the stores are read in the same way as the original volumes
+"""
+
+import logging
+from argparse import ArgumentParser
+from sys import stdout, exit
+from dataset_processor import DatasetProcessor
+from chunked_volume import ChunkedVolumeWriter, DEFAULT_CHUNKS, DEFAULT_LEVEL, DEFAULT_WORKERS
+from scans.models import NikonCTScan, Share
+from scans.models.dataset_status import DATASET_ONLINE
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Convert reconstructed volumes into compressed chunked stores")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    SELECTION = PARSER.add_mutually_exclusive_group(required=True)
+    SELECTION.add_argument(
+        "-s",
+        "--share",
+        action="store",
+        help="Convert all of the scans on the share with this name")
+    SELECTION.add_argument(
+        "-i",
+        "--id",
+        action="append",
+        type=int,
+        help="Convert the scan with this id, may be given more than once")
+    PARSER.add_argument(
+        "-c",
+        "--chunks",
+        action="store",
+        type=int,
+        nargs=3,
+        default=DEFAULT_CHUNKS,
+        metavar=("Z", "Y", "X"),
+        help="Size of each chunk (default: %(default)s)")
+    PARSER.add_argument(
+        "-l",
+        "--level",
+        action="store",
+        type=int,
+        default=DEFAULT_LEVEL,
+        help="zstd compression level (default: %(default)s)")
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of threads to compress with (default: %(default)s)")
+    PARSER.add_argument(
+        "--remove-original",
+        action="store_true",
+        help="Delete each original volume and its .vgi once its store has been checked against it")
+    ARGS = PARSER.parse_args()
+    if ARGS.workers < 1:
+        PARSER.error("--workers must be at least 1")
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    SCANS = NikonCTScan.objects.filter(dataset_status=DATASET_ONLINE).select_related("share")
+    if ARGS.share:
+        try:
+            SCANS = SCANS.filter(share=Share.objects.get(name=ARGS.share))
+        except Share.DoesNotExist:
+            PARSER.error("Unknown share {}".format(ARGS.share))
+    else:
+        SCANS = SCANS.filter(pk__in=ARGS.id)
+    try:
+        WRITER = ChunkedVolumeWriter(ARGS.chunks, ARGS.level, ARGS.workers, LOG_LEVEL)
+    except ValueError as ERR:
+        PARSER.error(str(ERR))
+    PROCESSOR = DatasetProcessor(LOG_LEVEL)
+    (CONVERTED, TOTAL) = PROCESSOR.convert_recons(
+        SCANS.iterator(), WRITER, ARGS.remove_original)
+    logging.info("Converted %d/%d reconstructions", CONVERTED, TOTAL)
+    if CONVERTED != TOTAL:
+        exit(1)
+    exit(0)
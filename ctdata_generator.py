@@ -0,0 +1,374 @@
+#!/opt/xrhms-venv/xrhms-env/bin/python
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Generate a synthetic CTData tree laid out the same way as the Nikon scanners write it
+    so that the ingest can be exercised without real scanner output.
+
+    <root>/<project>/<dataset>/<dataset>.xtekct
+                              /<dataset>.ctprofile.xml
+                              /<dataset>_NNNN.tif
+                              /<dataset>/<dataset>.vol
+                              /<dataset>/<dataset>.vgi
+                              /<dataset>/videos/<dataset><suffix>.mp4
+
+    Only the standard library is used so trees can be generated on machines without the
+    full environment installed.
+"""
+
+import logging
+import os
+import random
+import struct
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from pathlib import Path
+from sys import stdout, exit
+
+from xtek_parameters import XTEKCT_MODE, get_xtek_param_list
+
+DEFAULT_DATASETS = 10
+DEFAULT_DATASETS_PER_PROJECT = 50
+DEFAULT_PROJECTIONS = 16
+DEFAULT_PROJECTION_SIZE = 64 # pixels along each edge of the projections
+DEFAULT_VOXELS = 64 # voxels along each edge of the reconstruction
+DEFAULT_SCANNER = "Bench"
+DEFAULT_OPERATOR = "XX"
+DEFAULT_VIDEO_SUFFIXES = ["_XYSliceRoll", "_XZSliceRoll", "_YZSliceRoll"]
+VIDEO_SIZE = 64 * 1024 # bytes, the videos aren't decoded during ingest
+START_DATE = date(2020, 1, 1)
+
+TIFF_SHORT = 3
+TIFF_LONG = 4
+
+class CTDataGenerator():
+    """
+        Builds a tree of synthetic Nikon datasets
+    """
+
+    def __init__(
+            self,
+            root,
+            projections=DEFAULT_PROJECTIONS,
+            projection_size=DEFAULT_PROJECTION_SIZE,
+            voxels=DEFAULT_VOXELS,
+            dense_volumes=False,
+            video_suffixes=None,
+            datasets_per_project=DEFAULT_DATASETS_PER_PROJECT,
+            scanner=DEFAULT_SCANNER,
+            seed=0,
+            log_level=logging.WARNING):
+        """
+            :param Path root: Where to build the tree, the CTData folder
+            :param int projections: Number of projections per dataset
+            :param int projection_size: Width and height of the projections (pixels)
+            :param int voxels: Width, height and depth of the reconstructions (voxels)
+            :param boolean dense_volumes: Write data into the reconstructions rather than
+                leaving them sparse
+            :param List video_suffixes: Suffixes of the videos to create for each dataset
+            :param int datasets_per_project: How many datasets in each project folder
+            :param string scanner: Scanner name to use in the dataset names
+            :param int seed: Seed for the random data so runs are repeatable
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("CTData generator")
+        self._logger.setLevel(log_level)
+        if projections < 1:
+            raise ValueError("Must have at least 1 projection")
+        if datasets_per_project < 1:
+            raise ValueError("Must have at least 1 dataset per project")
+        if "_" in scanner:
+            raise ValueError("Scanner name cannot contain _")
+        self._root = root
+        self._projections = projections
+        self._projection_size = projection_size
+        self._voxels = voxels
+        self._dense_volumes = dense_volumes
+        if video_suffixes is None:
+            video_suffixes = DEFAULT_VIDEO_SUFFIXES
+        self._video_suffixes = video_suffixes
+        self._datasets_per_project = datasets_per_project
+        self._scanner = scanner
+        self._random = random.Random(seed)
+
+    def generate(self, count, start=0):
+        """
+            Create the datasets
+            :param int count: How many datasets to create
+            :param int start: Index of the first dataset, to add more to an existing tree
+            :return List: The dataset (xtekct) files created
+        """
+        datasets = []
+        for index in range(start, start + count):
+            datasets.append(self.generate_dataset(index))
+            if (index + 1) % 1000 == 0:
+                self._logger.info("Generated %d datasets", index + 1)
+        self._logger.info("Generated %d datasets under %s", count, self._root)
+        return datasets
+
+    def dataset_name(self, index):
+        """
+            Work out the name of a dataset
+            date_scanner_bug_operator_other
+            :param int index: The number of the dataset
+            :return string
+        """
+        scan_date = START_DATE + timedelta(days=index % 1000)
+        return "{}_{}_{}_{}_Synthetic{:06d}".format(
+            scan_date.strftime("%Y%m%d"), self._scanner, 0, DEFAULT_OPERATOR, index)
+
+    def generate_dataset(self, index):
+        """
+            Create a single dataset
+            :param int index: The number of the dataset
+            :return Path: The xtekct file
+        """
+        name = self.dataset_name(index)
+        project = "Project{:04d}".format(index // self._datasets_per_project)
+        folder = Path(self._root, project, name)
+        recon_folder = Path(folder, name)
+        video_folder = Path(recon_folder, "videos")
+        os.makedirs(video_folder, exist_ok=True)
+        xtek_file = Path(folder, "{}.xtekct".format(name))
+        self._write_xtek(xtek_file, name)
+        self._write_ctprofile(Path(folder, "{}.ctprofile.xml".format(name)))
+        for projection in range(1, self._projections + 1):
+            self._write_tiff(Path(folder, "{}_{:04d}.tif".format(name, projection)))
+        self._write_volume(Path(recon_folder, "{}.vol".format(name)))
+        self._write_vgi(Path(recon_folder, "{}.vgi".format(name)), name)
+        for suffix in self._video_suffixes:
+            with open(Path(video_folder, "{}{}.mp4".format(name, suffix)), "wb") as fhandle:
+                fhandle.write(self._random_bytes(VIDEO_SIZE))
+        return xtek_file
+
+    def _random_bytes(self, length):
+        """
+            :param int length: How many bytes
+            :return bytes: Random data
+        """
+        return self._random.getrandbits(8 * length).to_bytes(length, "little")
+
+    def _write_xtek(self, fname, name):
+        """
+            Write an xtekct file containing every parameter the parser looks for
+            :param Path fname: Where to write it
+            :param string name: The name of the dataset
+        """
+        special = {
+            "Name": name,
+            "VoxelsX": self._voxels,
+            "VoxelsY": self._voxels,
+            "VoxelsZ": self._voxels,
+            "Projections": self._projections,
+            "InputFolderName": "",
+            "OutputFolderName": "",
+        }
+        sections = {}
+        for (_target, param_type, section, source) in get_xtek_param_list(XTEKCT_MODE):
+            if source in special:
+                value = special[source]
+            elif param_type == "int":
+                value = self._random.randint(1, 100)
+            elif param_type == "float":
+                value = round(self._random.uniform(0.1, 100), 3)
+            elif param_type in ("bool", "boolean"):
+                value = "False"
+            else:
+                value = "synthetic"
+            sections.setdefault(section, []).append("{}={}".format(source, value))
+        with open(fname, "w") as fhandle:
+            for (section, lines) in sections.items():
+                fhandle.write("[{}]\n".format(section))
+                fhandle.write("\n".join(lines))
+                fhandle.write("\n\n")
+
+    def _write_ctprofile(self, fname):
+        """
+            Write a ctprofile file containing the values the parser reads
+            :param Path fname: Where to write it
+        """
+        with open(fname, "w") as fhandle:
+            fhandle.write(
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<CTProfile>\n'
+                '  <XrayHead>Synthetic</XrayHead>\n'
+                '  <ImagingSettings binning="1" exposure="500" gain="1" brightness="0" '
+                'digitalGain="1" accumulation="1" WhiteToBlackLatency="0" '
+                'BlackToWhiteLatency="0" WhiteToWhiteLatency="0" lines="0" />\n'
+                '  <FramesPerProjection>1</FramesPerProjection>\n'
+                '  <MaxPixelsToShuttle>0</MaxPixelsToShuttle>\n'
+                '  <HelicalScan>false</HelicalScan>\n'
+                '</CTProfile>\n')
+
+    def _write_tiff(self, fname):
+        """
+            Write an uncompressed 16 bit greyscale tiff of random data
+            :param Path fname: Where to write it
+        """
+        size = self._projection_size
+        data_length = size * size * 2
+        entries = [
+            (256, TIFF_LONG, size), # ImageWidth
+            (257, TIFF_LONG, size), # ImageLength
+            (258, TIFF_SHORT, 16), # BitsPerSample
+            (259, TIFF_SHORT, 1), # Compression: none
+            (262, TIFF_SHORT, 1), # PhotometricInterpretation: black is zero
+            (273, TIFF_LONG, 0), # StripOffsets, filled in below
+            (277, TIFF_SHORT, 1), # SamplesPerPixel
+            (278, TIFF_LONG, size), # RowsPerStrip
+            (279, TIFF_LONG, data_length), # StripByteCounts
+        ]
+        ifd_length = 2 + len(entries) * 12 + 4
+        data_offset = 8 + ifd_length
+        header = b"II" + struct.pack("<HI", 42, 8) + struct.pack("<H", len(entries))
+        for (tag, tag_type, value) in entries:
+            if tag == 273:
+                value = data_offset
+            if tag_type == TIFF_SHORT:
+                header += struct.pack("<HHIHH", tag, tag_type, 1, value, 0)
+            else:
+                header += struct.pack("<HHII", tag, tag_type, 1, value)
+        header += struct.pack("<I", 0) # no more IFDs
+        with open(fname, "wb") as fhandle:
+            fhandle.write(header)
+            fhandle.write(self._random_bytes(data_length))
+
+    def _write_volume(self, fname):
+        """
+            Write a 16 bit reconstruction, sparse unless dense volumes were requested
+            :param Path fname: Where to write it
+        """
+        slice_length = self._voxels * self._voxels * 2
+        with open(fname, "wb") as fhandle:
+            if self._dense_volumes:
+                for _ in range(self._voxels):
+                    fhandle.write(self._random_bytes(slice_length))
+            else:
+                fhandle.truncate(slice_length * self._voxels)
+
+    def _write_vgi(self, fname, name):
+        """
+            Write the header describing the reconstruction
+            :param Path fname: Where to write it
+            :param string name: The name of the dataset
+        """
+        with open(fname, "w") as fhandle:
+            fhandle.write(
+                "{{volume1}}\n"
+                "[representation]\n"
+                "size = {0} {0} {0}\n"
+                "datatype = unsigned integer\n"
+                "datarange = 0 65535\n"
+                "bitsperelement = 16\n"
+                "[file1]\n"
+                "SkipHeader = 0\n"
+                "FileFormat = raw\n"
+                "Size = {0} {0} {0}\n"
+                "Name = {1}.vol\n"
+                "Datatype = unsigned integer\n"
+                "datarange = 0 65535\n"
+                "BitsPerElement = 16\n".format(self._voxels, name))
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Generate a tree of synthetic Nikon datasets for testing the ingest")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-n",
+        "--datasets",
+        action="store",
+        type=int,
+        default=DEFAULT_DATASETS,
+        help="Number of datasets to generate (default: %(default)s)")
+    PARSER.add_argument(
+        "--start",
+        action="store",
+        type=int,
+        default=0,
+        help="Index of the first dataset, to add to an existing tree (default: %(default)s)")
+    PARSER.add_argument(
+        "--projections",
+        action="store",
+        type=int,
+        default=DEFAULT_PROJECTIONS,
+        help="Number of projections per dataset (default: %(default)s)")
+    PARSER.add_argument(
+        "--projection-size",
+        action="store",
+        type=int,
+        default=DEFAULT_PROJECTION_SIZE,
+        help="Width and height of each projection in pixels (default: %(default)s)")
+    PARSER.add_argument(
+        "--voxels",
+        action="store",
+        type=int,
+        default=DEFAULT_VOXELS,
+        help="Width, height and depth of each reconstruction (default: %(default)s)")
+    PARSER.add_argument(
+        "--dense-volumes",
+        action="store_true",
+        help="Fill the reconstructions with data rather than creating sparse files")
+    PARSER.add_argument(
+        "--datasets-per-project",
+        action="store",
+        type=int,
+        default=DEFAULT_DATASETS_PER_PROJECT,
+        help="Number of datasets in each project folder (default: %(default)s)")
+    PARSER.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        default=0,
+        help="Seed for the random data (default: %(default)s)")
+    PARSER.add_argument(
+        "root",
+        action="store",
+        help="The CTData folder to create the datasets in")
+    ARGS = PARSER.parse_args()
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    try:
+        GENERATOR = CTDataGenerator(
+            Path(ARGS.root),
+            projections=ARGS.projections,
+            projection_size=ARGS.projection_size,
+            voxels=ARGS.voxels,
+            dense_volumes=ARGS.dense_volumes,
+            datasets_per_project=ARGS.datasets_per_project,
+            seed=ARGS.seed,
+            log_level=LOG_LEVEL)
+    except ValueError as err:
+        PARSER.error(str(err))
+    GENERATOR.generate(ARGS.datasets, ARGS.start)
+    exit(0)
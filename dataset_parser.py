@@ -19,17 +19,74 @@
 
 from abc import ABC, abstractmethod
 import logging
-import subprocess
+import os
 from pathlib import Path
 
+from django.conf import settings
+
+from ingest_timing import get_ingest_timings
+from chunked_volume import STORE_SUFFIX
+from tile_pyramid import TILES_SUFFIX
+from vsi_extraction import EXTRACTION_SUFFIX
+
+EA_DIR = "@eaDir" # Metadata folders created by the synologies
+PRUNED_DIRECTORIES = (EA_DIR, settings.VIDEO_FOLDER, settings.EXTRA_FOLDER)
+# Tile pyramids and chunked stores hold thousands of tiles or chunks and no datasets,
+# VSI extractions in progress hold only their metadata and markers
+PRUNED_SUFFIXES = (TILES_SUFFIX, STORE_SUFFIX, EXTRACTION_SUFFIX)
+
+def is_pruned(name, pruned=PRUNED_DIRECTORIES):
+    """
+        :param string name: The name of a directory
+        :param tuple pruned: Names of directories not to descend into
+        :return boolean: True if the directory shouldn't be looked in for datasets
+    """
+    return name in pruned or name.endswith(PRUNED_SUFFIXES)
+
+def iterate_files(directory, extensions, pruned=PRUNED_DIRECTORIES):
+    """
+        Walk the directory tree once yielding the files with the specified extensions
+        as they are found.
+        Only the names are checked so the thousands of projections in each dataset
+        folder aren't stat'd, and the pruned directories (and tile pyramids and chunked
+        stores) aren't descended into at all.
+        All the files from one directory are yielded before moving onto the next.
+        :param Path directory: Where to look
+        :param List extensions: The extensions to include
+        :param tuple pruned: Names of directories not to descend into
+        :return generator of Path: the files found
+    """
+    logger = logging.getLogger("iterate_files")
+    extensions = tuple(extensions)
+    pruned = set(pruned)
+    to_visit = [str(directory)]
+    while to_visit:
+        current = to_visit.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if is_pruned(entry.name, pruned):
+                            logger.debug("Skipping %s", entry.path)
+                        else:
+                            to_visit.append(entry.path)
+                    elif entry.name.endswith(extensions) and entry.is_file(follow_symlinks=False):
+                        yield Path(entry.path)
+        except OSError as err:
+            logger.warning("Unable to list %s", current)
+            logger.debug(err)
+
 class DatasetParser(ABC):
     """
         Abstract class the all other parsers inherit from
         Describes the basic functionality that must be implemented and provies some helper methods
     """
+    ASSOCIATED_TASKS = {} # name -> priority, lower numbers are run first
+
     def __init__(self, log_level=logging.WARN):
         self._logger = logging.getLogger("Dataset Parser")
         self._logger.setLevel(log_level)
+        self._timings = get_ingest_timings()
 
     @abstractmethod
     def extensions(self):
@@ -38,18 +95,43 @@ class DatasetParser(ABC):
         """
 
     @abstractmethod
-    def process_file(self, dataset, scan_data=None):
+    def process_file(self, dataset, scan_data=None, checksum=None, fingerprint=None):
         """
             Process the specified file and add to database
             :param Path dataset: Where to find the dataset
             :param Scan scan_data: The object to insert the data into
+            :param string checksum: The checksum of the file if already calculated
+            :param string fingerprint: The fingerprint taken before the checksum was calculated
         """
 
-    @abstractmethod
     def process_associated_files(self, db_entry):
         """
             Process any other files that might contain data about the scan
+            by running all of the associated tasks
+            :param Scan db_entry: The scan to process the files for
         """
+        for (task, _priority) in self.associated_tasks():
+            self.run_associated_task(db_entry, task)
+
+    def associated_tasks(self):
+        """
+            The tasks that process the other files for a scan, each is run by a
+            _task_<name> method.  See ASSOCIATED_TASKS in the subclasses.
+            :return List: (name, priority) in the order they should be run
+        """
+        return sorted(self.ASSOCIATED_TASKS.items(), key=lambda task: task[1])
+
+    def run_associated_task(self, db_entry, task):
+        """
+            Run one of the tasks that processes the other files for a scan
+            :param Scan db_entry: The scan to process the files for
+            :param string task: The name of the task
+        """
+        if task not in self.ASSOCIATED_TASKS:
+            self._logger.error("Unknown task %s", task)
+            raise ValueError("Unknown task {}".format(task))
+        self._logger.debug("Running %s for %s", task, db_entry)
+        getattr(self, "_task_{}".format(task))(db_entry)
 
     @abstractmethod
     def list_files(self, directory):
@@ -59,44 +141,20 @@ class DatasetParser(ABC):
             :return List: the files found
         """
 
-    def _list_files(self, directory, extensions):
+    def _list_files(self, directory, extensions, pruned=PRUNED_DIRECTORIES):
         """
             List all the files with the specified extensions
             :param Path directory: Where to look
             :param List extensions: The extensions to include in the list
+            :param tuple pruned: Names of directories not to descend into
             :return List: the files found
         """
         if not directory.exists():
             raise ValueError("Path must exist")
-        all_files = []
-        if ".tif" in extensions:
-            output = subprocess.run(f"find '{directory}/' -type f",
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        else:
-            self._logger.debug("Searching %s for non-tif files", directory)
-            output = subprocess.run(f"find '{directory}/' -type f  -not -name *.tif",
-                shell=True,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        all_files = output.stdout.decode("utf-8").split("\n")
-        self._logger.debug("found %d files", len(all_files))
-        files = []
-        for ext in extensions:
-            self._logger.debug("Looking for %s files", ext)
-            new_files = []
-            for f_name in all_files:
-                if f_name.endswith(ext):
-                    new_files.append(Path(f_name))
-            self._logger.info("Found %d files with extension %s", len(new_files), ext)
-            files += new_files
+        files = list(iterate_files(directory, extensions, pruned))
         self._logger.info("Found %d files in total", len(files))
         return files
 
-
     @abstractmethod
     def get_model(self):
         """
@@ -121,3 +179,15 @@ class DatasetParser(ABC):
             :param boolean include_metadata: Should meta data files be copied across
             :return (status, output)
         """
+
+    def copy_preview( #pylint: disable=no-self-use, unused-argument
+            self, scan, destination, factor, include_metadata=False):
+        """
+            Copy a downsampled preview of the reconstructed data to the destination
+            :param Scan scan: The scan to copy
+            :param Path destination: Where to copy to
+            :param int factor: How much the preview is binned by
+            :param boolean include_metadata: Should meta data files be copied across
+            :return (status, output)
+        """
+        return (False, "Preview volumes are not available for this type of dataset\n")
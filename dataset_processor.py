@@ -26,16 +26,23 @@ from os import makedirs
 from datetime import datetime
 import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import groupby
 
 import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xrhms.settings")
 django.setup()
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
+from django.db import connection
+from django.db.models import Q
 from django.utils import timezone
 from django_mysql.exceptions import TimeoutError #pylint: disable=redefined-builtin
 from django_mysql.locks import Lock
 from xrhms_exceptions import XrhmsIgnore
+from dataset_parser import iterate_files
 from xtek_parser import XtekParser
 from vsi_parser import VsiParser
 
@@ -54,11 +61,12 @@ from scans.models.dataset_status import(
 )
 from scans.models import (
     Machine,
-    Share,
+    NikonCTScan,
     ScheduledMove,
     SidecarStatus,
     generate_sidecar_filename,
     load_sidecar,
+    read_sidecar,
     Scan,
     UserCopy,
 )
@@ -68,13 +76,28 @@ from xrh_utils import (
     count_eaDir,
     delete_eaDir,
     directory_size,
+    file_fingerprint,
     free_space,
     mount_free_percent,
 )
 from archive_processor import ArchiveProcessor
+from scan_index import ScanIndex
+from ingest_timing import (
+    get_ingest_timings,
+    STAGE_DB_WRITE,
+    STAGE_DISCOVERY,
+    STAGE_HASHING,
+    STAGE_LOOKUP,
+)
+from scans.share_resolver import get_share_resolver
+from associated_file_queue import AssociatedFileQueue, DEFAULT_QUEUE_WORKERS
+from xtek_extractor import DEFAULT_BATCH_WORKERS
+from thumbnailer import DEFAULT_WORKERS as DEFAULT_THUMBNAIL_WORKERS
 
 LOCK_TIMEOUT = 300 #Wait for this many secodns before giving up on getting the lock
 LOCK_NAME = "xtek_lock"
+DEFAULT_WORKERS = 1 #Process datasets one at a time unless told otherwise
+QUEUE_DEPTH_PER_WORKER = 2 #How many folders to have queued up for each worker
 
 
 class DatasetProcessor():
@@ -82,11 +105,13 @@ class DatasetProcessor():
         Class to handle the processing of datasets and their moves
     """
 
-    def __init__(self, log_level=logging.WARNING):
+    def __init__(self, log_level=logging.WARNING, defer_associated_files=False):
         """
             Standard constructor.
             Loads the modular parsers in for different datasets
             :param int log_level: How verbose to be
+            :param boolean defer_associated_files: Queue the associated files to be processed
+                later (see process_associated_queue) rather than processing them during ingest
         """
         self._logger = logging.getLogger("Dataset processor")
         self._log_level = log_level
@@ -96,6 +121,12 @@ class DatasetProcessor():
             VsiParser(log_level)
         ]
         self._build_parser_lookup()
+        self._thread_data = threading.local()
+        self._scan_index = None
+        self._share_resolver = get_share_resolver()
+        self._timings = get_ingest_timings()
+        self._associated_queue = AssociatedFileQueue(log_level)
+        self._defer_associated_files = defer_associated_files
         self._logger.info("Initialised with %d parsers", len(self._parsers))
 
     def _build_parser_lookup(self):
@@ -114,100 +145,50 @@ class DatasetProcessor():
         """
         return self._parser_dict[extension.strip(".")]
 
-    def process_directory(self, directory):
+    def process_directory(self, directory, workers=DEFAULT_WORKERS, verify_checksums=False):
         """
             Uses each parser to look in the specified directory to see if there are any changes
             Must acquire lock
             :param Path directory: The directory to be scanned
+            :param int workers: How many datasets to process concurrently (default 1)
+            :param boolean verify_checksums: Recalculate the checksum of every dataset even
+                if its fingerprint hasn't changed
+            :return boolean: True if every dataset was processed without error
         """
         if not directory.exists():
             raise ValueError("{} must exist".format(directory))
+        return self.process_datasets(
+            self._timings.timed_iter(STAGE_DISCOVERY, self.iterate_datasets(directory)),
+            workers,
+            verify_checksums)
+
+    def process_datasets(self, datasets, workers=DEFAULT_WORKERS, verify_checksums=False):
+        """
+            Check the datasets given against the database, updating it where there are changes
+            Must acquire lock
+            :param iterable datasets: (parser, file) pairs to process,
+                see iterate_datasets and datasets_from_files
+            :param int workers: How many datasets to process concurrently (default 1)
+            :param boolean verify_checksums: Recalculate the checksum of every dataset even
+                if its fingerprint hasn't changed
+            :return boolean: True if every dataset was processed without error
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
         try:
             with Lock(LOCK_NAME, acquire_timeout=LOCK_TIMEOUT):
                 process_ok = True
-                for parser in self._parsers:
-                    self._logger.debug("Using parser %s", parser)
-                    files = parser.list_files(directory)
-                    self._logger.debug("Found %d files", len(files))
-                    for fname in files:
-                        try:
-                            self._logger.debug("Processing: %s", fname)
-                            sidecar_filename = generate_sidecar_filename(fname)
-                            self._logger.debug("sidecar filename: %s", sidecar_filename)
-                            path = self._extract_path(fname)
-                            share = self._extract_share(fname)
-                            db_entry = None
-                            if sidecar_filename.exists():
-                                try:
-                                    db_entry_s = load_sidecar(sidecar_filename)
-                                    sidecar_status = db_entry_s.check_sidecar_status(fname)
-                                    self._logger.debug("Sidecar status: %s", sidecar_status.name)
-                                    if sidecar_status == SidecarStatus.COPIED:
-                                        self._logger.debug("copy found adding to DB")
-                                        db_entry = parser.process_file(fname)
-                                        # ^^  This will fix the wrong sidecar
-                                    elif sidecar_status == SidecarStatus.MOVED:
-                                        self._logger.debug("dataset moved")
-                                        db_entry_s.share = share
-                                        db_entry_s.path = path
-                                        db_entry_s.save()
-                                        db_entry = db_entry_s # Use the found record
-                                    elif sidecar_status == SidecarStatus.OK:
-                                        db_entry = db_entry_s
-                                    elif sidecar_status == SidecarStatus.INVALID:
-                                        raise ValueError("How can a sidecar not refer to itself?")
-                                except (ObjectDoesNotExist, KeyError):
-                                    pass
-                                except subprocess.CalledProcessError:
-                                    self._logger.error("Failed to run a required subprocess")
-                                    process_ok = False
-                            else:
-                                self._logger.debug("Sidecar not found")
-                            if not db_entry: #haven't got the db entry - have to search differently
-                                #This could be because it's new, or because the sidecar didn't exist
-                                short_fname = fname.name
-                                if Scan.objects.filter(
-                                        share=share,
-                                        path=path,
-                                        filename=short_fname):
-                                    #Found a record of the file - therefore it didn't have a sidecar
-                                    db_entry = Scan.objects.get(
-                                        share=share,
-                                        path=path,
-                                        filename=short_fname)
-                                    self._logger.debug(
-                                        "Found existing record pk=%d",
-                                        db_entry.pk)
-                                    self._logger.warning(
-                                        "Record %d didn't have a sidecar. Recreating...",
-                                        db_entry.pk)
-                                    db_entry.save_sidecar()
-                            calculated_checksum = calculate_file_hash(fname)
-                            self._logger.debug("Calculated checksum: %s", calculated_checksum)
-                            if db_entry:
-                                if db_entry.checksum == calculated_checksum:
-                                    self._logger.debug(
-                                        "Checksums match, therefore it hasn't changed")
-                                else:
-                                    self._logger.debug("Checksum DO NOT match, it has changed")
-                                    parser.process_file(fname, db_entry)
-                            else:
-                                self._logger.debug("No entry in database found")
-                                self._logger.debug("Creating entry")
-                                db_entry = parser.get_model()()
-                                db_entry.projection0deg = None
-                                db_entry.projection90deg = None
-                                db_entry = self._parse_filepath(fname, db_entry)
-                                db_entry = parser.process_file(fname, db_entry)
-                                db_entry.find_parent()
-                                db_entry.generate_sample_info()
-                            parser.process_associated_files(db_entry)
-                        except XrhmsIgnore:
-                            self._logger.info("Ignoring file (%s) due to option", fname)
-                        except Exception as exp: #pylint: disable=broad-except
-                            self._logger.error("Failed to process %s", fname)
-                            self._logger.error(exp)
-                            process_ok = False
+                self._share_resolver.invalidate() # Shares may have been edited via the web UI
+                self._scan_index = ScanIndex(self._log_level)
+                try:
+                    if workers == 1:
+                        for (parser, fname) in datasets:
+                            process_ok &= self._process_dataset(parser, fname, verify_checksums)
+                    else:
+                        process_ok &= self._process_datasets_parallel(
+                            datasets, workers, verify_checksums)
+                finally:
+                    self._scan_index = None
                 if not process_ok:
                     self._logger.error("Something went wrong processing files")
                 return process_ok
@@ -215,6 +196,422 @@ class DatasetProcessor():
             self._logger.critical("Unable to get DB lock")
             return False
 
+    def process_directories(
+            self,
+            directories,
+            workers=DEFAULT_WORKERS,
+            root_workers=None,
+            verify_checksums=False):
+        """
+            Process several directories at once using a single pool of workers.
+            Each directory is walked in its own thread and can only have a limited number of
+            folders being processed at any one time, so a slow share can't take all of the
+            workers away from a fast one.
+            Must acquire lock
+            :param List directories: The directories (Path) to be scanned
+            :param int workers: The total number of datasets to process concurrently
+            :param dict root_workers: The most datasets to process concurrently from each
+                directory, directories not in it (or if it's None) can use all the workers
+            :param boolean verify_checksums: Recalculate the checksum of every dataset even
+                if its fingerprint hasn't changed
+            :return dict: directory -> (True if every dataset was processed without error,
+                number of datasets, time taken (s))
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if root_workers is None:
+            root_workers = {}
+        for directory in directories:
+            if not directory.exists():
+                raise ValueError("{} must exist".format(directory))
+            if root_workers.get(directory, workers) < 1:
+                raise ValueError("Limit for {} must be at least 1".format(directory))
+        results = {}
+        try:
+            with Lock(LOCK_NAME, acquire_timeout=LOCK_TIMEOUT):
+                self._share_resolver.invalidate() # Shares may have been edited via the web UI
+                self._scan_index = ScanIndex(self._log_level)
+                try:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        feeders = []
+                        for directory in directories:
+                            feeder = threading.Thread(
+                                target=self._feed_directory,
+                                name="Feeder {}".format(directory),
+                                args=(
+                                    executor,
+                                    directory,
+                                    min(root_workers.get(directory, workers), workers),
+                                    verify_checksums,
+                                    results))
+                            feeder.start()
+                            feeders.append(feeder)
+                        for feeder in feeders:
+                            feeder.join()
+                finally:
+                    self._scan_index = None
+        except TimeoutError:
+            self._logger.critical("Unable to get DB lock")
+            return {directory: (False, 0, 0.0) for directory in directories}
+        for directory in directories:
+            if not results[directory][0]:
+                self._logger.error("Something went wrong processing files in %s", directory)
+        return results
+
+    def _feed_directory(self, executor, directory, limit, verify_checksums, results):
+        """
+            Run in a thread for each directory being processed by process_directories.
+            Walks the directory submitting each folder of datasets to the shared pool,
+            while never having more than limit folders in the pool at once.
+            :param ThreadPoolExecutor executor: The shared pool
+            :param Path directory: The directory to walk
+            :param int limit: The most folders from this directory to have in the pool
+            :param boolean verify_checksums: Always recalculate the checksums
+            :param dict results: Where to store (success, dataset count, time taken (s))
+        """
+        started = time.monotonic()
+        slots = threading.BoundedSemaphore(limit)
+        result_lock = threading.Lock()
+        state = {"ok": True, "count": 0}
+
+        def folder_done(future):
+            with result_lock:
+                state["ok"] &= self._collect_results([future])
+            slots.release()
+
+        try:
+            datasets = self._timings.timed_iter(STAGE_DISCOVERY, self.iterate_datasets(directory))
+            for (folder, group) in groupby(datasets, key=lambda dataset: dataset[1].parent):
+                group = list(group)
+                state["count"] += len(group)
+                slots.acquire()
+                self._logger.debug("Queueing folder %s", folder)
+                try:
+                    future = executor.submit(
+                        self._process_folder_worker, group, verify_checksums)
+                except Exception:
+                    slots.release() # otherwise waiting for the pool below never finishes
+                    raise
+                future.add_done_callback(folder_done)
+        except Exception as exp: #pylint: disable=broad-except
+            self._logger.error("Failed to walk %s", directory)
+            self._logger.error(exp)
+            with result_lock:
+                state["ok"] = False
+        finally:
+            for _ in range(limit): # wait for everything in the pool to finish
+                slots.acquire()
+            connection.close()
+        with result_lock:
+            results[directory] = (state["ok"], state["count"], time.monotonic() - started)
+
+    def _process_datasets_parallel(self, datasets, workers, verify_checksums=False):
+        """
+            Process the datasets using a pool of worker threads.
+            Datasets in the same folder are handled by the same worker, in order, so that
+            parent scans are created before the scans derived from them.
+            The number of folders queued up at any one time is bounded so that the
+            listing isn't turned into millions of pending futures.
+            :param iterable datasets: (parser, file) pairs to process
+            :param int workers: The number of worker threads to use
+            :param boolean verify_checksums: Always recalculate the checksums
+            :return boolean: True if every dataset was processed without error
+        """
+        self._logger.info("Processing datasets with %d workers", workers)
+        process_ok = True
+        max_pending = workers * QUEUE_DEPTH_PER_WORKER
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for (folder, group) in groupby(datasets, key=lambda dataset: dataset[1].parent):
+                if len(pending) >= max_pending:
+                    (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                    process_ok &= self._collect_results(done)
+                self._logger.debug("Queueing folder %s", folder)
+                pending.add(executor.submit(
+                    self._process_folder_worker, list(group), verify_checksums))
+            (done, _) = wait(pending)
+            process_ok &= self._collect_results(done)
+        return process_ok
+
+    def _collect_results(self, futures):
+        """
+            Gather the results of finished worker tasks
+            :param set futures: The completed futures
+            :return boolean: True if all of them reported success
+        """
+        process_ok = True
+        for future in futures:
+            try:
+                process_ok &= future.result()
+            except Exception as exp: #pylint: disable=broad-except
+                self._logger.error("Worker failed")
+                self._logger.error(exp)
+                process_ok = False
+        return process_ok
+
+    def _process_folder_worker(self, datasets, verify_checksums=False):
+        """
+            Run in a worker thread to process all the datasets found in a single folder.
+            Parsers keep state between calls so each thread uses its own copy.
+            :param List datasets: (parser, file) pairs to process
+            :param boolean verify_checksums: Always recalculate the checksums
+            :return boolean: True if every dataset was processed without error
+        """
+        try:
+            process_ok = True
+            for (parser, fname) in datasets:
+                process_ok &= self._process_dataset(
+                    self._worker_parser(parser), fname, verify_checksums)
+            return process_ok
+        finally:
+            # Each thread has its own DB connection, don't leave it open once finished
+            connection.close()
+
+    def _worker_parser(self, parser):
+        """
+            Get the copy of the parser belonging to the current thread
+            :param DatasetParser parser: The parser to get a copy of
+            :return DatasetParser
+        """
+        parsers = getattr(self._thread_data, "parsers", None)
+        if parsers is None:
+            parsers = {}
+            self._thread_data.parsers = parsers
+        parser_class = type(parser)
+        if parser_class not in parsers:
+            parsers[parser_class] = parser_class(self._log_level)
+        return parsers[parser_class]
+
+    def _process_dataset(self, parser, fname, verify_checksums=False):
+        """
+            Check a single dataset file against the database and update it if required.
+            Any errors are logged and reported through the return value so that one bad
+            dataset doesn't stop the rest being processed.
+            :param DatasetParser parser: The parser to use for the file
+            :param Path fname: The dataset file
+            :param boolean verify_checksums: Recalculate the checksum even if the fingerprint
+                shows the file is unchanged
+            :return boolean: True if processed without error
+        """
+        with self._timings.dataset(fname):
+            return self._process_dataset_timed(parser, fname, verify_checksums)
+
+    def _process_dataset_timed(self, parser, fname, verify_checksums):
+        """
+            See _process_dataset, called with the timings for the dataset being recorded
+        """
+        process_ok = True
+        changed = False # New datasets or ones that have changed get their files done first
+        scan_index = self._scan_index
+        try:
+            self._logger.debug("Processing: %s", fname)
+            sidecar_filename = generate_sidecar_filename(fname)
+            self._logger.debug("sidecar filename: %s", sidecar_filename)
+            path = self._extract_path(fname)
+            share = self._extract_share(fname)
+            db_entry = None
+            if sidecar_filename.exists():
+                try:
+                    with self._timings.stage(STAGE_LOOKUP):
+                        db_entry_s = scan_index.get_pk(read_sidecar(sidecar_filename))
+                        sidecar_status = self._sidecar_status(db_entry_s, share, path, fname)
+                    self._logger.debug("Sidecar status: %s", sidecar_status.name)
+                    if sidecar_status == SidecarStatus.COPIED:
+                        self._logger.debug("copy found adding to DB")
+                        db_entry = parser.process_file(fname)
+                        changed = True
+                        # ^^  This will fix the wrong sidecar
+                    elif sidecar_status == SidecarStatus.MOVED:
+                        self._logger.debug("dataset moved")
+                        db_entry_s.share = share
+                        db_entry_s.path = path
+                        with self._timings.stage(STAGE_DB_WRITE):
+                            # Only the location, the cached record may be out of date
+                            db_entry_s.save(update_fields=["share", "path"])
+                        scan_index.add(db_entry_s)
+                        db_entry = db_entry_s # Use the found record
+                        changed = True
+                    elif sidecar_status == SidecarStatus.OK:
+                        db_entry = db_entry_s
+                    elif sidecar_status == SidecarStatus.INVALID:
+                        raise ValueError("How can a sidecar not refer to itself?")
+                except (ObjectDoesNotExist, KeyError):
+                    pass
+                except subprocess.CalledProcessError:
+                    self._logger.error("Failed to run a required subprocess")
+                    process_ok = False
+            else:
+                self._logger.debug("Sidecar not found")
+            if not db_entry: #haven't got the db entry - have to search differently
+                #This could be because it's new, or because the sidecar didn't exist
+                short_fname = fname.name
+                with self._timings.stage(STAGE_LOOKUP):
+                    db_entry = scan_index.get(share, path, short_fname)
+                if db_entry:
+                    #Found a record of the file - therefore it didn't have a sidecar
+                    self._logger.debug(
+                        "Found existing record pk=%d",
+                        db_entry.pk)
+                    self._logger.warning(
+                        "Record %d didn't have a sidecar. Recreating...",
+                        db_entry.pk)
+                    db_entry.save_sidecar()
+            # Take the fingerprint before hashing so a change part way through is noticed next time
+            fingerprint = file_fingerprint(fname)
+            self._logger.debug("File fingerprint: %s", fingerprint)
+            if db_entry and not verify_checksums and db_entry.fingerprint == fingerprint:
+                self._logger.debug(
+                    "Fingerprints match, therefore it hasn't changed")
+            elif db_entry:
+                with self._timings.stage(STAGE_HASHING, fname.stat().st_size):
+                    calculated_checksum = calculate_file_hash(fname)
+                self._logger.debug("Calculated checksum: %s", calculated_checksum)
+                if db_entry.checksum == calculated_checksum:
+                    self._logger.debug(
+                        "Checksums match, therefore it hasn't changed")
+                    if db_entry.fingerprint != fingerprint:
+                        self._logger.debug("Updating fingerprint")
+                        db_entry.fingerprint = fingerprint
+                        with self._timings.stage(STAGE_DB_WRITE):
+                            db_entry.save(update_fields=["fingerprint"])
+                else:
+                    self._logger.debug("Checksum DO NOT match, it has changed")
+                    with self._timings.stage(STAGE_LOOKUP):
+                        # The cached record may have been changed since, eg. by
+                        # process_associated_files.py, and is saved in full
+                        db_entry.refresh_from_db()
+                    parser.process_file(fname, db_entry, calculated_checksum, fingerprint)
+                    changed = True
+            else:
+                self._logger.debug("No entry in database found")
+                self._logger.debug("Creating entry")
+                with self._timings.stage(STAGE_HASHING, fname.stat().st_size):
+                    calculated_checksum = calculate_file_hash(fname)
+                self._logger.debug("Calculated checksum: %s", calculated_checksum)
+                db_entry = parser.get_model()()
+                db_entry.projection0deg = None
+                db_entry.projection90deg = None
+                db_entry = self._parse_filepath(fname, db_entry)
+                db_entry = parser.process_file(fname, db_entry, calculated_checksum, fingerprint)
+                scan_index.add(db_entry)
+                with self._timings.stage(STAGE_DB_WRITE):
+                    db_entry.find_parent()
+                    db_entry.generate_sample_info()
+                changed = True
+            if self._defer_associated_files:
+                if changed: # The rest are rechecked by AssociatedFileQueue.recheck
+                    with self._timings.stage(STAGE_DB_WRITE):
+                        self._associated_queue.enqueue(db_entry, parser, True)
+            else:
+                parser.process_associated_files(db_entry)
+        except XrhmsIgnore:
+            self._logger.info("Ignoring file (%s) due to option", fname)
+        except Exception as exp: #pylint: disable=broad-except
+            self._logger.error("Failed to process %s", fname)
+            self._logger.error(exp)
+            process_ok = False
+        return process_ok
+
+    def _sidecar_status(self, db_entry, share, path, fname):
+        """
+            Work out the status of the sidecar file that led to the db entry.
+            If the record is for where the sidecar was found then there's no need to go
+            back to the DB to check the sidecar refers to it.
+            :param Scan db_entry: The record the sidecar refers to
+            :param Share share: The share the sidecar was found on
+            :param string path: The path the sidecar was found on
+            :param Path fname: The dataset file the sidecar is for
+            :return SidecarStatus
+        """
+        if (db_entry.share_id, db_entry.path, db_entry.filename) == (share.pk, path, fname.name):
+            return SidecarStatus.OK
+        return db_entry.check_sidecar_status(fname)
+
+
+    def process_associated_queue(
+            self, workers=DEFAULT_QUEUE_WORKERS, count=None, time_limit=None):
+        """
+            Process the queue of associated file tasks, see AssociatedFileQueue
+            :param int workers: How many tasks to run at the same time
+            :param int count: Stop after this many tasks (per worker)
+            :param int time_limit: Don't start any new tasks after this long (s)
+            :return boolean: True if none of the tasks failed
+        """
+        (processed, failed) = self._associated_queue.process_queue(workers, count, time_limit)
+        self._logger.info("Processed %d associated file tasks, %d failed", processed, failed)
+        return failed == 0
+
+    def count_failed_tasks(self):
+        """
+            :return int: The number of associated file tasks that have given up
+        """
+        return self._associated_queue.count_failed()
+
+    def reread_xtek_parameters(self, share=None, workers=DEFAULT_BATCH_WORKERS):
+        """
+            Read the parameters from the xtek files of the online CT scans again,
+            see XtekParser.reread_parameters
+            :param Share share: Only update the scans on this share
+            :param int workers: The number of processes to parse the files with
+            :return boolean: True if every scan was updated
+        """
+        try:
+            with Lock(LOCK_NAME, acquire_timeout=LOCK_TIMEOUT):
+                scans = NikonCTScan.objects.filter(
+                    dataset_status=DATASET_ONLINE).select_related("share")
+                if share is not None:
+                    scans = scans.filter(share=share)
+                self._logger.info("Re-reading %d xtek files", scans.count())
+                (_updated, failed) = self._lookup_parser("xtekct").reread_parameters(
+                    scans.iterator(), workers)
+                return failed == 0
+        except TimeoutError:
+            self._logger.critical("Unable to get DB lock")
+            return False
+
+    def backfill_projections(self, share=None, workers=DEFAULT_THUMBNAIL_WORKERS):
+        """
+            Store the projection thumbnails missing from the online CT scans,
+            see XtekParser.backfill_projections
+            :param Share share: Only check the scans on this share
+            :param int workers: The number of processes to make the thumbnails with
+            :return boolean: True if every thumbnail was stored
+        """
+        # No lock, this runs for hours and only saves the projection fields (update_fields)
+        # so it can't overwrite what an ingest running alongside it writes
+        missing = (
+            Q(projection0deg_png="") | Q(projection0deg_png__isnull=True) |
+            Q(projection90deg_png="") | Q(projection90deg_png__isnull=True))
+        scans = NikonCTScan.objects.filter(
+            missing, dataset_status=DATASET_ONLINE).select_related("share", "sample")
+        if share is not None:
+            scans = scans.filter(share=share)
+        self._logger.info("Checking projections of %d scans", scans.count())
+        (_stored, failed) = self._lookup_parser("xtekct").backfill_projections(
+            scans.iterator(), workers)
+        return failed == 0
+
+    def convert_recons(self, scans, writer, remove_original=False):
+        """
+            Convert the reconstructions of CT scans to chunked stores,
+            see XtekParser.convert_recon
+            :param iterable scans: The NikonCTScans to convert
+            :param ChunkedVolumeWriter writer: Writes the stores
+            :param boolean remove_original: Delete the original volumes once converted
+            :return (int, int): The number converted and the number attempted
+        """
+        parser = self._lookup_parser("xtekct")
+        converted = 0
+        total = 0
+        for scan in scans:
+            total += 1
+            self._logger.info("Converting %s", scan.name)
+            (status, output) = parser.convert_recon(scan, writer, remove_original)
+            if status:
+                converted += 1
+            else:
+                self._logger.error("Failed to convert %s: %s", scan.name, output.strip())
+        return (converted, total)
 
     def process_move_queue(self, count=None):
         """
@@ -395,9 +792,7 @@ class DatasetProcessor():
         try:
             with Lock(LOCK_NAME, acquire_timeout=LOCK_TIMEOUT):
                 self._logger.info("Lock acquired")
-                datasets = []
-                for parser in self._parsers:
-                    datasets += parser.list_files(src)
+                datasets = self.list_datasets(src)
                 self._logger.info(
                     "Found %d dataset files in structure to be moved", len(datasets))
                 not_found_count = 0
@@ -478,18 +873,10 @@ class DatasetProcessor():
         else:
             dname = fname.parent
         self._logger.debug("Directory name: %s", dname)
-        path_arr = dname.parts
-        if len(path_arr) < 3:
+        if len(dname.parts) < 3:
             self._logger.error("Unable to extract mount point from %s", dname)
             raise ValueError("Invalid directory name ({})".format(dname))
-        mnt_point = path_arr[2]
-        self._logger.debug("Dataset on mountpoint: %s", mnt_point)
-        try:
-            share = Share.objects.get(linux_mnt_point__contains=mnt_point)
-            return share
-        except ObjectDoesNotExist:
-            self._logger.error("Unable to match mount_point (%s) to value in DB", mnt_point)
-            raise ValueError("Unable to match mount_point ({}) to value in DB".format(mnt_point))  #pylint: disable=raise-missing-from
+        return self._share_resolver.share(dname)
 
     def _extract_path(self, fname, is_dir=False):
         """
@@ -498,14 +885,10 @@ class DatasetProcessor():
             :param boolean is_dir: Is a directory being passed in rather than a file
         """
         if is_dir:
-            path_arr = fname.parts
+            dname = fname
         else:
-            path_arr = fname.parent.parts
-        if len(path_arr) < 4:
-            #It's on the root of the share
-            self._logger.debug("Path doesn't have a directory component")
-            return ""
-        return "/".join(path_arr[3:])
+            dname = fname.parent
+        return self._share_resolver.relative_path(dname)
 
 
     def _parse_scan_name(self, scan_name):
@@ -662,13 +1045,7 @@ class DatasetProcessor():
             self._logger.error("Dataset path (%s) doesn't contain enough elements", dataset)
             raise ValueError("Dataset path ({}) doesn't contain enough elements".format(dataset))
         meta_data = self._parse_scan_name(path.stem)
-        mnt_point = path_arr[2]
-        self._logger.debug("Dataset on mountpoint: %s", mnt_point)
-        try:
-            share = Share.objects.get(linux_mnt_point__contains=mnt_point)
-        except ObjectDoesNotExist:
-            self._logger.error("Unable to match mount_point (%s) to value in DB", mnt_point)
-            raise ValueError("Unable to match mount_point ({}) to value in DB".format(mnt_point))  #pylint: disable=raise-missing-from
+        share = self._share_resolver.share(dataset)
         try:
             scanner = Machine.objects.get(name__icontains=meta_data["scanner"])
         except ObjectDoesNotExist:
@@ -783,12 +1160,42 @@ class DatasetProcessor():
             raise ValueError("Must pass in a Path")
         if not path.exists():
             raise ValueError("Path must exist")
-        datasets = []
-        for parser in self._parsers:
-            datasets += parser.list_files(path)
+        datasets = [fname for (_parser, fname) in self.iterate_datasets(path)]
         self._logger.debug("Found %d datasets", len(datasets))
         return datasets
 
+    def iterate_datasets(self, path):
+        """
+            Walk the path once, yielding the datasets as they are found along with the
+            parser that handles them
+            :param Path path: the path to look at
+            :return generator of (DatasetParser, Path)
+        """
+        for fname in iterate_files(path, self.dataset_extensions()):
+            yield (self._lookup_parser(fname.suffix), fname)
+
+    def datasets_from_files(self, files):
+        """
+            Pair up each of the files with the parser that handles it.
+            Files that none of the parsers know about are skipped.
+            :param iterable files: Paths to dataset files
+            :return List: (parser, file) pairs
+        """
+        datasets = []
+        for fname in files:
+            try:
+                datasets.append((self._lookup_parser(fname.suffix), fname))
+            except KeyError:
+                self._logger.debug("No parser for %s", fname)
+        return datasets
+
+    def dataset_extensions(self):
+        """
+            All of the extensions that the parsers know about
+            :return List: extensions including the leading .
+        """
+        return [".{}".format(ext) for ext in self._parser_dict]
+
     def lookup_dataset(self, fname):
         """
             Lookup the dataset object based on the path of the dataset
@@ -966,8 +1373,12 @@ class DatasetProcessor():
                 output = ""
                 parser = self._lookup_parser(Path(scan.filename).suffix)
                 if copy.include_recon_data:
-                    (status, tmp_output) = parser.copy_recon(
-                        scan, dest_folder, not copy.include_raw_data)
+                    if copy.preview_factor:
+                        (status, tmp_output) = parser.copy_preview(
+                            scan, dest_folder, copy.preview_factor, not copy.include_raw_data)
+                    else:
+                        (status, tmp_output) = parser.copy_recon(
+                            scan, dest_folder, not copy.include_raw_data)
                     success &= status
                     output += tmp_output
                     if status:
@@ -20,6 +20,8 @@
 """
 
 import logging
+import shutil
+import uuid
 from argparse import ArgumentParser
 from sys import exit, stderr
 from pathlib import Path
@@ -81,12 +83,22 @@ class DriveUploader():
 
     def upload(self, title, filepath, folder_name=UPLOAD_FOLDER):
         """
-            Upload the specified file to google drive
+            Upload the specified file to google drive and share it
             :param string title: The title to give the file when uploaded
             :param Path filepath: The file to upload
             :param string folder_name: The name of the gdrive folder to upload to
             :return string: The public URL of the uploaded file
         """
+        return self.share(self.upload_file(title, filepath, folder_name))
+
+    def upload_file(self, title, filepath, folder_name=UPLOAD_FOLDER):
+        """
+            Upload the specified file to google drive without sharing it
+            :param string title: The title to give the file when uploaded
+            :param Path filepath: The file to upload
+            :param string folder_name: The name of the gdrive folder to upload to
+            :return string: The ID of the uploaded file
+        """
         if not filepath.exists():
             self._logger.error("Cannot find file %s", filepath)
             raise FileNotFoundError("Cannot find file {}".format(str(filepath)))
@@ -104,7 +116,21 @@ class DriveUploader():
         gfile.SetContentFile(str(filepath))
         gfile["title"] = title
         gfile.Upload()
+        self._logger.debug("Uploaded %s as %s", filepath, gfile["id"])
+        return gfile["id"]
+
+    def share(self, file_id):
+        """
+            Make an uploaded file readable by anyone with the link
+            :param string file_id: The ID returned by upload_file
+            :return string: The public URL of the file
+        """
+        if not self._gdrive:
+            self._logger.error("Must authenticate before sharing")
+            raise ValueError("Not authenticated")
+        gfile = self._gdrive.CreateFile({"id": file_id})
         gfile.InsertPermission({"type" :"anyone", "role": "reader", "withLink":True})
+        gfile.FetchMetadata(fields="alternateLink")
         self._logger.debug("Original URL: %s", gfile["alternateLink"])
         url = gfile["alternateLink"].split("?")[0] # remove the GET params off the end to tidy it
         self._logger.info("Cleaned URL: %s", url)
@@ -144,6 +170,75 @@ class DriveUploader():
         self._logger.info("Used: %d, Total: %d, Used %d%%", used, total, int(percentage))
         return (used, total, percentage)
 
+class LocalDriveUploader():
+    """
+        Stands in for DriveUploader by copying files into a local directory,
+        for testing the uploaders without touching google drive
+    """
+
+    def __init__(self, directory):
+        """
+            :param Path directory: Where to put the "uploaded" files
+        """
+        self._logger = logging.getLogger("Local Drive Uploader")
+        self._directory = Path(directory)
+
+    def authenticate(self, ui=False): #pylint: disable=invalid-name,unused-argument
+        """
+            Make sure the directory exists
+            :param boolean ui: Ignored
+        """
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+    def upload(self, title, filepath, folder_name=UPLOAD_FOLDER):
+        """
+            Copy the file into the directory
+            :param string title: The title to give the file when uploaded
+            :param Path filepath: The file to upload
+            :param string folder_name: The sub directory to copy into
+            :return string: The URI of the copy
+        """
+        return self.share(self.upload_file(title, filepath, folder_name))
+
+    def upload_file(self, title, filepath, folder_name=UPLOAD_FOLDER):
+        """
+            Copy the file into the directory
+            :param string title: The title to give the file when uploaded
+            :param Path filepath: The file to upload
+            :param string folder_name: The sub directory to copy into
+            :return string: The path of the copy relative to the directory
+        """
+        if not filepath.exists():
+            self._logger.error("Cannot find file %s", filepath)
+            raise FileNotFoundError("Cannot find file {}".format(str(filepath)))
+        if not title:
+            self._logger.error("Must specify a title")
+            raise ValueError("Must specify a title")
+        folder = Path(self._directory, folder_name)
+        folder.mkdir(parents=True, exist_ok=True)
+        target = Path(folder, "{}{}".format(uuid.uuid4().hex, filepath.suffix))
+        shutil.copyfile(str(filepath), str(target))
+        self._logger.info("Copied %s to %s", filepath, target)
+        return str(target.relative_to(self._directory))
+
+    def share(self, file_id):
+        """
+            :param string file_id: The path returned by upload_file
+            :return string: The URI of the copy
+        """
+        target = Path(self._directory, file_id)
+        if not target.exists():
+            raise FileNotFoundError("Cannot find file {}".format(str(target)))
+        return target.resolve().as_uri()
+
+    def get_quota(self):
+        """
+            Check how much space is available in the directory
+            :return (available, total, percentage)
+        """
+        (total, used, _) = shutil.disk_usage(str(self._directory))
+        return (used, total, used / total * 100)
+
 if __name__ == "__main__":
     PARSER = ArgumentParser(
         description="Google drive upload")
@@ -20,37 +20,35 @@ source ../xrhms-env/bin/activate
 #Load in the icinga submit code
 source /opt/xrh-scripts/icinga_submit.sh
 
-./update_database.py -v /mnt/xrh-hot/CTData >> /opt/xrhms-venv/logs/ingest_hot.log 2>> /opt/xrhms-venv/logs/ingest_hot.err
+#The roots to ingest and the icinga service each one reports to
+declare -A SERVICES=(
+    ["/mnt/xrh-hot/CTData"]="XRH Hot Ingest"
+    ["/mnt/xrh-warm/CTData"]="XRH Warm Ingest"
+    ["/mnt/medx-data/CTData"]="Med-X Data Ingest"
+#    ["/mnt/medxdataB/External_academic"]="Med-X Ext-Ac Ingest"
+)
 
-update_status=$?
-if [ $update_status -ne 0 ]; then
-    icinga_submit $STATUS_CRITICAL "XRH Hot Ingest" "Ingest exited with code $update_status"
-else
-    icinga_submit $STATUS_OK "XRH Hot Ingest" "Ingest suceeded"
-fi
+#Per root results and stage timings are passed to icinga as performance data
+status_file=$(mktemp)
+perf_file=$(mktemp)
+trap 'rm -f "$status_file" "$perf_file"' EXIT
 
-./update_database.py -v /mnt/xrh-warm/CTData >> /opt/xrhms-venv/logs/ingest_warm.log 2>> /opt/xrhms-venv/logs/ingest_warm.err
+#All the roots are ingested at once sharing the workers, each root is limited so a slow
+#share can't hold up the others
+./update_database.py -v --defer-associated-files --workers 12 --root-workers 4 --root-limit /mnt/xrh-hot/CTData=8 --status "$status_file" --timings /opt/xrhms-venv/logs/ingest_scans_timings.json --perfdata "$perf_file" "${!SERVICES[@]}" >> /opt/xrhms-venv/logs/ingest_scans.log 2>> /opt/xrhms-venv/logs/ingest_scans.err
 update_status=$?
-if [ $update_status -ne 0 ]; then
-    icinga_submit $STATUS_CRITICAL "XRH Warm Ingest" "Ingest exited with code $update_status"
-else
-    icinga_submit $STATUS_OK "XRH Warm Ingest" "Ingest suceeded"
-fi
 
-./update_database.py -v /mnt/medx-data/CTData >> /opt/xrhms-venv/logs/ingest_medx-data.log 2>> /opt/xrhms-venv/logs/ingest_medx-data.err
-update_status=$?
-if [ $update_status -ne 0 ]; then
-    icinga_submit $STATUS_CRITICAL "Med-X Data Ingest" "Ingest exited with code $update_status"
-else
-    icinga_submit $STATUS_OK "Med-X Data Ingest" "Ingest suceeded"
-fi
-#./update_database.py -v /mnt/medxdataB/External_academic/ >> /opt/xrhms-venv/logs/ingest_medx-ext-ac.log 2>> /opt/xrhms-venv/logs/ingest_medx-ext-ac.err
-#update_status=$?
-#if [ $update_status -ne 0 ]; then
-#    icinga_submit $STATUS_CRITICAL "Med-X Ext-Ac Ingest" "Ingest exited with code $update_status"
-#else
-#    icinga_submit $STATUS_OK "Med-X Ext-Ac Ingest" "Ingest suceeded"
-#fi
+while IFS=$'\t' read -r root result perfdata; do
+    if [ "$result" == "OK" ]; then
+        icinga_submit $STATUS_OK "${SERVICES[$root]}" "Ingest suceeded|$perfdata"
+    else
+        icinga_submit $STATUS_CRITICAL "${SERVICES[$root]}" "Errors occured during ingest|$perfdata"
+    fi
+    unset "SERVICES[$root]"
+done < "$status_file"
+#Anything left didn't get a result so the ingest must have failed before finishing
+for root in "${!SERVICES[@]}"; do
+    icinga_submit $STATUS_CRITICAL "${SERVICES[$root]}" "Ingest exited with code $update_status"
+done
 #exit the virtualenv
 deactivate
-
@@ -0,0 +1,268 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Record where the time goes during an ingest run.
+
+    Time is recorded against the innermost stage running in the thread, so nested stages
+    don't count twice and the stages add up to the time spent. DB queries are counted the
+    same way using a wrapper on the thread's connection.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+STAGE_DISCOVERY = "discovery"
+STAGE_LOOKUP = "lookup"
+STAGE_HASHING = "hashing"
+STAGE_METADATA = "metadata"
+STAGE_XML_PARSING = "xml_parsing"
+STAGE_VSI_EXTRACTION = "vsi_extraction"
+STAGE_DB_WRITE = "db_write"
+STAGE_ATTACHMENTS = "attachments"
+STAGE_REFINED_FILES = "refined_files"
+STAGE_EXTRA_LISTING = "extra_listing"
+STAGE_PROJECTIONS = "projections"
+STAGE_PROJECTION_STACK = "projection_stack"
+STAGE_TIFF2PNG = "tiff2png"
+STAGE_XYSLICE = "stack2xyslice"
+STAGE_VOLUME_STATS = "volume_stats"
+STAGE_PREVIEWS = "previews"
+STAGE_TILE_PYRAMIDS = "tile_pyramids"
+STAGE_PREVIEW_VOLUMES = "preview_volumes"
+STAGE_VIDEOS = "videos"
+STAGE_REPORTS = "report_tasks"
+STAGE_OTHER = "other" # Time within a dataset not covered by another stage
+
+DEFAULT_SLOWEST = 10 # Number of slowest datasets to include in the summary
+
+class _Frame():
+    """
+        A stage that is currently running in a thread
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.queries = 0
+
+class IngestTimings():
+    """
+        Collects the time, bytes read and DB queries for each stage of the ingest,
+        in total and per dataset. Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("Ingest timings")
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+            Forget everything recorded so far
+        """
+        with self._lock:
+            self._started = time.perf_counter()
+            self._totals = {}
+            self._datasets = {}
+
+    def _stack(self):
+        """
+            :return List: The stages running in this thread, innermost last
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def _count_query(self, execute, sql, params, many, context):
+        """
+            Connection execute wrapper, see django.db.backends execute_wrapper
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].queries += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        """
+            Time a block of code
+            :param string name: The stage being run
+            :param int nbytes: The number of bytes the stage reads
+        """
+        stack = self._stack()
+        now = time.perf_counter()
+        if stack:
+            stack[-1].elapsed += now - stack[-1].started # pause the outer stage
+        frame = _Frame(name)
+        stack.append(frame)
+        try:
+            if len(stack) == 1:
+                with connection.execute_wrapper(self._count_query):
+                    yield
+            else:
+                yield
+        finally:
+            now = time.perf_counter()
+            stack.pop()
+            frame.elapsed += now - frame.started
+            if stack:
+                stack[-1].started = now
+            self._record(name, frame.elapsed, nbytes, frame.queries)
+
+    def timed_iter(self, name, iterable):
+        """
+            Time how long it takes to produce each item of an iterable,
+            the time spent processing the items isn't included.
+            :param string name: The stage being run
+            :param iterable iterable: The items to time
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    @contextmanager
+    def dataset(self, fname):
+        """
+            Attribute the stages run within the block to a dataset
+            :param Path fname: The dataset being processed
+        """
+        previous = getattr(self._local, "dataset", None)
+        self._local.dataset = str(fname)
+        with self._lock:
+            self._datasets.setdefault(str(fname), {})
+        try:
+            with self.stage(STAGE_OTHER):
+                yield
+        finally:
+            self._local.dataset = previous
+
+    def _record(self, name, elapsed, nbytes, queries):
+        """
+            Add a finished stage to the totals
+            :param string name: The stage
+            :param float elapsed: How long it took (s)
+            :param int nbytes: How many bytes it read
+            :param int queries: How many DB queries it made
+        """
+        dataset = getattr(self._local, "dataset", None)
+        with self._lock:
+            targets = [self._totals]
+            if dataset is not None:
+                targets.append(self._datasets[dataset])
+            for target in targets:
+                totals = target.setdefault(
+                    name, {"count": 0, "seconds": 0.0, "bytes": 0, "queries": 0})
+                totals["count"] += 1
+                totals["seconds"] += elapsed
+                totals["bytes"] += nbytes
+                totals["queries"] += queries
+
+    def summary(self, slowest=DEFAULT_SLOWEST):
+        """
+            :param int slowest: How many of the slowest datasets to include
+            :return dict: The recorded timings
+        """
+        with self._lock:
+            datasets = []
+            for (fname, stages) in self._datasets.items():
+                datasets.append({
+                    "dataset": fname,
+                    "seconds": sum(stage["seconds"] for stage in stages.values()),
+                    "stages": {name: dict(stage) for (name, stage) in stages.items()}})
+            datasets.sort(key=lambda dataset: dataset["seconds"], reverse=True)
+            return {
+                "elapsed": time.perf_counter() - self._started,
+                "datasets": len(self._datasets),
+                "stages": {name: dict(stage) for (name, stage) in self._totals.items()},
+                "slowest": datasets[:slowest]}
+
+    def write_json(self, fname):
+        """
+            Write the summary out as JSON
+            :param Path fname: Where to write it
+        """
+        with open(fname, "w") as fhandle:
+            json.dump(self.summary(), fhandle, indent=2)
+        self._logger.debug("Timings written to %s", fname)
+
+    def root_summary(self, root):
+        """
+            Add up the stages for the datasets below a directory.
+            Stages that weren't for a dataset (such as discovery) aren't included.
+            :param Path root: The directory
+            :return (int, dict): The number of datasets and the totals for each stage
+        """
+        prefix = os.path.join(str(root), "")
+        stages = {}
+        count = 0
+        with self._lock:
+            for (fname, dataset_stages) in self._datasets.items():
+                if not fname.startswith(prefix):
+                    continue
+                count += 1
+                for (name, stage) in dataset_stages.items():
+                    totals = stages.setdefault(
+                        name, {"count": 0, "seconds": 0.0, "bytes": 0, "queries": 0})
+                    for (key, value) in stage.items():
+                        totals[key] += value
+        return (count, stages)
+
+    def perfdata(self, root=None, elapsed=None):
+        """
+            Format the totals as Icinga/Nagios performance data
+            :param Path root: Only include the datasets below this directory
+            :param float elapsed: The time taken, if not since the timings were reset (s)
+            :return string
+        """
+        if root is None:
+            summary = self.summary(0)
+            (count, stages) = (summary["datasets"], summary["stages"])
+            if elapsed is None:
+                elapsed = summary["elapsed"]
+        else:
+            (count, stages) = self.root_summary(root)
+            if elapsed is None:
+                elapsed = time.perf_counter() - self._started
+        values = [
+            "'elapsed'={:.3f}s".format(elapsed),
+            "'datasets'={:d}".format(count)]
+        for (name, stage) in sorted(stages.items()):
+            values.append("'{}_time'={:.3f}s".format(name, stage["seconds"]))
+            values.append("'{}_bytes'={:d}B".format(name, stage["bytes"]))
+            values.append("'{}_queries'={:d}c".format(name, stage["queries"]))
+        return " ".join(values)
+
+TIMINGS = IngestTimings()
+
+def get_ingest_timings():
+    """
+        :return IngestTimings: The timings shared by the whole process
+    """
+    return TIMINGS
@@ -20,13 +20,19 @@ source ../xrhms-env/bin/activate
 #Load in the icinga submit code
 source /opt/xrh-scripts/icinga_submit.sh
 
+#Stage timings from each run are passed to icinga as performance data
+perf_file=$(mktemp)
+trap 'rm -f "$perf_file"' EXIT
 
-./update_database.py -v /mnt/xrh-warm/CTData >> /opt/xrhms-venv/logs/ingest_warm.log 2>> /opt/xrhms-venv/logs/ingest_warm.err
+
+./update_database.py -v --timings /opt/xrhms-venv/logs/ingest_warm_timings.json --perfdata "$perf_file" /mnt/xrh-warm/CTData >> /opt/xrhms-venv/logs/ingest_warm.log 2>> /opt/xrhms-venv/logs/ingest_warm.err
 update_status=$?
+perfdata=$(cat "$perf_file")
+: > "$perf_file" #Don't report stale timings if the next run fails to write any
 if [ $update_status -ne 0 ]; then
-    icinga_submit $STATUS_CRITICAL "XRH Warm Ingest" "Ingest exited with code $update_status"
+    icinga_submit $STATUS_CRITICAL "XRH Warm Ingest" "Ingest exited with code $update_status|$perfdata"
 else
-    icinga_submit $STATUS_OK "XRH Warm Ingest" "Ingest suceeded"
+    icinga_submit $STATUS_OK "XRH Warm Ingest" "Ingest suceeded|$perfdata"
 fi
 #exit the virtualenv
 deactivate
@@ -0,0 +1,282 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Continuously ingest datasets as they are written rather than re-walking the shares.
+
+    inotify only reports changes made through this machine's mount so changes made
+    directly on the NAS by other clients may be missed.  A full reconcile of each root
+    is still run periodically to pick these up.  The ingest timings are reset after each
+    batch so they don't grow for the life of the process.
+"""
+import errno
+import logging
+import os
+import time
+from pathlib import Path
+
+from inotify_simple import INotify, flags
+
+from dataset_parser import is_pruned
+from dataset_processor import DEFAULT_WORKERS
+from ingest_timing import get_ingest_timings
+
+DEFAULT_SETTLE_TIME = 120 # seconds without changes before a dataset is ingested
+DEFAULT_RECONCILE_INTERVAL = 24 * 60 * 60 # seconds between full walks of the roots
+MAX_READ_TIMEOUT = 60 # Never block on inotify for longer than this (s)
+
+WATCH_FLAGS = (
+    flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+    flags.DELETE)
+
+class IngestWatcher():
+    """
+        Watch the roots for changes and feed the datasets affected into the dataset processor
+        once they have stopped changing
+    """
+
+    def __init__(
+            self,
+            dataset_processor,
+            roots,
+            settle_time=DEFAULT_SETTLE_TIME,
+            reconcile_interval=DEFAULT_RECONCILE_INTERVAL,
+            workers=DEFAULT_WORKERS,
+            root_workers=None,
+            verify_checksums=False,
+            log_level=logging.WARNING):
+        """
+            :param DatasetProcessor dataset_processor: Used to process the datasets found
+            :param List roots: The directories (Path) to watch
+            :param int settle_time: How long a dataset must be unchanged before ingesting (s)
+            :param int reconcile_interval: How often to do a full walk of the roots (s)
+            :param int workers: How many datasets to process concurrently
+            :param dict root_workers: How many datasets to process concurrently from each
+                root during a reconcile, see DatasetProcessor.process_directories
+            :param boolean verify_checksums: Recalculate the checksum of every dataset
+                processed even if the file appears unchanged
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Ingest watcher")
+        self._logger.setLevel(log_level)
+        for root in roots:
+            if not root.is_dir():
+                raise ValueError("{} must be a directory".format(root))
+        self._processor = dataset_processor
+        self._roots = roots
+        self._settle_time = settle_time
+        self._reconcile_interval = reconcile_interval
+        self._workers = workers
+        self._root_workers = root_workers
+        self._verify_checksums = verify_checksums
+        self._extensions = tuple(dataset_processor.dataset_extensions())
+        self._inotify = INotify()
+        self._watches = {} # watch descriptor -> directory
+        self._folder_datasets = {} # directory -> datasets affected by changes in it
+        self._pending = {} # dataset -> time of last change
+        self._last_reconcile = None
+        self._reconcile_needed = False # Set when events have been lost
+        self._timings = get_ingest_timings()
+
+    def run(self):
+        """
+            Watch for changes forever
+        """
+        for root in self._roots:
+            self._watch_tree(root, False) # The reconcile will pick up what's already there
+        self._logger.info("Watching %d directories", len(self._watches))
+        self.reconcile()
+        while True:
+            for event in self._inotify.read(timeout=self._read_timeout()):
+                self._handle_event(event)
+            if self._reconcile_needed:
+                self._logger.warning("Running full reconcile after losing events")
+                self.reconcile()
+                continue
+            self._process_settled()
+            if time.monotonic() - self._last_reconcile >= self._reconcile_interval:
+                self.reconcile()
+
+    def reconcile(self):
+        """
+            Do a full pass over all of the roots to catch anything inotify missed
+            :return boolean: True if all the roots were processed without error
+        """
+        self._logger.info("Running full reconcile")
+        self._last_reconcile = time.monotonic()
+        self._reconcile_needed = False
+        try:
+            if len(self._roots) == 1 and not self._root_workers:
+                return self._processor.process_directory(
+                    self._roots[0], self._workers, self._verify_checksums)
+            results = self._processor.process_directories(
+                self._roots, self._workers, self._root_workers, self._verify_checksums)
+            return all(result[0] for result in results.values())
+        finally:
+            self._roll_timings()
+
+    def _read_timeout(self):
+        """
+            Work out how long to wait for events before something else needs doing
+            :return int: timeout in ms
+        """
+        now = time.monotonic()
+        deadline = self._last_reconcile + self._reconcile_interval
+        if self._pending:
+            deadline = min(deadline, min(self._pending.values()) + self._settle_time)
+        return int(max(0, min(deadline - now, MAX_READ_TIMEOUT)) * 1000)
+
+    def _watch_tree(self, directory, queue_existing=True):
+        """
+            Add watches to the directory and everything below it.
+            :param Path directory: The top of the tree to watch
+            :param boolean queue_existing: Queue any datasets already in the tree as they may
+                have been written before the watch was in place
+        """
+        to_visit = [str(directory)]
+        while to_visit:
+            current = to_visit.pop()
+            try:
+                wd = self._inotify.add_watch(current, WATCH_FLAGS) #pylint: disable=invalid-name
+            except OSError as err:
+                if err.errno == errno.ENOSPC:
+                    self._logger.error(
+                        "Out of inotify watches, increase fs.inotify.max_user_watches")
+                else:
+                    self._logger.warning("Unable to watch %s", current)
+                    self._logger.debug(err)
+                continue
+            self._watches[wd] = Path(current)
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not is_pruned(entry.name):
+                                to_visit.append(entry.path)
+                        elif queue_existing and entry.name.endswith(self._extensions):
+                            self._mark_changed(Path(entry.path))
+            except OSError as err:
+                self._logger.warning("Unable to list %s", current)
+                self._logger.debug(err)
+
+    def _handle_event(self, event):
+        """
+            Work out which datasets the event affects and mark them as changed
+            :param Event event: The inotify event
+        """
+        if event.mask & flags.Q_OVERFLOW:
+            # Reconciled from the main loop once the events already read are handled
+            self._logger.warning("inotify queue overflowed, full reconcile needed")
+            self._reconcile_needed = True
+            return
+        if event.mask & flags.IGNORED:
+            self._watches.pop(event.wd, None)
+            return
+        try:
+            folder = self._watches[event.wd]
+        except KeyError:
+            return
+        path = Path(folder, event.name)
+        if event.mask & flags.ISDIR:
+            if (
+                    event.mask & (flags.CREATE | flags.MOVED_TO) and
+                    not is_pruned(event.name)):
+                self._logger.debug("New directory %s", path)
+                self._watch_tree(path)
+            return
+        if event.name.endswith(self._extensions):
+            self._folder_datasets.clear() # which folders map to which datasets may have changed
+            self._mark_changed(path)
+            return
+        for dataset in self._datasets_for_folder(folder):
+            self._mark_changed(dataset)
+
+    def _mark_changed(self, dataset):
+        """
+            Record that the dataset has changed and needs ingesting once it settles
+            :param Path dataset: The dataset file
+        """
+        self._pending[dataset] = time.monotonic()
+
+    def _datasets_for_folder(self, folder):
+        """
+            Work out which datasets are affected by a change in a folder.
+            For files in a dataset folder (projections, ctprofile etc) this is the datasets
+            in the folder, for files in a reconstruction folder (or below it) it's the
+            dataset the folder is named after.
+            :param Path folder: The folder the change was in
+            :return List: The dataset files
+        """
+        if folder in self._folder_datasets:
+            return self._folder_datasets[folder]
+        datasets = []
+        try:
+            with os.scandir(folder) as entries:
+                datasets = [
+                    Path(entry.path) for entry in entries
+                    if entry.name.endswith(self._extensions)]
+        except OSError as err:
+            self._logger.debug(err)
+        current = folder
+        while not datasets and not self._is_root(current) and current != current.parent:
+            for extension in self._extensions:
+                candidate = Path(current.parent, current.name + extension)
+                if candidate.exists():
+                    datasets.append(candidate)
+            current = current.parent
+        if datasets:
+            self._folder_datasets[folder] = datasets
+        return datasets
+
+    def _is_root(self, folder):
+        """
+            :param Path folder: The folder to check
+            :return boolean: True if the folder is one of the roots being watched
+        """
+        return folder in self._roots
+
+    def _process_settled(self):
+        """
+            Ingest the datasets that have not changed for long enough
+        """
+        now = time.monotonic()
+        settled = [
+            dataset for (dataset, changed) in self._pending.items()
+            if now - changed >= self._settle_time]
+        if not settled:
+            return
+        for dataset in settled:
+            del self._pending[dataset]
+        existing = [dataset for dataset in settled if dataset.exists()]
+        self._logger.info("Ingesting %d changed datasets", len(existing))
+        if not existing:
+            return
+        # Each folder's datasets must be together, and in order, so a worker creates the
+        # parent scans before those derived from them.  Sorting the paths alone would put a
+        # sub folder's datasets between its parent folder's.
+        datasets = self._processor.datasets_from_files(
+            sorted(existing, key=lambda dataset: (dataset.parent, dataset.name)))
+        if not self._processor.process_datasets(
+                datasets, self._workers, self._verify_checksums):
+            self._logger.error("Errors occured processing changed datasets")
+        self._roll_timings()
+
+    def _roll_timings(self):
+        """
+            Log the timings of the batch just processed and start afresh for the next one
+        """
+        self._logger.debug("Batch timings: %s", self._timings.perfdata())
+        self._timings.reset()
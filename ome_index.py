@@ -0,0 +1,203 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Index of an OME-XML document so the parts the VSI parser needs can be looked up
+    without searching the whole tree each time.
+    The document is streamed so only the index is held in memory, the images (with all of
+    their planes) are streamed again one at a time when they are processed.
+
+    Olympus writes all of the original metadata as XMLAnnotation/OriginalMetadata key value
+    pairs, for a slide with many scenes and channels there are tens of thousands of them.
+"""
+import bisect
+import copy
+import logging
+from collections import namedtuple
+
+from xrh_utils import stream_xml_elements
+
+NS = {"ome":"http://www.openmicroscopy.org/Schemas/OME/2016-06"} # namespace within the XML to us
+IMAGE_TAG = "{{{}}}Image".format(NS["ome"])
+INSTRUMENT_TAG = "{{{}}}Instrument".format(NS["ome"])
+XML_ANNOTATION_TAG = "{{{}}}XMLAnnotation".format(NS["ome"])
+INDEXED_TAGS = {IMAGE_TAG, INSTRUMENT_TAG, XML_ANNOTATION_TAG}
+
+ImageSummary = namedtuple(
+    "ImageSummary", ["image_id", "name", "size_x", "size_y", "channels", "acquisition_date"])
+
+def stream_images(xmlfile, names):
+    """
+        Stream through a document returning the first image with each of the names.
+        Each image is discarded once the next one is requested.
+        :param Path xmlfile: The OME-XML file
+        :param iterable names: The names of the images wanted
+        :return generator: Image elements in document order
+    """
+    remaining = set(names)
+    for image in stream_xml_elements(xmlfile, {IMAGE_TAG}):
+        name = image.get("Name")
+        if name in remaining:
+            remaining.discard(name)
+            yield image
+            if not remaining:
+                return
+
+class OmeIndex():
+    """
+        Summaries of the images along with the instruments and original metadata from an
+        OME-XML document.
+        Where a key or image name appears more than once the first one is used, as searching
+        the document in order would.
+    """
+
+    def __init__(self, log_level=logging.WARNING):
+        """
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("OME index")
+        self._logger.setLevel(log_level)
+        self._metadata = {} # key -> value
+        self._order = {} # key -> position in the document
+        self._by_value = {} # value -> keys with that value in document order
+        self._sorted_keys = None # Built when first needed for prefix searches
+        self.images = [] # ImageSummary in document order
+        self._images_by_id = {}
+        self._images_by_name = {}
+        self.instruments = [] # Instrument elements in document order
+        self._instruments_by_id = {}
+
+    @classmethod
+    def from_file(cls, xmlfile, log_level=logging.WARNING):
+        """
+            Index a document by streaming through it, only the index is kept in memory
+            :param Path xmlfile: The OME-XML file
+            :param int log_level: How verbose to be
+            :return OmeIndex
+        """
+        index = cls(log_level)
+        for elem in stream_xml_elements(xmlfile, INDEXED_TAGS):
+            if elem.tag == IMAGE_TAG:
+                index.add_image(elem)
+            elif elem.tag == INSTRUMENT_TAG:
+                index.add_instrument(copy.deepcopy(elem)) # small and needed whole
+            else:
+                index.add_annotation(elem)
+        index.log_summary()
+        return index
+
+    def log_summary(self):
+        """
+            Log how much has been indexed
+        """
+        self._logger.debug(
+            "Indexed %d images, %d instruments and %d metadata keys",
+            len(self.images), len(self.instruments), len(self._metadata))
+
+    def add_image(self, image):
+        """
+            Add the summary of an image, the planes and channels aren't kept
+            :param Element image: An Image element
+        """
+        pixels = image.find("ome:Pixels", NS)
+        summary = ImageSummary(
+            image_id=image.get("ID"),
+            name=image.get("Name"),
+            size_x=int(pixels.get("SizeX")),
+            size_y=int(pixels.get("SizeY")),
+            channels=len(pixels.findall("ome:Channel", NS)),
+            acquisition_date=image.findtext("ome:AcquisitionDate", None, NS))
+        self.images.append(summary)
+        self._images_by_id.setdefault(summary.image_id, summary)
+        self._images_by_name.setdefault(summary.name, summary)
+
+    def add_instrument(self, instrument):
+        """
+            :param Element instrument: An Instrument element
+        """
+        self.instruments.append(instrument)
+        self._instruments_by_id.setdefault(instrument.get("ID"), instrument)
+
+    def add_annotation(self, annotation):
+        """
+            Add the original metadata from an XMLAnnotation, other annotations are ignored
+            :param Element annotation: An XMLAnnotation element
+        """
+        metadata = annotation.find("ome:Value/ome:OriginalMetadata", NS)
+        if metadata is None:
+            return
+        key = metadata.findtext("ome:Key", None, NS)
+        value = metadata.findtext("ome:Value", None, NS)
+        if key is None or key in self._metadata:
+            return
+        self._order[key] = len(self._order)
+        self._metadata[key] = value
+        self._by_value.setdefault(value, []).append(key)
+        self._sorted_keys = None
+
+    def image(self, image_id):
+        """
+            :param string image_id: The ID of the image
+            :return ImageSummary: The image or None
+        """
+        return self._images_by_id.get(image_id)
+
+    def image_by_name(self, name):
+        """
+            :param string name: The name of the image
+            :return ImageSummary: The first image with that name or None
+        """
+        return self._images_by_name.get(name)
+
+    def instrument(self, instrument_id):
+        """
+            :param string instrument_id: The ID of the instrument
+            :return Element: The Instrument element or None
+        """
+        return self._instruments_by_id.get(instrument_id)
+
+    def metadata(self, key):
+        """
+            :param string key: The original metadata key
+            :return string: The value or None if the key isn't present
+        """
+        return self._metadata.get(key)
+
+    def metadata_prefix(self, prefix):
+        """
+            Find the first key in the document starting with prefix
+            :param string prefix: The start of the key
+            :return (string, string): The key and value, or None if there isn't one
+        """
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._metadata)
+        start = bisect.bisect_left(self._sorted_keys, prefix)
+        best = None
+        for key in self._sorted_keys[start:]:
+            if not key.startswith(prefix):
+                break
+            if best is None or self._order[key] < self._order[best]:
+                best = key
+        if best is None:
+            return None
+        return (best, self._metadata[best])
+
+    def keys_with_value(self, value):
+        """
+            :param string value: The value to look for
+            :return List: The keys with the value in document order
+        """
+        return self._by_value.get(value, [])
@@ -0,0 +1,231 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Write downsampled copies of a reconstructed volume for a quick look at a scan.
+
+    Each level is made by block averaging the level before it, so the full volume is only
+    read once and the 4x preview is made from the 2x one.  The volumes are read and written
+    a slab of slices at a time so the memory used doesn't depend on the size of the volume.
+    Voxels at the far edges that don't fill a whole block are dropped.
+"""
+import logging
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+from sys import stdout, exit
+
+import numpy
+
+from volume_reader import VolumeReader, AXIS_X, AXIS_Y, AXIS_Z
+from xrh_utils import vgi_from_vol
+
+PREVIEW_FACTORS = [2, 4, 8]
+PREVIEW_CHUNK_BYTES = 64 * 1024 * 1024 # Read at most this much of the source at once
+PARTIAL_SUFFIX = ".part" # Added to the name while the preview is being written
+VGI_DATATYPES = { # bitdepth -> (vgi datatype, datarange)
+    8: ("unsigned integer", "0 255"),
+    16: ("unsigned integer", "0 65535"),
+    32: ("float", None),
+}
+
+def preview_name(volume, factor):
+    """
+        :param Path volume: The full resolution volume
+        :param int factor: How much the preview is binned by
+        :return string: The name of the preview volume
+    """
+    return "{}_bin{}.vol".format(volume.stem, factor)
+
+class PreviewVolumeWriter():
+    """
+        Writes binned copies of a volume, with .vgi headers, into a folder
+    """
+
+    def __init__(self, destination, factors=None, log_level=logging.WARNING):
+        """
+            :param Path destination: The folder to write the previews to
+            :param List factors: The binning factors (int) wanted, each must be a multiple
+                of the previous one (default: PREVIEW_FACTORS)
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Preview volume writer")
+        self._logger.setLevel(log_level)
+        self._log_level = log_level
+        self._destination = destination
+        self._factors = sorted(factors or PREVIEW_FACTORS)
+        previous = 1
+        for factor in self._factors:
+            if factor < 2 or factor % previous:
+                raise ValueError("Unable to bin by {} after {}".format(factor, previous))
+            previous = factor
+
+    def write(self, volume, pixels_x=None, pixels_y=None, pixels_z=None, bitdepth=None):
+        """
+            Write any previews that are missing or older than the volume.
+            Anything not specified is read from the .vgi file alongside the volume.
+            :param Path volume: The full resolution volume
+            :param int pixels_x: Width of the volume
+            :param int pixels_y: Height of the volume
+            :param int pixels_z: Number of slices in the volume
+            :param int bitdepth: Bits per voxel (8, 16 or 32)
+            :return List: (factor, Path) for each preview
+        """
+        source = VolumeReader(
+            volume, pixels_x, pixels_y, pixels_z, bitdepth, log_level=self._log_level)
+        if not source.is_complete():
+            raise ValueError("volume not yet complete")
+        self._destination.mkdir(exist_ok=True)
+        modified = volume.stat().st_mtime
+        previews = []
+        previous = 1
+        for factor in self._factors:
+            fname = Path(self._destination, preview_name(volume, factor))
+            if self._is_current(fname, modified):
+                self._logger.debug("%s is up to date", fname)
+            else:
+                self._bin(source, factor // previous, fname)
+            previews.append((factor, fname))
+            source = VolumeReader(fname, log_level=self._log_level)
+            previous = factor
+        return previews
+
+    @staticmethod
+    def _is_current(fname, modified):
+        """
+            :param Path fname: The preview volume
+            :param float modified: When the full resolution volume was last modified
+            :return boolean: True if the preview was completely written since then
+        """
+        vgi_file = vgi_from_vol(fname)
+        if not (fname.exists() and vgi_file.exists()):
+            return False
+        return vgi_file.stat().st_mtime >= modified
+
+    def _bin(self, source, step, fname):
+        """
+            Write a copy of the source block averaged by step in every direction
+            :param VolumeReader source: The volume to bin
+            :param int step: The size of the blocks
+            :param Path fname: The volume to write, the .vgi is written once it is complete
+        """
+        size = [source.size(axis) // step for axis in (AXIS_X, AXIS_Y, AXIS_Z)]
+        if 0 in size:
+            raise ValueError("{} is too small to bin by {}".format(source.filename, step))
+        self._logger.info(
+            "Binning %s by %d to %dx%dx%d", source.filename, step, size[0], size[1], size[2])
+        slices = max(1, PREVIEW_CHUNK_BYTES // (source.bytes_per_slice * step)) * step
+        stop = size[2] * step
+        partial = Path(fname.parent, fname.name + PARTIAL_SUFFIX)
+        try:
+            with open(partial, "wb") as fhandle:
+                for start in range(0, stop, slices):
+                    block_average(
+                        source.xy_slab(start, min(start + slices, stop)), step).tofile(fhandle)
+            os.replace(partial, fname)
+        finally:
+            if partial.exists():
+                partial.unlink()
+        write_vgi(vgi_from_vol(fname), fname.name, size, source.bitdepth)
+
+def block_average(chunk, step):
+    """
+        Average each step x step x step block of voxels
+        :param numpy.ndarray chunk: Slices of a volume (z, y, x)
+        :param int step: The size of the blocks
+        :return numpy.ndarray: The averages, the same type as the chunk
+    """
+    (depth, height, width) = (dim // step for dim in chunk.shape)
+    blocks = chunk[:depth * step, :height * step, :width * step].reshape(
+        depth, step, height, step, width, step)
+    mean = blocks.mean(axis=(1, 3, 5), dtype=numpy.float32)
+    if numpy.issubdtype(chunk.dtype, numpy.integer):
+        numpy.rint(mean, out=mean)
+    return mean.astype(chunk.dtype)
+
+def write_vgi(fname, name, size, bitdepth):
+    """
+        Write the header describing a volume
+        :param Path fname: Where to write it
+        :param string name: The name of the volume file
+        :param List size: x, y and z size in voxels
+        :param int bitdepth: Bits per voxel
+    """
+    (datatype, datarange) = VGI_DATATYPES[bitdepth]
+    size = "{} {} {}".format(*size)
+    datarange = ["datarange = {}".format(datarange)] if datarange else []
+    lines = [
+        "{volume1}",
+        "[representation]",
+        "size = {}".format(size),
+        "datatype = {}".format(datatype)] + datarange + [
+        "bitsperelement = {}".format(bitdepth),
+        "[file1]",
+        "SkipHeader = 0",
+        "FileFormat = raw",
+        "Size = {}".format(size),
+        "Name = {}".format(name),
+        "Datatype = {}".format(datatype)] + datarange + [
+        "BitsPerElement = {}".format(bitdepth)]
+    with open(fname, "w") as fhandle:
+        fhandle.write("\n".join(lines) + "\n")
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Write binned preview copies of a reconstructed volume")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-f",
+        "--factor",
+        action="append",
+        type=int,
+        help="Bin by this factor, may be given more than once (default: {})".format(
+            " ".join(str(factor) for factor in PREVIEW_FACTORS)))
+    PARSER.add_argument(
+        "volume",
+        action="store",
+        help="The volume (.vol) with its .vgi alongside")
+    PARSER.add_argument(
+        "destination",
+        action="store",
+        help="The folder to write the previews to")
+    ARGS = PARSER.parse_args()
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    try:
+        WRITER = PreviewVolumeWriter(Path(ARGS.destination), ARGS.factor, LOG_LEVEL)
+    except ValueError as ERR:
+        PARSER.error(str(ERR))
+    for (FACTOR, PREVIEW) in WRITER.write(Path(ARGS.volume)):
+        print("{}x: {}".format(FACTOR, PREVIEW))
+    exit(0)
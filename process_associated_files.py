@@ -0,0 +1,91 @@
+#!/opt/xrhms-venv/xrhms-env/bin/python
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Store the attachments, projections and videos queued by update_database.py
+    --defer-associated-files.  Several copies can be run at once.
+"""
+
+import logging
+from argparse import ArgumentParser
+from sys import stdout, exit
+from dataset_processor import DatasetProcessor
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Process the queue of files associated with scans")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of tasks to run at the same time (default: %(default)s)")
+    PARSER.add_argument(
+        "-c",
+        "--count",
+        type=int,
+        default=None,
+        help="How many tasks each worker should run",
+        action="store")
+    PARSER.add_argument(
+        "-t",
+        "--time-limit",
+        type=int,
+        default=None,
+        help="Don't start any new tasks after this many seconds",
+        action="store")
+    ARGS = PARSER.parse_args()
+    if ARGS.workers < 1:
+        PARSER.error("--workers must be at least 1")
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    FORMATTER = logging.Formatter(
+        '%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    CONSOLE_HANDLER = logging.StreamHandler(stdout)
+    CONSOLE_HANDLER.setLevel(LOG_LEVEL)
+    CONSOLE_HANDLER.setFormatter(FORMATTER)
+    HANDLERS = [CONSOLE_HANDLER]
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        handlers=HANDLERS)
+    logging.getLogger('sh.stream_bufferer').setLevel(logging.WARN)
+    logging.getLogger('sh.command.process.streamreader').setLevel(logging.WARN)
+    logging.getLogger('sh.command').setLevel(logging.WARN)
+    logging.getLogger('sh.streamreader').setLevel(logging.WARN)
+    PROCESSOR = DatasetProcessor(LOG_LEVEL)
+    if not PROCESSOR.process_associated_queue(ARGS.workers, ARGS.count, ARGS.time_limit):
+        exit(1)
+    COUNT = PROCESSOR.count_failed_tasks()
+    if COUNT > 0:
+        print(f"ERROR: {COUNT} associated file tasks have failed")
+        exit(2)
+    exit(0)
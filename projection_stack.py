@@ -0,0 +1,184 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Look at every projection of a CT scan once to spot beam drift, sample movement and
+    lost frames.
+
+    The projections are decoded in parallel worker processes. Each worker returns only
+    the mean, standard deviation and intensity-weighted centroid of its projection,
+    plus a small tile if the projection is on the contact sheet. Memory use therefore
+    doesn't grow with the size or number of projections.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil, sqrt
+
+import numpy
+import pyvips
+
+SERIES = ["mean", "std", "centroid_x", "centroid_y"]
+DEFAULT_WORKERS = 4
+SHEET_TILES = 100 # Most projections shown on the contact sheet
+TILE_SIZE = 128 # Longest side of each projection on the contact sheet (pixels)
+SHEET_PERCENTILES = (0.5, 99.5) # Shown as black and white on the contact sheet
+JOB_CHUNKSIZE = 8 # Projections sent to a worker at once
+
+def find_stack(candidates):
+    """
+        Check which projections exist and fingerprint them, so the statistics are only
+        worked out again when the projections change
+        :param List candidates: The projection files (Path) in the order they were taken
+        :return (List, string): The projections (None for any that are missing) and a hash
+            of their names, sizes and modification times
+    """
+    projections = []
+    digest = hashlib.sha256()
+    for proj in candidates:
+        try:
+            stat = os.stat(proj)
+        except FileNotFoundError:
+            projections.append(None)
+            digest.update(b"-\n")
+            continue
+        projections.append(proj)
+        digest.update("{}:{}:{}\n".format(proj.name, stat.st_size, stat.st_mtime_ns).encode())
+    return (projections, digest.hexdigest())
+
+class ProjectionStackAnalyser():
+    """
+        Works out the time series of each projection's statistics and draws the contact sheet
+    """
+
+    def __init__(
+            self, workers=DEFAULT_WORKERS, sheet_tiles=SHEET_TILES, tile_size=TILE_SIZE,
+            log_level=logging.WARNING):
+        """
+            :param int workers: The number of processes to decode the projections with
+            :param int sheet_tiles: The most projections to show on the contact sheet
+            :param int tile_size: The longest side of each projection on the contact sheet
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Projection stack analyser")
+        self._logger.setLevel(log_level)
+        self._workers = workers
+        self._sheet_tiles = sheet_tiles
+        self._tile_size = tile_size
+
+    def analyse(self, projections, sheet_file=None):
+        """
+            Read every projection once
+            :param List projections: The projection files (Path) in the order they were
+                taken, None for any that are missing
+            :param Path sheet_file: Where to write the contact sheet (default: don't)
+            :return dict: Each of SERIES (numpy.ndarray of float32, NaN where a projection
+                couldn't be read) and missing (the indices that couldn't be read)
+        """
+        count = len(projections)
+        on_sheet = set()
+        if sheet_file is not None and count:
+            on_sheet = set(
+                numpy.linspace(0, count - 1, min(count, self._sheet_tiles)).astype(int).tolist())
+        jobs = [
+            (None if proj is None else str(proj), self._tile_size if index in on_sheet else None)
+            for (index, proj) in enumerate(projections)]
+        result = {name: numpy.full(count, numpy.nan, dtype=numpy.float32) for name in SERIES}
+        missing = []
+        tiles = []
+        self._logger.info("Reading %d projections with %d workers", count, self._workers)
+        # Spawned rather than forked so they don't share the caller's DB connection
+        with ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            outputs = executor.map(_analyse_projection, jobs, chunksize=JOB_CHUNKSIZE)
+            for (index, output) in enumerate(outputs):
+                if output is None:
+                    missing.append(index)
+                    continue
+                (values, tile) = output
+                for (name, value) in zip(SERIES, values):
+                    result[name][index] = value
+                if tile is not None:
+                    tiles.append(tile)
+        if missing:
+            self._logger.warning("%d of %d projections couldn't be read", len(missing), count)
+        result["missing"] = missing
+        if sheet_file is not None and tiles:
+            self._write_sheet(tiles, sheet_file)
+        return result
+
+    def _write_sheet(self, tiles, sheet_file):
+        """
+            Lay the tiles out in a grid, windowed to the range of values on the sheet
+            :param List tiles: The tiles (numpy.ndarray of float32)
+            :param Path sheet_file: Where to write the contact sheet
+        """
+        columns = ceil(sqrt(len(tiles)))
+        rows = ceil(len(tiles) / columns)
+        height = max(tile.shape[0] for tile in tiles)
+        width = max(tile.shape[1] for tile in tiles)
+        values = numpy.concatenate([tile.ravel() for tile in tiles])
+        (low, high) = numpy.percentile(values, SHEET_PERCENTILES)
+        scale = 255 / (high - low) if high > low else 0
+        sheet = numpy.zeros((rows * height, columns * width), dtype=numpy.uint8)
+        for (index, tile) in enumerate(tiles):
+            (row, column) = divmod(index, columns)
+            scaled = numpy.clip((tile - low) * scale, 0, 255).astype(numpy.uint8)
+            sheet[
+                row * height:row * height + tile.shape[0],
+                column * width:column * width + tile.shape[1]] = scaled
+        self._logger.debug("Writing %dx%d contact sheet to %s", columns, rows, sheet_file)
+        pyvips.Image.new_from_memory(
+            sheet.data, sheet.shape[1], sheet.shape[0], 1, "uchar").write_to_file(str(sheet_file))
+
+def _analyse_projection(job):
+    """
+        Work out the statistics of a single projection, run in a worker process
+        :param tuple job: The projection (None if missing) and the tile size (None if not
+            on the contact sheet)
+        :return ((float, float, float, float), numpy.ndarray): mean, standard deviation and
+            centroid x and y, and the tile. None if the projection couldn't be read
+    """
+    (filename, tile_size) = job
+    if filename is None:
+        return None
+    try:
+        image = pyvips.Image.new_from_file(filename)
+        if image.bands > 1:
+            image = image.colourspace("b-w")[0]
+        image = image.cast("double")
+        (columns, rows) = image.project()
+        column_sums = numpy.frombuffer(columns.write_to_memory(), dtype=numpy.float64)
+        row_sums = numpy.frombuffer(rows.write_to_memory(), dtype=numpy.float64)
+        total = column_sums.sum()
+        if total:
+            centroid_x = float((column_sums * numpy.arange(column_sums.size)).sum() / total)
+            centroid_y = float((row_sums * numpy.arange(row_sums.size)).sum() / total)
+        else:
+            (centroid_x, centroid_y) = (numpy.nan, numpy.nan)
+        values = (image.avg(), image.deviate(), centroid_x, centroid_y)
+        tile = None
+        if tile_size is not None:
+            small = image.thumbnail_image(tile_size).cast("float")
+            tile = numpy.frombuffer(small.write_to_memory(), dtype=numpy.float32).reshape(
+                small.height, small.width)
+        return (values, tile)
+    except pyvips.Error as err:
+        logging.getLogger("Projection stack analyser").debug(err)
+        return None
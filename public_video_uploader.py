@@ -30,19 +30,20 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xrhms.settings")
 django.setup()
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 
-from django_mysql.locks import Lock
 from xrhms.settings import BASE_DIR
 from scans.models import ScanAttachment
 
-from drive_uploader import DriveUploader
+from drive_uploader import DriveUploader, LocalDriveUploader
+from upload_pipeline import (
+    DEFAULT_ENCODE_WORKERS, DEFAULT_RETRIES, DEFAULT_UPLOAD_WORKERS, UploadPipeline,
+    lease_owner, overlay_corner, perfdata, release_lease, renew_lease,
+    take_lease)
 
 from xrh_utils import publically_uploadable_video_type
 import xrh_utils
 
-LOCK_NAME = "Video Upload"
-LOCK_TIMEOUT = 300
-
 DEFAULT_OVERLAY_IMAGE = Path(BASE_DIR, "static", "XRH_Logo_v1_GraphicsOnly.png")
 
 class VideoUploader():
@@ -50,13 +51,15 @@ class VideoUploader():
         Manage the task of uploading videos into the google drive
     """
 
-    def __init__(self):
+    def __init__(self, drive=None):
         """
             Basic initialisation
+            :param DriveUploader drive: Where to upload to (default: google drive)
         """
         self._logger = logging.getLogger("Video Uploader")
-        self._gdrive = DriveUploader()
+        self._gdrive = drive if drive is not None else DriveUploader()
         self._gdrive.authenticate() # Set up the drive object
+        self._owner = lease_owner()
 
     def find_scan_attachment(self, attachment_id):
         """
@@ -73,40 +76,70 @@ class VideoUploader():
     def process_all_scan_attachments(self):
         """
             Look for all records that have the to_upload flag set an no URL set
+            :return (int, int): (uploaded, attempted), records leased by another run
+                aren't counted
         """
         self._logger.debug("Going to iterate through all scan attachments that need uploading")
-        records = ScanAttachment.objects.filter(url__isnull=True, to_upload=True)
+        records = ScanAttachment.objects.filter(url__isnull=True, to_upload=True).exclude(
+            upload_lease_expires__gt=timezone.now()) # Being uploaded by another run
         self._logger.info("Records to upload: %d", len(records))
         success = 0
-        with Lock(LOCK_NAME, acquire_timeout=LOCK_TIMEOUT):
-            for record in records:
-                self._logger.debug(record)
+        skipped = 0
+        for record in records:
+            self._logger.debug(record)
+            try:
                 try:
-                    if record.url:
-                        #User has uploaded it since starting the script
-                        #This reduces the possibility of a race condition but it's still there
-                        #TODO this needs more thought
-                        self._logger.warning("Somebody is messing with the URLs")
-                        continue
-                    try:
-                        if self.upload_scan_attachment(record):
-                            success += 1
-                    except (ValueError, FileNotFoundError) as err:
-                        self._logger.error("Invalid value passed into uploader")
-                        self._logger.warning(err)
-                        record.to_upload = False # Disable upload flag to stop attempting it again
-                        record.save()
-                except Exception as exp:
-                    self._logger.error(exp)
-                    raise
-            return (success, len(records))
-
-    def upload_scan_attachment(self, attachment, overlay_image=DEFAULT_OVERLAY_IMAGE):
+                    if self.upload_scan_attachment(record, disable_invalid=True):
+                        success += 1
+                    elif record.url is None:
+                        skipped += 1
+                except (ValueError, FileNotFoundError) as err:
+                    self._logger.error("Invalid value passed into uploader")
+                    self._logger.warning(err)
+            except Exception as exp:
+                self._logger.error(exp)
+                raise
+        return (success, len(records) - skipped)
+
+    def upload_scan_attachment(
+            self, attachment, overlay_image=DEFAULT_OVERLAY_IMAGE, disable_invalid=False):
         """
-            Upload the passed in record to YouTube
+            Upload the passed in record to YouTube.  It is leased while uploading, in the
+            same way as UploadPipeline, so it isn't uploaded by two runs at once.
             :param ScanAttachment attachment: The thing to upload
             :param Path overlay_image: The image to use to apply the watermark
+            :param boolean disable_invalid: Clear to_upload if it isn't a video that can be
+                uploaded, to stop attempting it again
+            :return string: The URL, None if it was already uploaded or leased by another run
     """
+        if not take_lease(attachment.pk, self._owner):
+            self._logger.warning("%d is already uploaded or being uploaded", attachment.pk)
+            return None
+        try:
+            url = self._upload(attachment, overlay_image)
+        except (ValueError, FileNotFoundError):
+            if disable_invalid:
+                release_lease(attachment.pk, self._owner, to_upload=False)
+            else:
+                release_lease(attachment.pk, self._owner)
+            raise
+        except Exception:
+            release_lease(attachment.pk, self._owner)
+            raise
+        if not release_lease(attachment.pk, self._owner, url=url):
+            # Another run took over, it may have uploaded it as well
+            self._logger.error("Lost the lease on %d, not storing %s", attachment.pk, url)
+            return None
+        attachment.url = url
+        return url
+
+    def _upload(self, attachment, overlay_image):
+        """
+            Watermark and upload a leased attachment
+            :param ScanAttachment attachment: The thing to upload
+            :param Path overlay_image: The image to use to apply the watermark
+            :return string: The URL
+        """
         temp_dir = None # need to be able to keep this in scope for entirity of function
         filename = Path(attachment.attachment.path)
         if not filename.exists():
@@ -114,26 +147,18 @@ class VideoUploader():
             raise FileNotFoundError()
         if not publically_uploadable_video_type(filename):
             raise ValueError("Not a video file")
-        if attachment.overlay_position != ScanAttachment.NONE:
+        corner = overlay_corner(attachment)
+        if corner is not None:
             self._logger.debug("Need to apply overlay to video")
-            top = True
-            left = True
-            if(
-                    attachment.overlay_position == ScanAttachment.BOTTOM_LEFT or
-                    attachment.overlay_position == ScanAttachment.BOTTOM_RIGHT):
-                top = False
-            if(
-                    attachment.overlay_position == ScanAttachment.TOP_RIGHT or
-                    attachment.overlay_position == ScanAttachment.BOTTOM_RIGHT):
-                left = False
-            (temp_dir, output_name) = xrh_utils.apply_overlay(filename, overlay_image, top, left)
+            (top, left) = corner
+            (temp_dir, output_name) = xrh_utils.apply_overlay(
+                filename, overlay_image, top, left, info=attachment.video_info())
             filename = Path(temp_dir.name, output_name)
+            if not renew_lease(attachment.pk, self._owner):
+                self._logger.warning("Lease on %d has been taken by another run", attachment.pk)
         title = attachment.name
         self._logger.debug("Using title: %s", title)
-        url = self._gdrive.upload(title, filename)
-        attachment.url = url
-        attachment.save()
-        return url
+        return self._gdrive.upload(title, filename)
 
 if __name__ == '__main__':
     PARSER = ArgumentParser(
@@ -169,6 +194,34 @@ if __name__ == '__main__':
         action="store",
         type=int,
         help="The ID number of the record to upload")
+    PARSER.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="With --all, watermark and upload several videos at once")
+    PARSER.add_argument(
+        "--encode-workers",
+        action="store",
+        type=int,
+        default=DEFAULT_ENCODE_WORKERS,
+        help="Videos to watermark at once with --pipeline (default: {})".format(
+            DEFAULT_ENCODE_WORKERS))
+    PARSER.add_argument(
+        "--upload-workers",
+        action="store",
+        type=int,
+        default=DEFAULT_UPLOAD_WORKERS,
+        help="Videos to upload at once with --pipeline (default: {})".format(
+            DEFAULT_UPLOAD_WORKERS))
+    PARSER.add_argument(
+        "--retries",
+        action="store",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Times to retry each video with --pipeline (default: {})".format(DEFAULT_RETRIES))
+    PARSER.add_argument(
+        "--local-drive",
+        action="store",
+        help="Copy the videos into this directory instead of uploading them (for testing)")
     ARGS = PARSER.parse_args()
     LOG_LEVEL = logging.WARNING
     if ARGS.quiet:
@@ -193,21 +246,47 @@ if __name__ == '__main__':
 
     if not (ARGS.id or ARGS.all):
         PARSER.error("Must specify either an ID or all")
-    UPLOADER = VideoUploader()
+    if ARGS.pipeline and not ARGS.all:
+        PARSER.error("--pipeline needs --all")
+
+    def make_drive():
+        """
+            :return DriveUploader: An authenticated uploader
+        """
+        if ARGS.local_drive:
+            drive = LocalDriveUploader(Path(ARGS.local_drive))
+        else:
+            drive = DriveUploader()
+        drive.authenticate()
+        return drive
+
+    if ARGS.all and ARGS.scan and ARGS.pipeline:
+        PIPELINE = UploadPipeline(
+            make_drive, DEFAULT_OVERLAY_IMAGE, ARGS.encode_workers, ARGS.upload_workers,
+            ARGS.retries, log_level=LOG_LEVEL)
+        METRICS = PIPELINE.run()
+        (SUCCESS, TOTAL) = (METRICS["uploaded"], METRICS["queued"] - METRICS["skipped"])
+        PERFDATA = " | " + perfdata(METRICS)
+    else:
+        UPLOADER = VideoUploader(make_drive() if ARGS.local_drive else None)
+        PERFDATA = ""
     if ARGS.all:
         if ARGS.scan:
-            (SUCCESS, TOTAL) = UPLOADER.process_all_scan_attachments()
+            if not ARGS.pipeline:
+                (SUCCESS, TOTAL) = UPLOADER.process_all_scan_attachments()
             if SUCCESS == TOTAL:
-                print("OK: Uploaded {} videos".format(TOTAL))
+                print("OK: Uploaded {} videos{}".format(TOTAL, PERFDATA))
                 sys.exit(0)
             elif TOTAL < 0:
                 print("CRITICAL: Unable to run")
                 sys.exit(2)
             elif SUCCESS == 0 and TOTAL != 0:
-                print("CRITICAL: Unable to upload ANY reports {} attempted".format(TOTAL))
+                print("CRITICAL: Unable to upload ANY reports {} attempted{}".format(
+                    TOTAL, PERFDATA))
                 sys.exit(2)
             elif SUCCESS < TOTAL:
-                print("WARNING: Uploaded {}/{} ({})%".format(SUCCESS, TOTAL, int(SUCCESS/TOTAL)))
+                print("WARNING: Uploaded {}/{} ({})%{}".format(
+                    SUCCESS, TOTAL, int(SUCCESS/TOTAL), PERFDATA))
                 sys.exit(1)
         else:
             raise NotImplementedError("Don't know how to upload all entries of that type")
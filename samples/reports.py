@@ -31,7 +31,7 @@ from weasyprint import HTML
 
 from samples.models import SampleAttachmentType, SampleReport
 from scans.models import ScanAttachmentType
-from xrh_utils import video2thumbnail, compress_pdf
+from xrh_utils import compress_pdf
 from xrhms.settings import BASE_DIR
 IMG_WIDTH = "12cm"
 IMG_WIDTH_2 = "8cm"
@@ -322,8 +322,7 @@ def generate_report(report, force=False, debug=False):
             if video_details["url"]:
                 #Thumbnail generation is expensive only do it if also have a URL
                 try:
-                    thumbnail = video2thumbnail(
-                        Path(attachment.attachment.path), Path(temp_dir.name))
+                    thumbnail = attachment.thumbnail()
                     video_details["thumb"] = "file://{}".format(thumbnail)
                     if appendix:
                         appendix_videos.append(video_details)
@@ -0,0 +1,102 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    In memory index of the scan records used during an ingest run so that looking up
+    each dataset doesn't need its own queries
+"""
+import logging
+import threading
+
+from scans.models import Scan
+
+class ScanIndex():
+    """
+        Lookup scans by location or primary key.
+        All the scans on a share are loaded the first time the share is used.
+        Safe to share between worker threads.
+        The scans aren't reloaded so may be out of date by the time they are used, refresh
+        them before saving anything other than specific fields.
+    """
+
+    def __init__(self, log_level=logging.WARNING):
+        """
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Scan index")
+        self._logger.setLevel(log_level)
+        self._lock = threading.RLock()
+        self._loaded_shares = set()
+        self._by_location = {} # (share_id, path, filename) -> Scan
+        self._by_pk = {} # pk -> Scan
+        self._locations = {} # pk -> (share_id, path, filename)
+
+    def load_share(self, share):
+        """
+            Load all of the scans on the share into the index if not already done
+            :param Share share: The share to load
+        """
+        with self._lock:
+            if share.pk in self._loaded_shares:
+                return
+            count = 0
+            for scan in Scan.objects.filter(share=share):
+                scan.share = share # already have the share so don't look it up for every scan
+                self.add(scan)
+                count += 1
+            self._loaded_shares.add(share.pk)
+            self._logger.info("Loaded %d scans for share %s", count, share)
+
+    def add(self, scan):
+        """
+            Add a scan to the index, or update it if its location has changed
+            :param Scan scan: The scan to add, must have been saved
+        """
+        location = (scan.share_id, scan.path, scan.filename)
+        with self._lock:
+            old_location = self._locations.get(scan.pk)
+            if old_location and old_location != location:
+                self._by_location.pop(old_location, None)
+            self._by_location[location] = scan
+            self._by_pk[scan.pk] = scan
+            self._locations[scan.pk] = location
+
+    def get(self, share, path, filename):
+        """
+            Find the scan at the specified location
+            :param Share share: The share the scan is on
+            :param string path: The path on the share
+            :param string filename: The name of the dataset file
+            :return Scan: The scan or None if there isn't one
+        """
+        self.load_share(share)
+        with self._lock:
+            return self._by_location.get((share.pk, path, filename))
+
+    def get_pk(self, pk): #pylint: disable=invalid-name
+        """
+            Find the scan with the specified primary key.
+            Scans not on a loaded share are fetched from the database and added.
+            :param int pk: The primary key of the scan
+            :return Scan
+            :raises ObjectDoesNotExist: If there is no such scan
+        """
+        with self._lock:
+            scan = self._by_pk.get(pk)
+        if scan is None:
+            scan = Scan.objects.get(pk=pk)
+            self.add(scan)
+        return scan
@@ -16,6 +16,7 @@
     See the License for the specific language governing permissions and
     limitations under the License.
 """
+import ffmpeg
 from django.contrib import admin, messages
 from django.utils.html import mark_safe
 from django.shortcuts import render
@@ -32,6 +33,7 @@ from samples.models import ReportScanMapping
 from labels.utils import print_drive_label
 from .models import (
     ArchiveDrive,
+    AssociatedFileTask,
     Gain,
     Machine,
     NikonCTScan,
@@ -60,14 +62,36 @@ from .views import scan_comparison_csv, transfer_time_table
 
 
 from .models.dataset_status import DATASET_MISSING, DATASET_DELETED
+from .models.associated_file_task import TASK_FAILED, TASK_QUEUED
+from .models.user_copy import PREVIEW_FACTOR_CHOICES
 # Register your models here.
 
 from .reports import generate_basic_report_tasks
+from .tiles import pyramid_urls
 
 
 PREVIEW_WIDTH = 400
 PREVIEW_HEIGHT = 400
 
+def tiled_img(instance, field, url, img_url):
+    """
+        Show an image linking to its full size version. Images with a tile pyramid show a
+        single small tile instead and link to the tile viewer.
+        :param Model instance: The instance showing the image
+        :param string field: The field shown
+        :param string url: The full size image
+        :param string img_url: The image to show
+    """
+    urls = pyramid_urls(instance, field)
+    if urls is not None:
+        (url, img_url) = urls
+    return mark_safe(
+        '<a href="{}" target="_new"><img src="{}" style="max-width:{}px; max-height:{}px;"/></a>'.format( #pylint:disable=line-too-long
+            url,
+            img_url,
+            PREVIEW_WIDTH,
+            PREVIEW_HEIGHT))
+
 @admin.register(Gain)
 class GainAdmin(admin.ModelAdmin):
     list_display = ["scanner", "gain_type", "index", "value"]
@@ -438,21 +462,19 @@ class NikonCTScanAdmin(PolymorphicChildModelAdmin):
     xyslice_img.short_description = "XY Slice"
 
     def projection0deg_img(self, instance):
-        return mark_safe(
-            '<a href="{}" target="_new"><img src="{}" style="max-width:{}px; max-height:{}px;"/></a>'.format( #pylint:disable=line-too-long
-                instance.projection0deg.url,
-                instance.projection0deg_png.url,
-                PREVIEW_WIDTH,
-                PREVIEW_HEIGHT))
+        return tiled_img(
+            instance,
+            "projection0deg",
+            instance.projection0deg.url,
+            instance.projection0deg_png.url)
     projection0deg_img.short_description = "0 degrees projection"
 
     def projection90deg_img(self, instance):
-        return mark_safe(
-            '<a href="{}" target="_new"><img src="{}" style="max-width:{}px; max-height:{}px;"/></a>'.format( #pylint:disable=line-too-long
-                instance.projection90deg.url,
-                instance.projection90deg_png.url,
-                PREVIEW_WIDTH,
-                PREVIEW_HEIGHT))
+        return tiled_img(
+            instance,
+            "projection90deg",
+            instance.projection90deg.url,
+            instance.projection90deg_png.url)
     projection90deg_img.short_description = "90 degrees projection"
 
     def response_change(self, request, obj):
@@ -490,6 +512,14 @@ class ScanAttachmentAdmin(admin.ModelAdmin):
 
         return always
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if "attachment" in form.changed_data and obj.is_video():
+            try:
+                obj.update_video_info()
+            except (ffmpeg.Error, ValueError) as err:
+                messages.warning(request, "Unable to read the video details: {}".format(err))
+
     def has_change_permission(self, request, obj=None):
         if obj:
             return obj.editable
@@ -568,6 +598,8 @@ class ScanAdmin(PolymorphicParentModelAdmin):
                 copy_obj.username = username
                 copy_obj.include_recon_data = bool(request.POST.get("reconstructed_data"))
                 copy_obj.include_raw_data = bool(request.POST.get("raw_data"))
+                if request.POST.get("preview_factor"):
+                    copy_obj.preview_factor = int(request.POST.get("preview_factor"))
                 copy_obj.save()
             messages.success(request, "Copy added for {} datasets".format(queryset.count()))
             return HttpResponseRedirect(request.get_full_path())
@@ -582,6 +614,7 @@ class ScanAdmin(PolymorphicParentModelAdmin):
         context["has_permission"] = True
         context["site_header"] = self.admin_site.site_header
         context["scans"] = queryset
+        context["preview_factors"] = PREVIEW_FACTOR_CHOICES
         return render(request,
             "admin/scans/copy_to_user.html",
             context=context)
@@ -770,11 +803,7 @@ class OmeDataAdmin(PolymorphicChildModelAdmin):
     ]
 
     def overview_img(self, instance):
-        return mark_safe(
-            '<a href="{}" target="_new"><img src="{}" style="max-width:{}px; max-height:{}px;"/></a>'.format( #pylint: disable=line-too-long
-            instance.overview.url,
-            instance.overview.url,
-            PREVIEW_WIDTH, PREVIEW_HEIGHT))
+        return tiled_img(instance, "overview", instance.overview.url, instance.overview.url)
     overview_img.short_description = "Overview"
 
 
@@ -814,6 +843,34 @@ class ScheduledMoveAdmin(admin.ModelAdmin):
         return False # it's already run
 
 
+@admin.register(AssociatedFileTask)
+class AssociatedFileTaskAdmin(admin.ModelAdmin):
+    list_display = [
+        "pk", "scan_link", "task", "priority", "status", "attempts", "date_queued",
+        "date_started", "date_completed", "worker"
+    ]
+    ordering = ["status", "priority", "date_queued"]
+    fields = [
+        "scan_link", "task", "priority", "status", "attempts", "max_attempts",
+        "date_queued", "next_attempt", "date_started", "date_completed", "worker", "output"
+    ]
+    readonly_fields = fields
+    list_filter = ["status", "task"]
+    actions = ["retry"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def retry(self, request, queryset):
+        count = queryset.filter(status=TASK_FAILED).update(
+            status=TASK_QUEUED, attempts=0, next_attempt=None)
+        messages.success(request, "Queued {} failed tasks to run again".format(count))
+    retry.short_description = "Retry selected failed tasks"
+
+
 @admin.register(ArchiveDrive)
 class ArchiveDriveAdmin(admin.ModelAdmin):
     list_display = [
@@ -972,12 +1029,7 @@ class OmePlaneInline(admin.StackedInline):
     def preview_img(self, instance):
         if not instance.preview:
             return "-"
-        return mark_safe(
-            '<a href="{}" target="_new"><img src="{}" style="max-width:{}px; max-height:{}px;"/></a>'.format( #pylint: disable=line-too-long
-                instance.preview.url,
-                instance.preview.url,
-                PREVIEW_WIDTH,
-                PREVIEW_HEIGHT))
+        return tiled_img(instance, "preview", instance.preview.url, instance.preview.url)
     preview_img.short_description = "Preview"
 
     def channel_name(self, instance):
@@ -1082,7 +1134,7 @@ class UserCopyAdmin(admin.ModelAdmin):
     fields = [
         "scan", "username",
         "date_added",
-        ("include_raw_data", "include_recon_data"),
+        ("include_raw_data", "include_recon_data", "preview_factor"),
         ("date_copied", "copy_success"),
         ("deletion_after", "deletion_valid_from"),
         ("date_deleted", "deletion_success"),
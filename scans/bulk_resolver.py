@@ -0,0 +1,112 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Find or create many records at once.  Those that already exist are found with one query
+    and the rest are inserted with bulk_create rather than a get() and save() for each.
+"""
+import logging
+from functools import partial, reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Q
+
+QUERY_BATCH = 200 # Identities to look up in a single query
+
+class BulkRecordResolver():
+    """
+        Resolve records of a model from the values of the fields that identify them.
+        Resolved records are cached so anything looked up again (eg. the detectors and
+        objectives used for every file from a microscope) doesn't need a query.
+    """
+
+    def __init__(self, model, fields, cache=True, log_level=logging.WARNING):
+        """
+            :param Model model: The model to resolve
+            :param List fields: The fields (use the attname, eg. detector_id, for foreign keys)
+                that together identify a record
+            :param boolean cache: Keep the records resolved for later calls
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Bulk resolver {}".format(model.__name__))
+        self._logger.setLevel(log_level)
+        self._model = model
+        self._fields = fields
+        self._converters = [model._meta.get_field(field).to_python for field in fields] #pylint: disable=protected-access
+        self._use_cache = cache
+        self._cache = {}
+
+    def key(self, values):
+        """
+            :param dict values: field -> value
+            :return tuple: The values converted to the field types so they compare equal to
+                those read from the DB
+        """
+        return tuple(
+            convert(values[field]) for (field, convert) in zip(self._fields, self._converters))
+
+    def _record_key(self, record):
+        return tuple(getattr(record, field) for field in self._fields)
+
+    def _find(self, keys):
+        """
+            Look up the records with the identities
+            :param List keys: The identities to find
+            :return dict: identity -> record for those found
+        """
+        found = {}
+        for start in range(0, len(keys), QUERY_BATCH):
+            query = reduce(or_, (
+                Q(**dict(zip(self._fields, key))) for key in keys[start:start + QUERY_BATCH]))
+            for record in self._model.objects.filter(query).order_by("pk"):
+                found.setdefault(self._record_key(record), record) # Oldest if duplicated
+        return found
+
+    def resolve(self, wanted):
+        """
+            Find the records, creating any that don't exist.
+            Should be called in a transaction so the records created are found again.
+            :param List wanted: dicts of field -> value identifying each record
+            :return List: The records in the same order as wanted
+        """
+        keys = [self.key(values) for values in wanted]
+        resolved = {key: self._cache[key] for key in keys if key in self._cache}
+        missing = list({key for key in keys if key not in resolved})
+        if missing:
+            resolved.update(self._find(missing))
+            to_create = [key for key in missing if key not in resolved]
+            if to_create:
+                self._logger.info("Creating %d records", len(to_create))
+                self._model.objects.bulk_create([
+                    self._model(**dict(zip(self._fields, key))) for key in to_create])
+                # MySQL doesn't return the primary keys of the records created
+                resolved.update(self._find(to_create))
+                if len(resolved) != len(set(keys)):
+                    self._logger.error("Unable to find the records created")
+                    raise ValueError("Unable to find the {} records created".format(
+                        self._model.__name__))
+            if self._use_cache:
+                # Records created in a transaction that's rolled back mustn't be remembered
+                new = {key: resolved[key] for key in missing}
+                transaction.on_commit(partial(self._cache.update, new))
+        return [resolved[key] for key in keys]
+
+    def clear(self):
+        """
+            Forget the cached records
+        """
+        self._cache = {}
@@ -0,0 +1,55 @@
+# Generated by Django 2.2.20 on 2026-10-17 10:05
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0142_scan_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssociatedFileTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(help_text='What to do, see the parser for the scan', max_length=30)),
+                ('priority', models.IntegerField(default=0, help_text='Tasks with lower numbers are done first')),
+                ('status', models.CharField(choices=[('QU', 'Queued'), ('RU', 'Running'), ('DO', 'Done'), ('FA', 'Failed')], db_index=True, default='QU', max_length=2)),
+                ('rerun', models.BooleanField(default=False, help_text='Queued again while it was running so run it again once finished')),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=3)),
+                ('date_queued', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('next_attempt', models.DateTimeField(blank=True, help_text="Don't run before this time", null=True)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_completed', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, help_text='The worker that last ran the task', max_length=100, null=True)),
+                ('output', models.TextField(blank=True, null=True)),
+                ('scan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='scans.Scan')),
+            ],
+            options={
+                'verbose_name': 'Associated file task',
+                'verbose_name_plural': 'Associated file tasks',
+                'unique_together': {('scan', 'task')},
+                'index_together': {('status', 'priority', 'next_attempt')},
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 2.2.20 on 2026-10-17 11:40
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0143_associatedfiletask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_min',
+            field=models.FloatField(blank=True, help_text='Smallest value in the reconstructed volume', null=True),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_max',
+            field=models.FloatField(blank=True, help_text='Largest value in the reconstructed volume', null=True),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_mean',
+            field=models.FloatField(blank=True, help_text='Mean value of the reconstructed volume', null=True),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_std',
+            field=models.FloatField(blank=True, help_text='Standard deviation of the values in the reconstructed volume', null=True, verbose_name='Volume standard deviation'),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_window_low',
+            field=models.FloatField(blank=True, help_text='Low percentile of the volume, shown as black in previews', null=True),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_window_high',
+            field=models.FloatField(blank=True, help_text='High percentile of the volume, shown as white in previews', null=True),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='volume_histogram',
+            field=models.TextField(blank=True, help_text='JSON list of counts in equal bins from volume_min to volume_max', null=True),
+        ),
+    ]
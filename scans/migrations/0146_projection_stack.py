@@ -0,0 +1,50 @@
+# Generated by Django 2.2.20 on 2026-10-17 13:10
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import migrations, models
+from scans.models import ScanAttachmentType
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0145_usercopy_preview_factor'),
+    ]
+    def insert_attachment_types(apps, schema_editor):
+        types = [
+            ("Projection contact sheet", "A sample of the projections laid out in a grid", -7),
+        ]
+
+        for i in types:
+            if ScanAttachmentType.objects.filter(name=i[0]).count() == 0:
+                t = ScanAttachmentType(name=i[0], description=i[1],  report_priority=i[2])
+                t.save()
+
+
+    operations = [
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='projection_stats',
+            field=models.BinaryField(blank=True, help_text='zlib compressed float32 mean, std, centroid x and centroid y of every projection, see projection_series', null=True),
+        ),
+        migrations.AddField(
+            model_name='nikonctscan',
+            name='missing_projections',
+            field=models.IntegerField(blank=True, help_text="How many projections couldn't be read when projection_stats was calculated", null=True),
+        ),
+        migrations.RunPython(insert_attachment_types),
+    ]
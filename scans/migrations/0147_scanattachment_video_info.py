@@ -0,0 +1,64 @@
+# Generated by Django 2.2.20 on 2026-10-17 15:40
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0146_projection_stack'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_codec',
+            field=models.CharField(blank=True, help_text='Codec of the video stream', max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_duration',
+            field=models.FloatField(blank=True, help_text='Length of the video (s)', null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_fingerprint',
+            field=models.CharField(blank=True, help_text='Fingerprint of the file when the video details were read', max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_frame_rate',
+            field=models.FloatField(blank=True, help_text='Frames per second', null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_frames',
+            field=models.IntegerField(blank=True, help_text='Number of frames in the video', null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_height',
+            field=models.IntegerField(blank=True, help_text='Height of the video (pixels)', null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='video_width',
+            field=models.IntegerField(blank=True, help_text='Width of the video (pixels)', null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.20 on 2026-10-17 16:55
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scans', '0147_scanattachment_video_info'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanattachment',
+            name='upload_lease_expires',
+            field=models.DateTimeField(blank=True, help_text='When another upload process may take over this attachment', null=True),
+        ),
+        migrations.AddField(
+            model_name='scanattachment',
+            name='upload_lease_owner',
+            field=models.CharField(blank=True, help_text='The upload process (host:pid) working on this attachment', max_length=255, null=True),
+        ),
+    ]
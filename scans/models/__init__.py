@@ -17,6 +17,7 @@
     limitations under the License.
 """
 from .archive_drive import ArchiveDrive, ScanArchive
+from .associated_file_task import AssociatedFileTask
 from .attachment import ScanAttachment, ScanAttachmentType, ScanAttachmentTypeSuffix
 from .gain import Gain
 from .machine import Machine
@@ -31,7 +32,7 @@ from .ome_image import OmeImage
 from .ome_objective import OmeObjective
 from .ome_plane import OmePlane
 from .refined_raw import RefinedRawExtension, RefinedRawData
-from .scan import Scan, generate_sidecar_filename, load_sidecar, SidecarStatus
+from .scan import Scan, generate_sidecar_filename, load_sidecar, read_sidecar, SidecarStatus
 from .scheduled_move import ScheduledMove
 from .scanner_screenshot import ScannerScreenshot
 from .server import Server
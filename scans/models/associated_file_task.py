@@ -0,0 +1,113 @@
+#pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring, no-self-use
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+from django.db import models
+from django.utils.html import mark_safe
+from django.urls import reverse
+
+TASK_QUEUED = "QU"
+TASK_RUNNING = "RU"
+TASK_DONE = "DO"
+TASK_FAILED = "FA"
+
+TASK_STATUS_CHOICES = [
+    (TASK_QUEUED, "Queued"),
+    (TASK_RUNNING, "Running"),
+    (TASK_DONE, "Done"),
+    (TASK_FAILED, "Failed"),
+]
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+class AssociatedFileTask(models.Model):
+    """
+        A piece of work storing the files associated with a scan (attachments, projections,
+        videos etc) that is done after the scan itself has been ingested.
+        See associated_file_queue.py
+    """
+    class Meta:
+        verbose_name = "Associated file task"
+        verbose_name_plural = "Associated file tasks"
+        unique_together = [("scan", "task")]
+        index_together = [("status", "priority", "next_attempt")]
+
+    scan = models.ForeignKey(
+        "Scan",
+        on_delete=models.CASCADE,
+        blank=False,
+        null=False)
+    task = models.CharField(
+        max_length=30,
+        blank=False,
+        null=False,
+        help_text="What to do, see the parser for the scan")
+    priority = models.IntegerField(
+        default=0,
+        blank=False,
+        null=False,
+        help_text="Tasks with lower numbers are done first")
+    status = models.CharField(
+        max_length=2,
+        choices=TASK_STATUS_CHOICES,
+        default=TASK_QUEUED,
+        db_index=True,
+        blank=False,
+        null=False)
+    rerun = models.BooleanField(
+        default=False,
+        blank=False,
+        null=False,
+        help_text="Queued again while it was running so run it again once finished")
+    attempts = models.IntegerField(
+        default=0,
+        blank=False,
+        null=False)
+    max_attempts = models.IntegerField(
+        default=DEFAULT_MAX_ATTEMPTS,
+        blank=False,
+        null=False)
+    date_queued = models.DateTimeField(
+        db_index=True,
+        auto_now_add=True)
+    next_attempt = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="Don't run before this time")
+    date_started = models.DateTimeField(
+        blank=True,
+        null=True)
+    date_completed = models.DateTimeField(
+        blank=True,
+        null=True)
+    worker = models.CharField(
+        max_length=100,
+        blank=True,
+        null=True,
+        help_text="The worker that last ran the task")
+    output = models.TextField(
+        blank=True,
+        null=True)
+
+    def __str__(self):
+        return "{}: {}".format(self.scan, self.task)
+
+    def scan_link(self):
+        url = reverse('admin:scans_scan_change', args=[self.scan_id])
+        return mark_safe('<a href="{}">{}</a>'.format(url, str(self.scan)))
+    scan_link.short_description = "Scan"
+    scan_link.admin_order_field = "scan"
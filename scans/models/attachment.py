@@ -18,6 +18,7 @@
 """
 import imghdr
 import mimetypes
+from pathlib import Path
 from django.db import models
 from django.utils.html import mark_safe
 from django.conf import settings
@@ -25,8 +26,16 @@ from django.urls import reverse
 
 from private_storage.fields import PrivateFileField
 
+from xrh_utils import VideoInfo, file_fingerprint, probe_video
+from video_thumbnail_store import VideoThumbnailStore
+
 PREVIEW_WIDTH = 800
 PREVIEW_HEIGHT = 600
+VIDEO_INFO_FIELDS = [ # In the order of VideoInfo
+    "video_width", "video_height", "video_frames", "video_frame_rate", "video_duration",
+    "video_codec"]
+THUMBNAIL_STORE = VideoThumbnailStore(
+    settings.VIDEO_THUMBNAIL_ROOT, settings.VIDEO_THUMBNAIL_BUDGET)
 
 ALLOWED_TYPES = settings.ATTACHMENT_TYPES
 ALLOWED_TYPES += [
@@ -113,6 +122,45 @@ class ScanAttachment(models.Model):
         upload_subfolder=get_subfolder,
         content_types=settings.ATTACHMENT_TYPES,
         max_file_size=settings.LARGE_ATTACHMENT_FILE_SIZE_LIMIT)
+    video_width = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="Width of the video (pixels)")
+    video_height = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="Height of the video (pixels)")
+    video_frames = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="Number of frames in the video")
+    video_frame_rate = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Frames per second")
+    video_duration = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Length of the video (s)")
+    video_codec = models.CharField(
+        max_length=32,
+        blank=True,
+        null=True,
+        help_text="Codec of the video stream")
+    video_fingerprint = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text="Fingerprint of the file when the video details were read")
+    upload_lease_owner = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text="The upload process (host:pid) working on this attachment")
+    upload_lease_expires = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="When another upload process may take over this attachment")
 
     def publically_uploaded(self):
         return self.url is not None
@@ -139,7 +187,9 @@ class ScanAttachment(models.Model):
                 PREVIEW_WIDTH,
                 PREVIEW_HEIGHT))
         if self.is_video():
-            html = '<video width="{}" height="{}" controls>'.format(PREVIEW_WIDTH, PREVIEW_HEIGHT)
+            # The thumbnail is shown until play is pressed so the video isn't loaded with the page
+            html = '<video width="{}" height="{}" poster="{}" preload="none" controls>'.format(
+                PREVIEW_WIDTH, PREVIEW_HEIGHT, reverse("video_thumbnail", args=[self.pk]))
             html += '<source src="{}" type="video/mp4">'.format(self.attachment.url)
             html += 'Preview unsupported <a href="{}">{}</a>'.format(
                 self.attachment.url, self.attachment.url)
@@ -155,6 +205,46 @@ class ScanAttachment(models.Model):
         return mimetypes.guess_type(self.attachment.file.name)[0] in settings.VIDEO_TYPES
     is_video.boolean = True
 
+    def video_info(self):
+        """
+            The details of the video, it is only probed again if the file has changed
+            since they were read
+            :return VideoInfo
+        """
+        fingerprint = file_fingerprint(self.attachment.path)
+        if fingerprint != self.video_fingerprint:
+            self.update_video_info(fingerprint)
+        return VideoInfo(*(getattr(self, field) for field in VIDEO_INFO_FIELDS))
+
+    def update_video_info(self, fingerprint=None):
+        """
+            Probe the video and store its details, saved if the attachment already is
+            :param string fingerprint: The fingerprint of the file if already known
+        """
+        video = Path(self.attachment.path)
+        if fingerprint is None:
+            fingerprint = file_fingerprint(video)
+        info = probe_video(video)
+        for (field, value) in zip(VIDEO_INFO_FIELDS, info):
+            setattr(self, field, value)
+        self.video_fingerprint = fingerprint
+        if self.pk is not None:
+            self.save(update_fields=VIDEO_INFO_FIELDS + ["video_fingerprint"])
+
+    def thumbnail(self, position=0.5):
+        """
+            Get the thumbnail of the video from the thumbnail store, making it if needed
+            :param float position: 0 < position <= 1 position through the video
+            :return Path: The thumbnail
+        """
+        info = self.video_info()
+        return THUMBNAIL_STORE.get(
+            Path(self.attachment.path),
+            self.checksum or self.video_fingerprint,
+            position,
+            settings.VIDEO_THUMBNAIL_SIZE,
+            info)
+
 
 class ScanAttachmentType(models.Model):
     name = models.CharField(
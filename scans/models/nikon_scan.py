@@ -17,12 +17,15 @@
     limitations under the License.
 """
 import logging
+import zlib
+from array import array
 from pathlib import Path
 from datetime import timedelta
 from django.db import models
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from xrh_utils import directory_size
+from projection_stack import SERIES as PROJECTION_SERIES
 
 from .gain import Gain
 from .nikon_scan_modes import SCAN_MODE_CONTINUOUS, SCAN_MODE_STANDARD, SCAN_MODE_MRA, \
@@ -469,6 +472,83 @@ class NikonCTScan(Scan):
     max_pixels_to_shuttle = models.IntegerField(
         blank=True,
         null=True)
+    volume_min = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Smallest value in the reconstructed volume")
+    volume_max = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Largest value in the reconstructed volume")
+    volume_mean = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Mean value of the reconstructed volume")
+    volume_std = models.FloatField(
+        blank=True,
+        null=True,
+        verbose_name="Volume standard deviation",
+        help_text="Standard deviation of the values in the reconstructed volume")
+    volume_window_low = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="Low percentile of the volume, shown as black in previews")
+    volume_window_high = models.FloatField(
+        blank=True,
+        null=True,
+        help_text="High percentile of the volume, shown as white in previews")
+    volume_histogram = models.TextField(
+        blank=True,
+        null=True,
+        help_text="JSON list of counts in equal bins from volume_min to volume_max")
+    projection_stats = models.BinaryField(
+        blank=True,
+        null=True,
+        help_text="zlib compressed float32 mean, std, centroid x and centroid y of every "
+            "projection, see projection_series")
+    missing_projections = models.IntegerField(
+        blank=True,
+        null=True,
+        help_text="How many projections couldn't be read when projection_stats was calculated")
+    projection_stats_source = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        help_text="Fingerprint of the projections projection_stats was calculated from")
+
+    def volume_window(self):
+        """
+            :return (float, float): The values to show as black and white in previews, None
+                if the statistics of the volume haven't been calculated
+        """
+        if self.volume_window_low is None or self.volume_window_high is None:
+            return None
+        if self.volume_window_high <= self.volume_window_low:
+            return None
+        return (self.volume_window_low, self.volume_window_high)
+
+    def set_projection_series(self, series):
+        """
+            :param dict series: PROJECTION_SERIES -> the value for each projection (float)
+        """
+        values = array("f")
+        for name in PROJECTION_SERIES:
+            values.extend(series[name])
+        self.projection_stats = zlib.compress(values.tobytes())
+
+    def projection_series(self):
+        """
+            :return dict: PROJECTION_SERIES -> the value for each projection (float, NaN if
+                the projection couldn't be read), None if they haven't been calculated
+        """
+        if not self.projection_stats:
+            return None
+        values = array("f")
+        values.frombytes(zlib.decompress(bytes(self.projection_stats)))
+        count = len(values) // len(PROJECTION_SERIES)
+        return {
+            name: values[index * count:(index + 1) * count].tolist()
+            for (index, name) in enumerate(PROJECTION_SERIES)}
 
     def helical_rotations(self): #pylint: disable=inconsistent-return-statements
         if self.helical_projections_per_rotation:
@@ -567,9 +647,19 @@ class NikonCTScan(Scan):
     def recon_video_dir(self):
         return Path(self.recon_directory(), settings. VIDEO_FOLDER)
 
+    def recon_preview_dir(self):
+        return Path(self.recon_directory(), settings.PREVIEW_FOLDER)
+
     def recon_size(self):
+        """
+            The size of the reconstruction, not including the preview volumes made from it
+        """
         recon_dir = self.recon_directory()
-        return directory_size(recon_dir)
+        size = directory_size(recon_dir)
+        preview_dir = self.recon_preview_dir()
+        if preview_dir.is_dir():
+            size -= directory_size(preview_dir)
+        return size
 
     def raw_files(self):
         path = Path(self.full_path()).parent
@@ -109,6 +109,11 @@ class Scan(PolymorphicModel):
         db_index=True,
         blank=False,
         null=False)
+    fingerprint = models.CharField(
+        max_length=100,
+        blank=True,
+        null=True,
+        help_text="Size, modification time, inode and device of the file when last checksummed")
     name = models.CharField(
         max_length=255,
         db_index=True)
@@ -523,10 +528,13 @@ def generate_sidecar_filename(path):
     sidecar_filename = "." + filename + "." + SIDECAR_SUFFIX
     return Path(path.parent, sidecar_filename)
 
-def load_sidecar(path):
+def read_sidecar(path):
     if not path.exists():
         raise FileNotFoundError("Path ({}) does not exist".format(str(path)))
     with open(path, "r") as f_handle:
         data = json.load(f_handle)
-        pk = data["pk"] #pylint:disable=invalid-name
-        return Scan.objects.get(pk=pk)
+        return data["pk"]
+
+def load_sidecar(path):
+    pk = read_sidecar(path) #pylint:disable=invalid-name
+    return Scan.objects.get(pk=pk)
@@ -26,6 +26,12 @@ from django.utils import timezone
 
 from xrh_utils import directory_size
 
+PREVIEW_FACTOR_CHOICES = [
+    (2, "2x binned"),
+    (4, "4x binned"),
+    (8, "8x binned"),
+]
+
 class UserCopy(models.Model):
     class Meta:
         verbose_name_plural = "User Copies"
@@ -42,6 +48,11 @@ class UserCopy(models.Model):
         null=False,
         blank=False,
         help_text="Copy the reconstructed data folder")
+    preview_factor = models.IntegerField(
+        choices=PREVIEW_FACTOR_CHOICES,
+        null=True,
+        blank=True,
+        help_text="Copy a downsampled preview volume instead of the reconstructed data folder")
     include_raw_data = models.BooleanField(
         default=False,
         null=False,
@@ -0,0 +1,122 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Work out which share a path is on without going to the database for every path
+"""
+import logging
+import threading
+from pathlib import Path
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Share
+
+SHARE_KEY = None # Key in a trie node for the share mounted at that node
+
+class ShareResolver():
+    """
+        Loads the mount points of all the shares once and matches paths against them
+        using the longest matching prefix
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("Share resolver")
+        self._lock = threading.Lock()
+        self._trie = None
+
+    def invalidate(self):
+        """
+            Forget the mount points so they are reloaded the next time they are needed.
+            Saves in this process do this automatically, other processes (the web interface)
+            won't so long running processes should call this periodically.
+        """
+        with self._lock:
+            self._trie = None
+
+    def _load(self):
+        """
+            Build the trie of mount points
+            :return dict: The root node
+        """
+        with self._lock:
+            if self._trie is None:
+                trie = {}
+                for share in Share.objects.exclude(linux_mnt_point__isnull=True).exclude(
+                        linux_mnt_point=""):
+                    node = trie
+                    for part in Path(share.linux_mnt_point).parts:
+                        node = node.setdefault(part, {})
+                    node[SHARE_KEY] = share
+                self._logger.debug("Loaded mount points")
+                self._trie = trie
+            return self._trie
+
+    def resolve(self, path):
+        """
+            Find the share a path is on
+            :param Path path: The path to look up
+            :return (Share, string): The share and the path relative to its mount point
+            :raises ValueError: If the path isn't on a known share
+        """
+        parts = Path(path).parts
+        node = self._load()
+        share = None
+        depth = 0
+        for (index, part) in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if SHARE_KEY in node:
+                share = node[SHARE_KEY]
+                depth = index + 1
+        if share is None:
+            self._logger.error("Unable to match mount_point of %s to value in DB", path)
+            raise ValueError("Unable to match mount_point of ({}) to value in DB".format(path))
+        return (share, "/".join(parts[depth:]))
+
+    def share(self, path):
+        """
+            Find the share a path is on
+            :param Path path: The path to look up
+            :return Share
+        """
+        return self.resolve(path)[0]
+
+    def relative_path(self, path):
+        """
+            Find the path relative to the mount point of its share
+            :param Path path: The path to look up
+            :return string
+        """
+        return self.resolve(path)[1]
+
+RESOLVER = ShareResolver()
+
+def get_share_resolver():
+    """
+        :return ShareResolver: The resolver shared by the whole process
+    """
+    return RESOLVER
+
+@receiver(post_save, sender=Share)
+@receiver(post_delete, sender=Share)
+def invalidate_share_resolver(sender, **kwargs): #pylint: disable=unused-argument
+    """
+        Drop the cached trie of mount points whenever a Share is saved or deleted
+    """
+    RESOLVER.invalidate()
@@ -1,3 +1,1191 @@
-from django.test import TestCase
+import os
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+import numpy
+import pyvips
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from associated_file_queue import (
+    RECHECK_INTERVAL, RETRY_DELAY, ROUTINE_PRIORITY, STALE_TIMEOUT, AssociatedFileQueue)
+from chunked_volume import (
+    PARTIAL_SUFFIX, STORE_SUFFIX, ChunkedArray, ChunkedVolumeWriter, export_volume,
+    is_chunked_store)
+from dataset_parser import is_pruned
+from dataset_processor import DatasetProcessor
+from drive_uploader import LocalDriveUploader, UPLOAD_FOLDER
+from ingest_watcher import IngestWatcher
+from ome_index import NS, OmeIndex, stream_images
+from preview_volume import (
+    PARTIAL_SUFFIX as PREVIEW_PARTIAL_SUFFIX, PreviewVolumeWriter, block_average, write_vgi)
+from public_video_uploader import VideoUploader
+from scans.bulk_resolver import QUERY_BATCH, BulkRecordResolver
+from scans.models import (
+    AssociatedFileTask, Machine, NikonCTScan, RefinedRawData, Scan, ScanAttachment, Server,
+    Share)
+from scans.models.associated_file_task import (
+    DEFAULT_MAX_ATTEMPTS, TASK_DONE, TASK_FAILED, TASK_QUEUED, TASK_RUNNING)
+from scans.models.dataset_status import DATASET_ONLINE
+from scans.tiles import pyramid_urls
+from thumbnailer import Thumbnailer, make_thumbnail
+from tile_pyramid import (
+    DziInfo, has_pyramid, make_pyramid, overview_tile, pyramid_dzi, pyramid_tiles, read_dzi)
+from upload_pipeline import UploadPipeline, release_lease, take_lease
+from video_thumbnail_store import THUMBNAIL_SUFFIX, VideoThumbnailStore, thumbnail_key
+from volume_reader import (
+    AXIS_X, AXIS_Y, AXIS_Z, FLOAT_BINS, HISTOGRAM_BINS, PROJECTION_MEAN, PROJECTION_MIP,
+    PROJECTION_STD, VolumeReader)
+from vsi_extraction import MARKER_SUFFIX, METADATA_FILE, Plane, VsiExtractor, main_images
+from xrh_utils import vgi_from_vol
+from xrhms_exceptions import XrhmsIgnore
+from xtek_extractor import XtekExtractor, read_sections, read_xtek
+from xtek_parameters import XTEKCT_MODE, XTEKHELIX_MODE
+from xtek_parser import XtekParser
+
+# Just enough of an MP4 for libmagic to call it video/mp4
+MP4_HEADER = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom\x00\x00\x00\x08free"
+
+class FlakyShareDrive(LocalDriveUploader):
+    """
+        Fails to share the first file it is asked to
+    """
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.uploads = 0
+        self.share_failures = 1
+
+    def upload_file(self, title, filepath, folder_name=UPLOAD_FOLDER):
+        self.uploads += 1
+        return super().upload_file(title, filepath, folder_name)
+
+    def share(self, file_id):
+        if self.share_failures:
+            self.share_failures -= 1
+            raise RuntimeError("Permission not inserted")
+        return super().share(file_id)
+
+class VideoUploadTests(TestCase):
+    def setUp(self):
+        self._temp = TemporaryDirectory()
+        self.addCleanup(self._temp.cleanup)
+        self.storage = Path(self._temp.name, "storage")
+        self.drive_dir = Path(self._temp.name, "drive")
+        storage = ScanAttachment._meta.get_field("attachment").storage
+        patcher = mock.patch.object(storage, "location", str(self.storage))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        server = Server.objects.create(host_name="test-server")
+        share = Share.objects.create(
+            name="test-share", server=server, linux_mnt_point=self._temp.name,
+            default_status=DATASET_ONLINE)
+        scanner = Machine.objects.create(name="test-scanner")
+        self.scan = Scan.objects.create(
+            scan_date=date(2026, 10, 17), scanner=scanner, share=share, path="scan",
+            filename="scan.xtekct", checksum="0" * 64, name="Test scan")
+
+    def _attachment(self, name="video.mp4", content=MP4_HEADER):
+        """
+            :return ScanAttachment: A video waiting to be uploaded
+        """
+        video = Path(self.storage, "scan", str(self.scan.pk), name)
+        video.parent.mkdir(parents=True, exist_ok=True)
+        video.write_bytes(content)
+        return ScanAttachment.objects.create(
+            name=name, scan=self.scan, attachment="scan/{}/{}".format(self.scan.pk, name),
+            to_upload=True, overlay_position=ScanAttachment.NONE)
+
+    def _uploaded(self):
+        """
+            :return List: The files in the local drive
+        """
+        return list(Path(self.drive_dir, UPLOAD_FOLDER).glob("*"))
+
+    def _pipeline(self, drive):
+        drive.authenticate()
+        return UploadPipeline(lambda: drive, None, 1, 1, retries=2, backoff=0)
+
+    def test_pipeline_stores_url_and_releases(self):
+        attachment = self._attachment()
+        metrics = self._pipeline(LocalDriveUploader(self.drive_dir)).run([attachment.pk])
+        self.assertEqual(metrics["uploaded"], 1)
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.url, self._uploaded()[0].resolve().as_uri())
+        self.assertIsNone(attachment.upload_lease_owner)
+        self.assertIsNone(attachment.upload_lease_expires)
+
+    def test_pipeline_skips_leased(self):
+        attachment = self._attachment()
+        ScanAttachment.objects.filter(pk=attachment.pk).update(
+            upload_lease_owner="other:1",
+            upload_lease_expires=timezone.now() + timedelta(hours=1))
+        metrics = self._pipeline(LocalDriveUploader(self.drive_dir)).run([attachment.pk])
+        self.assertEqual(metrics["skipped"], 1)
+        attachment.refresh_from_db()
+        self.assertIsNone(attachment.url)
+        self.assertEqual(attachment.upload_lease_owner, "other:1")
+        self.assertEqual(self._uploaded(), [])
+
+    def test_pipeline_retries_only_share(self):
+        attachment = self._attachment()
+        drive = FlakyShareDrive(self.drive_dir)
+        metrics = self._pipeline(drive).run([attachment.pk])
+        self.assertEqual(metrics["uploaded"], 1)
+        self.assertEqual(metrics["retries"], 1)
+        self.assertEqual(drive.uploads, 1)
+        self.assertEqual(len(self._uploaded()), 1)
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.url, self._uploaded()[0].resolve().as_uri())
+
+    def test_expired_lease_can_be_taken(self):
+        attachment = self._attachment()
+        self.assertTrue(take_lease(attachment.pk, "first:1"))
+        self.assertFalse(take_lease(attachment.pk, "second:2"))
+        ScanAttachment.objects.filter(pk=attachment.pk).update(
+            upload_lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(take_lease(attachment.pk, "second:2"))
+
+    def test_lost_lease_does_not_store_url(self):
+        attachment = self._attachment()
+        self.assertTrue(take_lease(attachment.pk, "first:1"))
+        ScanAttachment.objects.filter(pk=attachment.pk).update(upload_lease_owner="second:2")
+        self.assertFalse(release_lease(attachment.pk, "first:1", url="file:///first"))
+        attachment.refresh_from_db()
+        self.assertIsNone(attachment.url)
+        self.assertEqual(attachment.upload_lease_owner, "second:2")
+
+    def test_serial_leases(self):
+        attachment = self._attachment()
+        uploader = VideoUploader(LocalDriveUploader(self.drive_dir))
+        url = uploader.upload_scan_attachment(attachment)
+        self.assertEqual(url, self._uploaded()[0].resolve().as_uri())
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.url, url)
+        self.assertIsNone(attachment.upload_lease_owner)
+
+    def test_serial_skips_leased(self):
+        attachment = self._attachment()
+        self.assertTrue(take_lease(attachment.pk, "other:1"))
+        uploader = VideoUploader(LocalDriveUploader(self.drive_dir))
+        self.assertIsNone(uploader.upload_scan_attachment(attachment))
+        self.assertEqual(self._uploaded(), [])
+
+    def test_serial_disables_invalid(self):
+        attachment = self._attachment("notes.mp4", b"Not a video")
+        uploader = VideoUploader(LocalDriveUploader(self.drive_dir))
+        self.assertEqual(uploader.process_all_scan_attachments(), (0, 1))
+        attachment.refresh_from_db()
+        self.assertFalse(attachment.to_upload)
+        self.assertIsNone(attachment.upload_lease_owner)
+
+class XtekExtractorTests(SimpleTestCase):
+    def setUp(self):
+        self._temp = TemporaryDirectory()
+        self.addCleanup(self._temp.cleanup)
+
+    def _xtek(self, text):
+        """
+            :return Path: An xtek file containing text
+        """
+        xtek = Path(self._temp.name, "scan.xtekct")
+        xtek.write_text(text)
+        return xtek
+
+    def test_conversion(self):
+        (mode, values) = read_xtek(self._xtek(
+            "[XTekCT]\n"
+            "Name=Sample 1\n"
+            "VoxelsX = 1000\n"
+            "VoxelSizeX: 0.0125\n"
+            "OperatorID=\n"
+            "[CTPro]\n"
+            "Shuttling=True\n"
+            "AngleFile_Use=no\n"
+            "[Xrays]\n"
+            "XraykV=160\n"))
+        self.assertEqual(mode, XTEKCT_MODE)
+        self.assertEqual(values["name"], "Sample 1")
+        self.assertEqual(values["voxels_x"], 1000)
+        self.assertEqual(values["voxel_size_x"], 0.0125)
+        self.assertIsNone(values["operator_id"])
+        self.assertIs(values["shuttling"], True)
+        self.assertIs(values["angle_file_use"], False)
+        self.assertEqual(values["xray_kv"], 160)
+        self.assertNotIn("voxels_y", values)
+
+    def test_helix_mode(self):
+        (mode, values) = read_xtek(self._xtek("[XTekHelixCT]\nPitch=1.5\n"))
+        self.assertEqual(mode, XTEKHELIX_MODE)
+        self.assertEqual(values["pitch"], 1.5)
+
+    def test_default_section(self):
+        sections = read_sections(self._xtek(
+            "[DEFAULT]\n"
+            "Units=mm\n"
+            "Scale=1\n"
+            "[XTekCT]\n"
+            "Scale=2\n"
+            "[CTPro]\n"))
+        self.assertNotIn("DEFAULT", sections)
+        self.assertEqual(sections["XTekCT"], {"Units": "mm", "Scale": "2"})
+        self.assertEqual(sections["CTPro"], {"Units": "mm", "Scale": "1"})
+
+    def test_comments_continuations_and_repeats(self):
+        sections = read_sections(self._xtek(
+            "# comment\n"
+            "[XTekCT]\n"
+            "; comment\n"
+            "DICOMTags=first\n"
+            "  second\n"
+            "Name=old\n"
+            "Name=new\n"))
+        self.assertEqual(sections["XTekCT"], {"DICOMTags": "first\nsecond", "Name": "new"})
+
+    def test_ignored(self):
+        with self.assertRaises(XrhmsIgnore):
+            read_xtek(self._xtek("[XTekCT]\nName=test\n[soton]\nXrhmsIgnore=yes\n"))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            read_xtek(self._xtek("[Other]\nName=test\n"))
+        with self.assertRaises(ValueError):
+            read_xtek(self._xtek("Name=test\n[XTekCT]\n"))
+        with self.assertRaises(ValueError):
+            read_xtek(self._xtek("[XTekCT]\nVoxelsX=many\n"))
+
+    def test_read_many_returns_errors(self):
+        good = self._xtek("[XTekCT]\nVoxelsX=10\n")
+        bad = Path(self._temp.name, "bad.xtekct")
+        bad.write_text("[Other]\n")
+        results = dict(XtekExtractor().read_many([good, bad], workers=1))
+        self.assertEqual(results[good], (XTEKCT_MODE, {"voxels_x": 10}))
+        self.assertIsInstance(results[bad], ValueError)
+
+OME_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">
+  <Instrument ID="Instrument:0"><Microscope Model="VS200"/></Instrument>
+  <Image ID="Image:0" Name="overview">
+    <AcquisitionDate>2026-10-17T09:00:00</AcquisitionDate>
+    <Pixels SizeX="100" SizeY="50"><Channel ID="Channel:0:0"/></Pixels>
+  </Image>
+  <Image ID="Image:1" Name="40x_01">
+    <Pixels SizeX="4000" SizeY="3000"><Channel ID="Channel:1:0"/><Channel ID="Channel:1:1"/>
+    </Pixels>
+  </Image>
+  <Image ID="Image:2" Name="overview">
+    <Pixels SizeX="10" SizeY="5"/>
+  </Image>
+  <StructuredAnnotations>
+    <XMLAnnotation ID="Annotation:0"><Value><OriginalMetadata>
+      <Key>Objective 2 Name</Key><Value>40x</Value>
+    </OriginalMetadata></Value></XMLAnnotation>
+    <XMLAnnotation ID="Annotation:1"><Value><OriginalMetadata>
+      <Key>Objective 1 Name</Key><Value>2x</Value>
+    </OriginalMetadata></Value></XMLAnnotation>
+    <XMLAnnotation ID="Annotation:2"><Value><OriginalMetadata>
+      <Key>Objective 2 Name</Key><Value>ignored</Value>
+    </OriginalMetadata></Value></XMLAnnotation>
+    <XMLAnnotation ID="Annotation:3"><Value><OriginalMetadata>
+      <Key>Channel Name</Key><Value>40x</Value>
+    </OriginalMetadata></Value></XMLAnnotation>
+    <XMLAnnotation ID="Annotation:4"><Value><Other/></Value></XMLAnnotation>
+  </StructuredAnnotations>
+</OME>
+"""
+
+class OmeIndexTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.xmlfile = Path(temp.name, "slide.ome.xml")
+        self.xmlfile.write_text(OME_XML)
+        self.index = OmeIndex.from_file(self.xmlfile)
+
+    def test_images(self):
+        self.assertEqual([image.image_id for image in self.index.images],
+                         ["Image:0", "Image:1", "Image:2"])
+        image = self.index.image("Image:1")
+        self.assertEqual((image.name, image.size_x, image.size_y, image.channels),
+                         ("40x_01", 4000, 3000, 2))
+        self.assertIsNone(image.acquisition_date)
+        self.assertIsNone(self.index.image("Image:9"))
+
+    def test_first_image_with_name(self):
+        image = self.index.image_by_name("overview")
+        self.assertEqual(image.image_id, "Image:0")
+        self.assertEqual(image.acquisition_date, "2026-10-17T09:00:00")
+        self.assertIsNone(self.index.image_by_name("missing"))
+
+    def test_instrument(self):
+        instrument = self.index.instrument("Instrument:0")
+        self.assertEqual(instrument.find("ome:Microscope", NS).get("Model"), "VS200")
+        self.assertIsNone(self.index.instrument("Instrument:1"))
+
+    def test_first_metadata_value(self):
+        self.assertEqual(self.index.metadata("Objective 2 Name"), "40x")
+        self.assertIsNone(self.index.metadata("Objective 3 Name"))
+
+    def test_prefix_is_first_in_document(self):
+        # Sorted, "Objective 1" comes first but "Objective 2" is earlier in the document
+        self.assertEqual(
+            self.index.metadata_prefix("Objective"), ("Objective 2 Name", "40x"))
+        self.assertEqual(
+            self.index.metadata_prefix("Objective 1"), ("Objective 1 Name", "2x"))
+        self.assertIsNone(self.index.metadata_prefix("Stage"))
+
+    def test_keys_with_value(self):
+        self.assertEqual(
+            self.index.keys_with_value("40x"), ["Objective 2 Name", "Channel Name"])
+        self.assertEqual(self.index.keys_with_value("ignored"), [])
+
+    def test_stream_images(self):
+        # Each image is cleared once the next one is read
+        ids = [image.get("ID") for image in stream_images(self.xmlfile, ["overview", "40x_01"])]
+        self.assertEqual(ids, ["Image:0", "Image:1"])
+
+class BulkRecordResolverTests(TestCase):
+    def test_finds_and_creates_in_order(self):
+        existing = Machine.objects.create(name="existing", shuttle_multiplier=1.5)
+        resolver = BulkRecordResolver(Machine, ["name", "shuttle_multiplier"])
+        wanted = [
+            {"name": "new", "shuttle_multiplier": None},
+            {"name": "existing", "shuttle_multiplier": "1.5"}, # Converted to match the DB
+            {"name": "new", "shuttle_multiplier": None}]
+        with self.assertNumQueries(3): # Find, create the missing one and find it
+            records = resolver.resolve(wanted)
+        self.assertEqual(records[1], existing)
+        self.assertIsNotNone(records[0].pk)
+        self.assertIs(records[0], records[2])
+        self.assertEqual(Machine.objects.count(), 2)
+
+    def test_batches(self):
+        resolver = BulkRecordResolver(Machine, ["name"])
+        names = ["machine {}".format(index) for index in range(QUERY_BATCH + 1)]
+        records = resolver.resolve([{"name": name} for name in names])
+        self.assertEqual([record.name for record in records], names)
+        self.assertEqual(Machine.objects.count(), QUERY_BATCH + 1)
+
+class BulkRecordResolverCacheTests(TransactionTestCase):
+    def test_cached_once_committed(self):
+        resolver = BulkRecordResolver(Machine, ["name"])
+        with transaction.atomic():
+            (first,) = resolver.resolve([{"name": "scanner"}])
+        with self.assertNumQueries(0):
+            (second,) = resolver.resolve([{"name": "scanner"}])
+        self.assertIs(first, second)
+        resolver.clear()
+        with self.assertNumQueries(1):
+            resolver.resolve([{"name": "scanner"}])
+
+    def test_not_cached_when_rolled_back(self):
+        resolver = BulkRecordResolver(Machine, ["name"])
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                resolver.resolve([{"name": "scanner"}])
+                raise RuntimeError("Roll back")
+        self.assertFalse(Machine.objects.exists())
+        (record,) = resolver.resolve([{"name": "scanner"}])
+        self.assertTrue(Machine.objects.filter(pk=record.pk).exists())
+
+class VolumeReaderTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = Path(temp.name)
+        self.data = numpy.random.RandomState(0).randint(
+            0, 4096, size=(6, 5, 4)).astype(numpy.uint16)
+
+    def _reader(self, data=None, slices=None, header=16):
+        """
+            :param numpy.ndarray data: The volume (z, y, x), default self.data
+            :param int slices: Only write this many slices, as if it is being reconstructed
+            :return VolumeReader: For the volume written after a header
+        """
+        data = self.data if data is None else data
+        volume = Path(self.directory, "recon.vol")
+        with open(volume, "wb") as fhandle:
+            fhandle.write(b"\xff" * header)
+            fhandle.write(data[:slices].tobytes())
+        (pixels_z, pixels_y, pixels_x) = data.shape
+        return VolumeReader(
+            volume, pixels_x, pixels_y, pixels_z, data.dtype.itemsize * 8, header=header)
+
+    def test_slices(self):
+        reader = self._reader()
+        numpy.testing.assert_array_equal(reader.xy_slice(2), self.data[2])
+        numpy.testing.assert_array_equal(reader.xz_slice(1), self.data[:, 1, :])
+        numpy.testing.assert_array_equal(reader.yz_slice(3), self.data[:, :, 3])
+        numpy.testing.assert_array_equal(reader.slice(AXIS_Z, 1.0), self.data[5])
+        numpy.testing.assert_array_equal(reader.slice(AXIS_X, 0.5), self.data[:, :, 2])
+
+    def test_slabs(self):
+        reader = self._reader()
+        for (axis, numpy_axis, start, stop) in [(AXIS_Z, 0, 1, 5), (AXIS_Y, 1, 0, 3),
+                                                (AXIS_X, 2, 2, 4)]:
+            part = numpy.take(self.data, range(start, stop), axis=numpy_axis)
+            numpy.testing.assert_array_equal(
+                reader.slab(axis, start, stop, PROJECTION_MIP), part.max(axis=numpy_axis))
+            numpy.testing.assert_allclose(
+                reader.slab(axis, start, stop, PROJECTION_MEAN),
+                part.mean(axis=numpy_axis, dtype=numpy.float64))
+            numpy.testing.assert_allclose(
+                reader.slab(axis, start, stop, PROJECTION_STD),
+                part.std(axis=numpy_axis, dtype=numpy.float64), atol=1e-9)
+
+    def test_slabs_read_in_chunks(self):
+        reader = self._reader()
+        with mock.patch("volume_reader.CHUNK_BYTES", reader.bytes_per_slice * 2):
+            numpy.testing.assert_array_equal(
+                reader.slab(AXIS_Z, 0, 5, PROJECTION_MIP), self.data[0:5].max(axis=0))
+            numpy.testing.assert_allclose(
+                reader.slab(AXIS_Z, 0, 5, PROJECTION_STD),
+                self.data[0:5].std(axis=0, dtype=numpy.float64), atol=1e-9)
+            numpy.testing.assert_allclose(
+                reader.slab(AXIS_Y, 1, 4, PROJECTION_MEAN),
+                self.data[:, 1:4, :].mean(axis=1, dtype=numpy.float64))
+
+    def test_float_mip(self):
+        data = -numpy.arange(24, dtype=numpy.float32).reshape((2, 3, 4)) - 1
+        reader = self._reader(data)
+        numpy.testing.assert_array_equal(reader.slab(AXIS_Z, 0, 2), data.max(axis=0))
+
+    def test_incomplete(self):
+        reader = self._reader(slices=3)
+        self.assertFalse(reader.is_complete())
+        numpy.testing.assert_array_equal(reader.xy_slice(2), self.data[2])
+        with self.assertRaises(ValueError):
+            reader.xy_slice(3)
+        with self.assertRaises(ValueError):
+            reader.xz_slice(0)
+
+    def test_invalid(self):
+        reader = self._reader()
+        with self.assertRaises(ValueError):
+            reader.slab(AXIS_Z, 3, 3)
+        with self.assertRaises(ValueError):
+            reader.slab(AXIS_Z, 0, 7)
+        with self.assertRaises(ValueError):
+            reader.slab(AXIS_Z, 0, 1, "median")
+        with self.assertRaises(ValueError):
+            reader.slice(AXIS_Z, 1.5)
+
+class VolumeStatisticsTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.volume = Path(temp.name, "recon.vol")
+
+    def _statistics(self, data, percentiles):
+        """
+            :param numpy.ndarray data: The volume (z, y, x)
+            :param tuple percentiles: The percentiles to find
+            :return dict: The statistics of the volume, read in several chunks and ranges
+        """
+        self.volume.write_bytes(data.tobytes())
+        (pixels_z, pixels_y, pixels_x) = data.shape
+        reader = VolumeReader(
+            self.volume, pixels_x, pixels_y, pixels_z, data.dtype.itemsize * 8)
+        with mock.patch("volume_reader.STATS_CHUNK_BYTES", reader.bytes_per_slice * 3):
+            return reader.statistics(workers=2, percentiles=percentiles)
+
+    def test_integer(self):
+        data = numpy.random.RandomState(1).randint(
+            100, 60000, size=(20, 6, 7)).astype(numpy.uint16)
+        stats = self._statistics(data, (0, 0.5, 50, 99.5, 100))
+        self.assertEqual(stats["min"], data.min())
+        self.assertEqual(stats["max"], data.max())
+        self.assertAlmostEqual(stats["mean"], data.mean(dtype=numpy.float64))
+        self.assertAlmostEqual(stats["std"], data.std(dtype=numpy.float64), places=6)
+        for (percentile, value) in stats["percentiles"].items():
+            self.assertEqual(
+                value, numpy.percentile(data, percentile, method="inverted_cdf"))
+        self.assertEqual(len(stats["histogram"]), HISTOGRAM_BINS)
+        self.assertEqual(sum(stats["histogram"]), data.size)
+        self.assertEqual(stats["histogram"][0], numpy.count_nonzero(
+            data < data.min() + (data.max() - data.min()) / HISTOGRAM_BINS))
+
+    def test_constant(self):
+        data = numpy.full((3, 2, 2), 7, dtype=numpy.uint8)
+        stats = self._statistics(data, (50,))
+        self.assertEqual((stats["min"], stats["max"], stats["mean"], stats["std"]),
+                         (7, 7, 7, 0))
+        self.assertEqual(stats["percentiles"], {50: 7})
+        self.assertEqual(stats["histogram"], [data.size] + [0] * (HISTOGRAM_BINS - 1))
+
+    def test_float(self):
+        data = numpy.random.RandomState(2).normal(
+            size=(20, 8, 8)).astype(numpy.float32)
+        data[3, 0, 0] = numpy.nan # Ignored
+        finite = data[numpy.isfinite(data)].astype(numpy.float64)
+        stats = self._statistics(data, (50,))
+        self.assertEqual(stats["min"], finite.min())
+        self.assertEqual(stats["max"], finite.max())
+        self.assertAlmostEqual(stats["mean"], finite.mean())
+        self.assertAlmostEqual(stats["std"], finite.std())
+        # Within a bin of the range sampled, which may not include every value
+        self.assertAlmostEqual(
+            stats["percentiles"][50], numpy.median(finite),
+            delta=2 * (finite.max() - finite.min()) / FLOAT_BINS)
+        self.assertEqual(sum(stats["histogram"]), finite.size)
+
+    def test_incomplete(self):
+        self.volume.write_bytes(numpy.zeros((2, 2, 2), dtype=numpy.uint8).tobytes())
+        reader = VolumeReader(self.volume, 2, 2, 3, 8)
+        with self.assertRaises(ValueError):
+            reader.statistics(workers=1)
+
+class ChunkedVolumeTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = Path(temp.name)
+        self.data = numpy.random.RandomState(3).randint(
+            1, 65536, size=(9, 7, 5)).astype(numpy.uint16)
+        self.data[:4, :3, :3] = 0 # A whole chunk of air
+        self.source = self._volume("recon.vol", self.data)
+        self.store = Path(self.directory, "recon" + STORE_SUFFIX)
+        self.writer = ChunkedVolumeWriter(chunks=(4, 3, 3), workers=2)
+
+    def _volume(self, name, data):
+        """
+            :return VolumeReader: For data written to a raw volume
+        """
+        volume = Path(self.directory, name)
+        volume.write_bytes(data.tobytes())
+        (pixels_z, pixels_y, pixels_x) = data.shape
+        return VolumeReader(volume, pixels_x, pixels_y, pixels_z, data.dtype.itemsize * 8)
+
+    def test_roundtrip(self):
+        self.assertGreater(self.writer.convert(self.source, self.store, {"scan": 1}), 0)
+        self.assertTrue(is_chunked_store(self.store))
+        self.assertFalse(Path(self.store, "0.0.0").exists())
+        self.assertTrue(Path(self.store, "0.0.1").exists())
+        self.assertFalse(Path(self.store.parent, self.store.name + PARTIAL_SUFFIX).exists())
+        store = VolumeReader(self.store)
+        self.assertEqual((store.pixels_x, store.pixels_y, store.pixels_z, store.bitdepth),
+                         (5, 7, 9, 16))
+        self.assertTrue(self.writer.verify(self.source, store))
+        self.assertEqual(ChunkedArray(self.store).attributes, {"scan": 1})
+        numpy.testing.assert_array_equal(store.xy_slab(3, 9), self.data[3:9])
+        numpy.testing.assert_array_equal(store.xy_slice(8), self.data[8])
+        numpy.testing.assert_array_equal(store.yz_slice(4), self.data[:, :, 4])
+        numpy.testing.assert_array_equal(
+            store.slab(AXIS_Y, 2, 6), self.data[:, 2:6, :].max(axis=1))
+
+    def test_statistics_match(self):
+        self.writer.convert(self.source, self.store)
+        self.assertEqual(
+            VolumeReader(self.store).statistics(workers=1),
+            self.source.statistics(workers=1))
+
+    def test_verify_detects_differences(self):
+        self.writer.convert(self.source, self.store)
+        changed = self.data.copy()
+        changed[8, 6, 4] += 1
+        self.assertFalse(self.writer.verify(
+            self._volume("changed.vol", changed), VolumeReader(self.store)))
+        self.assertFalse(self.writer.verify(
+            self._volume("smaller.vol", self.data[:8]), VolumeReader(self.store)))
+
+    def test_existing_store(self):
+        self.writer.convert(self.source, self.store)
+        with self.assertRaises(ValueError):
+            self.writer.convert(self.source, self.store)
+
+    def test_replaces_partial_store(self):
+        partial = Path(self.store.parent, self.store.name + PARTIAL_SUFFIX)
+        partial.mkdir()
+        Path(partial, "0.0.0").write_bytes(b"left over")
+        self.writer.convert(self.source, self.store)
+        self.assertFalse(partial.exists())
+        self.assertFalse(Path(self.store, "0.0.0").exists())
+
+    def test_incomplete(self):
+        self.source.filename.write_bytes(self.data[:5].tobytes())
+        incomplete = VolumeReader(self.source.filename, 5, 7, 9, 16)
+        with self.assertRaises(ValueError):
+            self.writer.convert(incomplete, self.store)
+        self.assertFalse(self.store.exists())
+
+    def test_export(self):
+        self.writer.convert(self.source, self.store)
+        exported = Path(self.directory, "exported.vol")
+        self.assertEqual(
+            export_volume(VolumeReader(self.store), exported, slices=4), self.data.nbytes)
+        self.assertEqual(exported.read_bytes(), self.data.tobytes())
+        self.assertFalse(Path(self.directory, "exported.vol" + PARTIAL_SUFFIX).exists())
+        with self.assertRaises(ValueError):
+            export_volume(VolumeReader(self.store), exported)
+
+class XtekReconTests(TestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = Path(temp.name)
+        server = Server.objects.create(host_name="test-server")
+        share = Share.objects.create(
+            name="test-share", server=server, linux_mnt_point=temp.name,
+            default_status=DATASET_ONLINE)
+        scanner = Machine.objects.create(name="test-scanner")
+        self.scan = NikonCTScan.objects.create(
+            scan_date=date(2026, 10, 17), scanner=scanner, share=share, path="scan",
+            filename="scan.xtekct", checksum="0" * 64, name="Test scan",
+            voxels_x=5, voxels_y=7, voxels_z=9)
+        self.recon_dir = self.scan.recon_directory()
+        self.recon_dir.mkdir(parents=True)
+        self.data = numpy.random.RandomState(5).randint(
+            0, 65536, size=(9, 7, 5)).astype(numpy.uint16)
+        self.volume = Path(self.recon_dir, "scan.vol")
+        self.volume.write_bytes(self.data.tobytes())
+        write_vgi(vgi_from_vol(self.volume), self.volume.name, (5, 7, 9), 16)
+        for fname in (self.volume, vgi_from_vol(self.volume)):
+            RefinedRawData.objects.create(scan=self.scan, name=fname.name, path="scan")
+        Path(self.recon_dir, "notes.txt").write_text("notes")
+        self.parser = XtekParser()
+        self.writer = ChunkedVolumeWriter(chunks=(4, 3, 3), workers=1)
+
+    def test_remove_original(self):
+        self.assertEqual(
+            self.parser.convert_recon(self.scan, self.writer, remove_original=True),
+            (True, ""))
+        self.assertTrue(is_chunked_store(Path(self.recon_dir, "scan" + STORE_SUFFIX)))
+        self.assertFalse(self.volume.exists())
+        self.assertFalse(vgi_from_vol(self.volume).exists())
+        self.assertFalse(RefinedRawData.objects.filter(scan=self.scan).exists())
+
+    def test_copy_store_as_volume(self):
+        self.parser.convert_recon(self.scan, self.writer, remove_original=True)
+        destination = Path(self.directory, "copy")
+        destination.mkdir()
+        self.assertEqual(self.parser.copy_recon(self.scan, destination), (True, ""))
+        copied = Path(destination, "scan")
+        self.assertEqual(
+            sorted(fname.name for fname in copied.iterdir()),
+            ["notes.txt", "scan.vgi", "scan.vol"])
+        self.assertEqual(Path(copied, "scan.vol").read_bytes(), self.data.tobytes())
+        copy = VolumeReader(Path(copied, "scan.vol"))
+        self.assertEqual((copy.pixels_x, copy.pixels_y, copy.pixels_z, copy.bitdepth),
+                         (5, 7, 9, 16))
+
+class ThumbnailerTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = Path(temp.name)
+
+    def _image(self, name, data):
+        """
+            :param numpy.ndarray data: 8 bit greyscale pixels (y, x)
+            :return Path: The image written as a TIFF
+        """
+        data = numpy.ascontiguousarray(data, dtype=numpy.uint8)
+        (height, width) = data.shape
+        image = Path(self.directory, name)
+        pyvips.Image.new_from_memory(data.data, width, height, 1, "uchar").write_to_file(
+            str(image))
+        return image
+
+    def _read(self, thumbnail):
+        """
+            :return numpy.ndarray: The pixels of a thumbnail (y, x)
+        """
+        image = pyvips.Image.new_from_file(str(thumbnail))
+        return numpy.ndarray(
+            buffer=image.write_to_memory(), dtype=numpy.uint8,
+            shape=(image.height, image.width, image.bands))[:, :, 0]
+
+    def test_shrinks(self):
+        image = self._image("projection_0001.tif", numpy.full((200, 400), 100))
+        thumbnail = Thumbnailer(size=100).thumbnail(image, self.directory)
+        self.assertEqual(thumbnail, Path(self.directory, "projection_0001.png"))
+        data = self._read(thumbnail)
+        self.assertEqual(data.shape, (50, 100))
+        self.assertTrue((data == 100).all())
+
+    def test_not_enlarged(self):
+        image = self._image("small.tif", numpy.zeros((20, 10)))
+        thumbnail = make_thumbnail(image, self.directory, size=100)
+        self.assertEqual(self._read(thumbnail).shape, (20, 10))
+
+    def test_percentile_is_white(self):
+        data = numpy.zeros((100, 100))
+        data[:, 50:] = 100
+        data[:, 99] = 200
+        image = self._image("bright.tif", data)
+        thumbnail = make_thumbnail(image, self.directory, size=100, percent=95)
+        result = self._read(thumbnail)
+        self.assertEqual(result[0, 0], 0)
+        self.assertEqual(result[0, 50], 255)
+        self.assertEqual(result[0, 99], 255) # Clipped
+
+    def test_batch(self):
+        images = [
+            self._image("a.tif", numpy.zeros((30, 40))),
+            self._image("b.tif", numpy.zeros((40, 30)))]
+        broken = Path(self.directory, "broken.tif")
+        broken.write_bytes(b"Not an image")
+        with Thumbnailer(size=20, workers=2).thumbnails(images + [broken]) as thumbnails:
+            self.assertEqual(self._read(thumbnails[images[0]]).shape, (15, 20))
+            self.assertEqual(self._read(thumbnails[images[1]]).shape, (20, 15))
+            self.assertIsNone(thumbnails[broken])
+            made = list(thumbnails.values())[0]
+        self.assertFalse(made.exists())
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            Thumbnailer(size=0)
+
+class PreviewVolumeTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = Path(temp.name)
+        self.data = numpy.random.RandomState(4).randint(
+            0, 65536, size=(9, 10, 11)).astype(numpy.uint16)
+        self.volume = Path(self.directory, "recon.vol")
+        self.volume.write_bytes(self.data.tobytes())
+        self.previews = Path(self.directory, "preview")
+
+    def _write(self, factors):
+        (pixels_z, pixels_y, pixels_x) = self.data.shape
+        return PreviewVolumeWriter(self.previews, factors).write(
+            self.volume, pixels_x, pixels_y, pixels_z, 16)
+
+    def test_block_average(self):
+        chunk = numpy.arange(5 * 4 * 3, dtype=numpy.uint8).reshape((5, 4, 3))
+        expected = chunk[:4, :4, :2].reshape(2, 2, 2, 2, 1, 2).mean(axis=(1, 3, 5))
+        numpy.testing.assert_array_equal(block_average(chunk, 2), numpy.rint(expected))
+        self.assertEqual(block_average(chunk, 2).dtype, numpy.uint8)
+        floats = numpy.full((2, 2, 2), 0.25, dtype=numpy.float32)
+        numpy.testing.assert_array_equal(block_average(floats, 2), [[[0.25]]])
+
+    def test_levels(self):
+        previews = self._write([2, 4])
+        self.assertEqual(previews, [
+            (2, Path(self.previews, "recon_bin2.vol")),
+            (4, Path(self.previews, "recon_bin4.vol"))])
+        half = VolumeReader(previews[0][1])
+        self.assertEqual((half.pixels_x, half.pixels_y, half.pixels_z, half.bitdepth),
+                         (5, 5, 4, 16))
+        expected = block_average(self.data, 2)
+        numpy.testing.assert_array_equal(half.xy_slab(0, 4), expected)
+        quarter = VolumeReader(previews[1][1])
+        numpy.testing.assert_array_equal(
+            quarter.xy_slab(0, 2), block_average(expected, 2))
+        self.assertEqual(list(self.previews.glob("*" + PREVIEW_PARTIAL_SUFFIX)), [])
+
+    def test_current_previews_kept(self):
+        self._write([2])
+        with mock.patch.object(PreviewVolumeWriter, "_bin") as binned:
+            self._write([2])
+        binned.assert_not_called()
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            PreviewVolumeWriter(self.previews, [2, 3])
+        with self.assertRaises(ValueError):
+            PreviewVolumeWriter(self.previews, [1])
+        with self.assertRaises(ValueError):
+            self._write([16])
+
+VSI_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">
+  <Image ID="Image:0" Name="macro image"><Pixels SizeX="800" SizeY="300"/></Image>
+  <Image ID="Image:1" Name="overview"><Pixels SizeX="1000" SizeY="500"/></Image>
+  <Image ID="Image:2" Name="overview"><Pixels SizeX="500" SizeY="250"/></Image>
+  <Image ID="Image:3" Name="40x_01">
+    <Pixels SizeX="4000" SizeY="3000"><Channel ID="Channel:3:0"/><Channel ID="Channel:3:1"/>
+    </Pixels>
+  </Image>
+  <Image ID="Image:4" Name="40x_01"><Pixels SizeX="2000" SizeY="1500"/></Image>
+</OME>
+"""
+
+class VsiExtractionTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = Path(temp.name)
+        self.dataset = Path(self.directory, "slide.vsi")
+        self.dataset.write_bytes(b"Not really a VSI file")
+        self.xmlfile = Path(self.directory, "slide.xml")
+        self.extractor = VsiExtractor(workers=1)
+        self.markers = VsiExtractor.marker_dir(self.dataset)
+        self.markers.mkdir()
+        Path(self.markers, METADATA_FILE).write_text(VSI_XML)
+        self.planes = self.extractor._find_planes( #pylint: disable=protected-access
+            self.dataset, OmeIndex.from_file(Path(self.markers, METADATA_FILE)))
+
+    def test_main_images(self):
+        index = OmeIndex.from_file(Path(self.markers, METADATA_FILE))
+        self.assertEqual(
+            [(series, image.name) for (series, image) in main_images(index)],
+            [(1, "overview"), (3, "40x_01")])
+
+    def test_planes(self):
+        directory = self.directory
+        self.assertEqual(self.planes, [
+            Plane(1, 0, Path(directory, "slide_overview_1000_500_ch0.tif"), [
+                Path(directory, "slide_overview_ch0_preview.png"),
+                Path(directory, "slide_overview_preview.png")], True),
+            Plane(3, 0, Path(directory, "slide_40x_01_4000_3000_ch0.tif"), [
+                Path(directory, "slide_40x_01_ch0_preview.png"),
+                Path(directory, "slide_40x_01_preview.png")], True),
+            Plane(3, 1, Path(directory, "slide_40x_01_4000_3000_ch1.tif"), [
+                Path(directory, "slide_40x_01_ch1_preview.png")], True),
+            Plane(0, None, Path(self.markers, "macro.tif"), [
+                Path(directory, "slide_macro.png")], False)])
+        self.assertTrue(is_pruned(self.markers.name))
+
+    def _mark(self, planes):
+        for plane in planes:
+            self.extractor._marker(self.markers, plane).touch() #pylint: disable=protected-access
+
+    def test_resume_finished(self):
+        self._mark(self.planes)
+        self.extractor.extract(self.dataset, self.xmlfile)
+        self.assertEqual(self.xmlfile.read_text(), VSI_XML)
+        self.assertFalse(self.markers.exists())
+
+    def test_resume_failed(self):
+        self._mark(self.planes[1:])
+        with self.assertRaises(ValueError): # Not a real VSI file
+            self.extractor.extract(self.dataset, self.xmlfile)
+        self.assertFalse(self.xmlfile.exists())
+        self.assertTrue(Path(self.markers, METADATA_FILE).exists())
+        self.assertEqual(len(list(self.markers.glob("*" + MARKER_SUFFIX))), 3)
+
+def fake_video2thumbnail(video, destination, position, info, size): #pylint: disable=unused-argument
+    """
+        Stands in for ffmpeg, the thumbnail is 100 bytes
+    """
+    thumbnail = Path(destination, "{}.png".format(video.stem))
+    thumbnail.write_bytes(b"\x00" * 100)
+    return thumbnail
+
+@mock.patch("video_thumbnail_store.video2thumbnail", side_effect=fake_video2thumbnail)
+class VideoThumbnailStoreTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.root = Path(temp.name)
+        self.video = Path(self.root, "video.mp4")
+        self.store = VideoThumbnailStore(self.root, budget=250)
+
+    def _used(self, thumbnail, when):
+        os.utime(thumbnail, (when, when))
+
+    def test_keys(self, _video2thumbnail):
+        self.assertEqual(thumbnail_key("abc", 0.5, 100), thumbnail_key("abc", 0.5, 100))
+        self.assertNotEqual(thumbnail_key("abc", 0.5, 100), thumbnail_key("abd", 0.5, 100))
+        self.assertNotEqual(thumbnail_key("abc", 0.5, 100), thumbnail_key("abc", 0.6, 100))
+        self.assertNotEqual(thumbnail_key("abc", 0.5, 100), thumbnail_key("abc", 0.5, 200))
+        for key in ["../../etc/passwd", "ab", "ABCDEF"]:
+            with self.assertRaises(ValueError):
+                self.store.path(key)
+
+    def test_made_once(self, video2thumbnail):
+        thumbnail = self.store.get(self.video, "abc")
+        self.assertEqual(thumbnail, self.store.path(thumbnail_key("abc")))
+        self.assertEqual(self.store.get(self.video, "abc"), thumbnail)
+        self.assertEqual(self.store.lookup(thumbnail_key("abc")), thumbnail)
+        video2thumbnail.assert_called_once()
+        self.assertIsNone(self.store.lookup(thumbnail_key("abd")))
+        self.assertEqual([path.name for path in self.root.glob(".*")], [])
+
+    def test_least_recently_used_evicted(self, _video2thumbnail):
+        first = self.store.get(self.video, "first")
+        second = self.store.get(self.video, "second")
+        self._used(first, 1000)
+        self._used(second, 2000)
+        self.assertEqual(self.store.lookup(thumbnail_key("first")), first) # Now the newest
+        third = self.store.get(self.video, "third") # 300 bytes, evicted down to 225
+        self.assertTrue(first.exists())
+        self.assertFalse(second.exists())
+        self.assertTrue(third.exists())
+
+    def test_counts_other_processes(self, _video2thumbnail):
+        first = self.store.get(self.video, "first")
+        self._used(first, 1000)
+        other = VideoThumbnailStore(self.root, budget=250)
+        other.get(self.video, "second")
+        other.get(self.video, "third")
+        self.assertFalse(first.exists())
+        self.assertEqual(self.store.evict(target=0), 2)
+        self.assertEqual(list(self.root.rglob("*" + THUMBNAIL_SUFFIX)), [])
+
+class IngestWatcherTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.root = Path(temp.name)
+        self.processor = mock.MagicMock()
+        self.processor.dataset_extensions.return_value = [".xtekct"]
+        self.processor.datasets_from_files.side_effect = lambda files: [
+            (None, fname) for fname in files]
+        self.watcher = IngestWatcher(self.processor, [self.root], settle_time=0)
+
+    def test_settled_grouped_by_folder(self):
+        datasets = [
+            Path(self.root, "b", "x.xtekct"), Path(self.root, "b", "c", "z.xtekct"),
+            Path(self.root, "b", "a.xtekct")]
+        for dataset in datasets:
+            dataset.parent.mkdir(parents=True, exist_ok=True)
+            dataset.touch()
+            self.watcher._pending[dataset] = 0 #pylint: disable=protected-access
+        self.watcher._process_settled() #pylint: disable=protected-access
+        ((files,), _) = self.processor.datasets_from_files.call_args
+        self.assertEqual(files, [datasets[2], datasets[0], datasets[1]])
+
+    def test_verify_checksums_passed_on(self):
+        watcher = IngestWatcher(
+            self.processor, [self.root], settle_time=0, workers=2, verify_checksums=True)
+        dataset = Path(self.root, "a.xtekct")
+        dataset.touch()
+        watcher._pending[dataset] = 0 #pylint: disable=protected-access
+        watcher._process_settled() #pylint: disable=protected-access
+        self.processor.process_datasets.assert_called_once_with([(None, dataset)], 2, True)
+        watcher.reconcile()
+        self.processor.process_directory.assert_called_once_with(self.root, 2, True)
+
+class FeedDirectoryTests(SimpleTestCase):
+    def test_submit_failure_releases_slot(self):
+        processor = DatasetProcessor()
+        executor = mock.Mock()
+        executor.submit.side_effect = RuntimeError("cannot schedule new futures after shutdown")
+        results = {}
+        datasets = [
+            (None, Path("/data", "a", "scan.xtekct")), (None, Path("/data", "b", "scan.xtekct"))]
+        with mock.patch.object(processor, "iterate_datasets", return_value=iter(datasets)):
+            feeder = threading.Thread(
+                target=processor._feed_directory, #pylint: disable=protected-access
+                args=(executor, Path("/data"), 1, False, results), daemon=True)
+            feeder.start()
+            feeder.join(timeout=10)
+        self.assertFalse(feeder.is_alive())
+        self.assertEqual(executor.submit.call_count, 1)
+        (ok, count, _) = results[Path("/data")]
+        self.assertFalse(ok)
+        self.assertEqual(count, 1)
+
+class TilePyramidTests(SimpleTestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.source = Path(temp.name, "image.tif")
+
+    def test_overview_tile(self):
+        self.assertEqual(overview_tile(DziInfo(300, 200, 128, 0, "png")), "7/0_0.png")
+        self.assertEqual(overview_tile(DziInfo(100, 300, 512, 0, "png")), "9/0_0.png")
+        self.assertEqual(overview_tile(DziInfo(1024, 1024, 512, 0, "png")), "9/0_0.png")
+
+    def test_make_pyramid(self):
+        pyvips.Image.black(300, 200).tiffsave(str(self.source))
+        dzi = make_pyramid(self.source, tile_size=128, min_size=100)
+        self.assertEqual(dzi, pyramid_dzi(self.source))
+        info = read_dzi(dzi)
+        self.assertEqual(info, DziInfo(300, 200, 128, 0, "png"))
+        overview = pyvips.Image.new_from_file(
+            str(Path(pyramid_tiles(self.source), overview_tile(info))))
+        self.assertEqual((overview.width, overview.height), (75, 50))
+        self.assertTrue(Path(pyramid_tiles(self.source), "9", "2_1.png").is_file())
+        self.assertFalse(Path(pyramid_tiles(self.source), "9", "3_0.png").exists())
+        self.assertEqual(
+            [fname.name for fname in self.source.parent.iterdir() if fname.name.startswith(".")],
+            [])
+
+    def test_scales_to_8_bit(self):
+        image = pyvips.Image.black(200, 200) + 1000
+        image.cast("ushort").tiffsave(str(self.source))
+        make_pyramid(self.source, tile_size=128, min_size=100)
+        tile = pyvips.Image.new_from_file(str(Path(pyramid_tiles(self.source), "8", "0_0.png")))
+        self.assertEqual((tile.format, tile.max()), ("uchar", 255))
+
+    def test_too_small(self):
+        pyvips.Image.black(100, 50).tiffsave(str(self.source))
+        self.assertIsNone(make_pyramid(self.source, tile_size=128, min_size=100))
+        self.assertFalse(has_pyramid(self.source))
+
+class TilePyramidViewTests(TestCase):
+    def setUp(self):
+        temp = TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        storage = NikonCTScan._meta.get_field("projection0deg").storage
+        patcher = mock.patch.object(storage, "location", temp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        server = Server.objects.create(host_name="test-server")
+        share = Share.objects.create(
+            name="test-share", server=server, linux_mnt_point=temp.name,
+            default_status=DATASET_ONLINE)
+        scanner = Machine.objects.create(name="test-scanner")
+        self.scan = NikonCTScan.objects.create(
+            scan_date=date(2026, 10, 17), scanner=scanner, share=share, path="scan",
+            filename="scan.xtekct", checksum="0" * 64, name="Test scan",
+            projection0deg="projections/scan.tif")
+        source = Path(temp.name, "projections", "scan.tif")
+        source.parent.mkdir()
+        pyvips.Image.black(300, 200).tiffsave(str(source))
+        make_pyramid(source, tile_size=128, min_size=100)
+        self.client.force_login(User.objects.create_user("staff", is_staff=True))
+
+    def _get(self, name):
+        return self.client.get(reverse(
+            "tile_pyramid", args=["nikonctscan", self.scan.pk, "projection0deg", name]))
+
+    def test_dzi(self):
+        response = self._get("image.dzi")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'TileSize="128"', b"".join(response.streaming_content))
+        self.assertIn("private", response["Cache-Control"])
+
+    def test_tile(self):
+        (viewer, tile) = pyramid_urls(self.scan, "projection0deg")
+        self.assertTrue(tile.endswith("/image_files/7/0_0.png"))
+        self.assertEqual(self.client.get(tile).status_code, 200)
+        self.assertEqual(self.client.get(viewer).status_code, 200)
+        self.assertEqual(self._get("image_files/9/2_1.png").status_code, 200)
+        self.assertEqual(self._get("image_files/9/3_0.png").status_code, 404)
+
+    def test_outside_pyramid(self):
+        for name in ["image_files/../scan.tif", "scan.tif", "image_files/9/info.txt", "scan.dzi"]:
+            with self.subTest(name=name):
+                self.assertEqual(self._get(name).status_code, 404)
+
+    def test_unknown_field(self):
+        response = self.client.get(reverse(
+            "tile_pyramid", args=["nikonctscan", self.scan.pk, "name", "image.dzi"]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self._get("image.dzi").status_code, 302)
+
+class AssociatedFileQueueTests(TestCase):
+    def setUp(self):
+        server = Server.objects.create(host_name="test-server")
+        share = Share.objects.create(
+            name="test-share", server=server, linux_mnt_point="/data",
+            default_status=DATASET_ONLINE)
+        scanner = Machine.objects.create(name="test-scanner")
+        self.scan = NikonCTScan.objects.create(
+            scan_date=date(2026, 10, 17), scanner=scanner, share=share, path="scan",
+            filename="scan.xtekct", checksum="0" * 64, name="Test scan")
+        self.parser = mock.Mock()
+        self.parser.associated_tasks.return_value = [("first", 10), ("second", 20)]
+        self.queue = AssociatedFileQueue()
+
+    def _task(self, name="first"):
+        return AssociatedFileTask.objects.get(scan=self.scan, task=name)
+
+    def _run(self, error=None):
+        """
+            Claim the first task and run it, failing with error if there is one
+            :return AssociatedFileTask: The task once run
+        """
+        AssociatedFileTask.objects.update(next_attempt=None)
+        task = self.queue.claim("test")
+        self.parser.run_associated_task.side_effect = error
+        with mock.patch.object(self.queue, "_parser_for", return_value=self.parser):
+            self.queue.run_task(task)
+        return self._task(task.task)
+
+    def test_enqueue(self):
+        self.queue.enqueue(self.scan, self.parser)
+        self.assertEqual(self._task().priority, 10 + ROUTINE_PRIORITY)
+        self.queue.enqueue(self.scan, self.parser, urgent=True)
+        self.assertEqual(self._task().priority, 10) # More urgent
+        self.queue.enqueue(self.scan, self.parser)
+        self.assertEqual(self._task().priority, 10) # Not made less urgent
+        self.assertEqual(AssociatedFileTask.objects.count(), 2)
+
+    def test_enqueue_running_marks_rerun(self):
+        self.queue.enqueue(self.scan, self.parser, urgent=True)
+        self.queue.claim("test")
+        self.queue.enqueue(self.scan, self.parser, urgent=True)
+        task = self._task()
+        self.assertEqual((task.status, task.rerun, task.attempts), (TASK_RUNNING, True, 1))
+
+    def test_enqueue_finished(self):
+        self.queue.enqueue(self.scan, self.parser)
+        AssociatedFileTask.objects.update(status=TASK_FAILED, attempts=3)
+        self.queue.enqueue(self.scan, self.parser, urgent=True)
+        task = self._task("second")
+        self.assertEqual((task.status, task.priority, task.attempts), (TASK_QUEUED, 20, 0))
+
+    def test_claim(self):
+        self.queue.enqueue(self.scan, self.parser)
+        AssociatedFileTask.objects.filter(task="first").update(
+            next_attempt=timezone.now() + timedelta(hours=1))
+        task = self.queue.claim("test")
+        self.assertEqual((task.task, task.status, task.attempts, task.worker),
+                         ("second", TASK_RUNNING, 1, "test"))
+        self.assertEqual(self._task("second").status, TASK_RUNNING)
+        self.assertIsNone(self.queue.claim("test")) # first isn't ready yet
+
+    def test_retries_then_fails(self):
+        self.queue.enqueue(self.scan, self.parser)
+        AssociatedFileTask.objects.filter(task="second").delete()
+        for attempt in range(1, DEFAULT_MAX_ATTEMPTS):
+            before = timezone.now()
+            task = self._run(ValueError("broken"))
+            self.assertEqual((task.status, task.attempts), (TASK_QUEUED, attempt))
+            self.assertIn("broken", task.output)
+            delay = timedelta(seconds=RETRY_DELAY * 2 ** (attempt - 1))
+            self.assertGreaterEqual(task.next_attempt, before + delay)
+            self.assertLessEqual(task.next_attempt, timezone.now() + delay)
+        task = self._run(ValueError("broken"))
+        self.assertEqual((task.status, task.attempts), (TASK_FAILED, DEFAULT_MAX_ATTEMPTS))
+        self.assertIsNone(task.next_attempt)
+        self.assertEqual(self.queue.count_failed(), 1)
+
+    def test_rerun_when_finished(self):
+        self.queue.enqueue(self.scan, self.parser, urgent=True)
+        task = self.queue.claim("test")
+        AssociatedFileTask.objects.filter(pk=task.pk).update(rerun=True)
+        with mock.patch.object(self.queue, "_parser_for", return_value=self.parser):
+            self.assertTrue(self.queue.run_task(task))
+        task = self._task()
+        self.assertEqual((task.status, task.rerun, task.attempts), (TASK_QUEUED, False, 0))
+        self.assertIsNone(task.next_attempt)
+
+    def test_done(self):
+        self.queue.enqueue(self.scan, self.parser, urgent=True)
+        task = self._run()
+        self.assertEqual((task.status, task.output), (TASK_DONE, None))
+        self.parser.run_associated_task.assert_called_once_with(self.scan, "first")
+
+    def test_reclaim_stale(self):
+        self.queue.enqueue(self.scan, self.parser)
+        self.queue.claim("test")
+        self.queue.claim("test")
+        AssociatedFileTask.objects.filter(task="first").update(
+            rerun=True, date_started=timezone.now() - timedelta(seconds=STALE_TIMEOUT + 60))
+        self.assertEqual(self.queue.reclaim_stale(), 1)
+        self.assertEqual((self._task().status, self._task().rerun), (TASK_QUEUED, False))
+        self.assertEqual(self._task("second").status, TASK_RUNNING)
+
+    def test_recheck(self):
+        tasks = XtekParser().associated_tasks()
+        self.assertEqual(self.queue.recheck(), len(tasks))
+        for (name, priority) in tasks:
+            task = self._task(name)
+            self.assertEqual(
+                (task.status, task.priority), (TASK_QUEUED, priority + ROUTINE_PRIORITY))
+        self.assertEqual(self.queue.recheck(), 0) # All queued now
+        (old, recent) = (tasks[0][0], tasks[1][0])
+        AssociatedFileTask.objects.update(
+            status=TASK_DONE, priority=5, date_completed=timezone.now())
+        AssociatedFileTask.objects.filter(task=old).update(
+            date_completed=timezone.now() - timedelta(seconds=RECHECK_INTERVAL + 60))
+        self.assertEqual(self.queue.recheck(), 1)
+        self.assertEqual(
+            (self._task(old).status, self._task(old).priority),
+            (TASK_QUEUED, 5 + ROUTINE_PRIORITY))
+        self.assertEqual(self._task(recent).status, TASK_DONE)
@@ -0,0 +1,104 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Find the tile pyramids of the images shown in the admin.
+    The pyramids are looked up by model, primary key and field so no paths appear in URLs.
+"""
+from pathlib import Path
+
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+
+from tile_pyramid import (
+    DZI_SUFFIX, TILES_SUFFIX, has_pyramid, overview_tile, pyramid_dzi, read_dzi)
+from .models import NikonCTScan, OmeData, OmePlane
+
+PYRAMID_NAME = "image" # The name of the pyramid in its URLs
+
+def _plane_tiff(plane):
+    """
+        :param OmePlane plane: The plane
+        :return Path: The full resolution TIFF alongside the VSI file
+    """
+    return Path(plane.image.scan.full_path().parent, plane.filename)
+
+def _stored_file(field):
+    """
+        :param string field: A file field
+        :return function: Gets the stored file of the field from an instance
+    """
+    def source(instance):
+        stored = getattr(instance, field)
+        return Path(stored.path) if stored else None
+    return source
+
+TILED_FIELDS = { # model name -> (model, {field: function returning the full size image})
+    "omeplane": (OmePlane, {"preview": _plane_tiff}),
+    "omedata": (OmeData, {"overview": _stored_file("overview")}),
+    "nikonctscan": (NikonCTScan, {
+        "projection0deg": _stored_file("projection0deg"),
+        "projection90deg": _stored_file("projection90deg"),
+    }),
+}
+
+def get_tile_source(model, pk, field): #pylint: disable=invalid-name
+    """
+        :param string model: The model name
+        :param int pk: The primary key of the instance
+        :param string field: The field shown
+        :return Path: The full size image the pyramid was made from
+    """
+    try:
+        (model_class, fields) = TILED_FIELDS[model]
+        find_source = fields[field]
+    except KeyError:
+        raise Http404("No tiles for {}.{}".format(model, field))
+    source = find_source(get_object_or_404(model_class, pk=pk))
+    if source is None:
+        raise Http404("No image")
+    return source
+
+def pyramid_urls(instance, field):
+    """
+        :param Model instance: The instance showing the image
+        :param string field: The field shown
+        :return (string, string): The URLs of the tile viewer and a single tile showing the
+            whole image, None if the image doesn't have a pyramid
+    """
+    model = instance._meta.model_name #pylint: disable=protected-access
+    find_source = TILED_FIELDS.get(model, (None, {}))[1].get(field)
+    if find_source is None:
+        return None
+    source = find_source(instance)
+    if source is None or not has_pyramid(source):
+        return None
+    args = [model, instance.pk, field]
+    tile = "{}{}/{}".format(
+        PYRAMID_NAME, TILES_SUFFIX, overview_tile(read_dzi(pyramid_dzi(source))))
+    return (
+        reverse("tile_viewer", args=args),
+        reverse("tile_pyramid", args=args + [tile]))
+
+def pyramid_dzi_url(model, pk, field): #pylint: disable=invalid-name
+    """
+        :param string model: The model name
+        :param int pk: The primary key of the instance
+        :param string field: The field shown
+        :return string: The URL of the description of the pyramid
+    """
+    return reverse("tile_pyramid", args=[model, pk, field, PYRAMID_NAME + DZI_SUFFIX])
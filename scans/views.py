@@ -18,9 +18,20 @@
 """
 import csv
 from datetime import timedelta
-from django.http import HttpResponse
-from django.shortcuts import render
+import ffmpeg
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, HttpResponse
+from django.shortcuts import get_object_or_404, render
 from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_safe
+from django.views.static import serve
+
+from tile_pyramid import (
+    DZI_SUFFIX, TILE_NAME, TILES_SUFFIX, has_pyramid, pyramid_dzi, pyramid_tiles)
+from .models import ScanAttachment
+from .tiles import PYRAMID_NAME, get_tile_source, pyramid_dzi_url
 # Create your views here.
 
 def scan_comparison_csv(queryset):
@@ -88,3 +99,55 @@ def calculate_transfer_times(queryset):
     total_line.append(timedelta(seconds=round(total_size / settings.TRANSFER_SPEED_USB3, 0)))
     dataset.append(total_line)
     return dataset
+
+@require_safe
+@staff_member_required
+def tile_viewer(request, model, pk, field): #pylint: disable=invalid-name
+    """
+        Browse an image a few tiles at a time
+    """
+    if not has_pyramid(get_tile_source(model, pk, field)):
+        raise Http404("No tiles")
+    context = admin.site.each_context(request)
+    context["title"] = "{} {} {}".format(model, pk, field)
+    context["dzi_url"] = pyramid_dzi_url(model, pk, field)
+    context["openseadragon_url"] = settings.OPENSEADRAGON_URL
+    return render(request, "admin/scans/tile_viewer.html", context=context)
+
+@require_safe
+@staff_member_required
+def tile_pyramid_file(request, model, pk, field, name): #pylint: disable=invalid-name
+    """
+        Serve the description or a tile of a pyramid.
+        Browsers may keep them for TILE_CACHE_SECONDS and revalidate them with
+        If-Modified-Since after that.
+    """
+    source = get_tile_source(model, pk, field)
+    tiles_prefix = PYRAMID_NAME + TILES_SUFFIX + "/"
+    if name == PYRAMID_NAME + DZI_SUFFIX:
+        path = pyramid_dzi(source).name
+    elif name.startswith(tiles_prefix) and TILE_NAME.fullmatch(name[len(tiles_prefix):]):
+        # Only tiles, nothing else alongside the source image
+        path = pyramid_tiles(source).name + "/" + name[len(tiles_prefix):]
+    else:
+        raise Http404("Not part of a pyramid")
+    response = serve(request, path, document_root=str(source.parent))
+    patch_cache_control(response, private=True, max_age=settings.TILE_CACHE_SECONDS)
+    return response
+
+@require_safe
+@staff_member_required
+def video_thumbnail(request, pk): #pylint: disable=invalid-name
+    """
+        Serve the thumbnail of a video attachment from the thumbnail store
+    """
+    attachment = get_object_or_404(ScanAttachment, pk=pk)
+    if not attachment.is_video():
+        raise Http404("Not a video")
+    try:
+        thumbnail = attachment.thumbnail()
+    except (ffmpeg.Error, ValueError, OSError):
+        raise Http404("Unable to make thumbnail")
+    response = FileResponse(open(thumbnail, "rb"), content_type="image/png")
+    patch_cache_control(response, private=True, max_age=settings.VIDEO_THUMBNAIL_CACHE_SECONDS)
+    return response
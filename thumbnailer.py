@@ -0,0 +1,126 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Make PNG thumbnails of images (projections etc) without loading them at full size.
+
+    vips thumbnail shrinks while loading, so the full resolution image is never held
+    in memory. Thresholding uses a percentile taken from a smaller copy of the image.
+    Single thumbnails are written to a directory the caller gives, batches are written
+    to a temporary directory which is removed when the with block using them ends.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import pyvips
+
+DEFAULT_SIZE = 1024 # Longest side of the thumbnail (pixels)
+PERCENTILE_SAMPLE_SIZE = 256 # Longest side of the copy used to find the percentile
+DEFAULT_WORKERS = 4
+
+class Thumbnailer():
+    """
+        Makes PNG thumbnails, one at a time or a batch at a time on a process pool
+    """
+
+    def __init__(
+            self, size=DEFAULT_SIZE, percent=100, workers=DEFAULT_WORKERS,
+            log_level=logging.WARNING):
+        """
+            :param int size: The longest side of the thumbnails, smaller images aren't enlarged
+            :param int percent: Show this percentile of the pixel values as white, 100 leaves
+                the values unchanged
+            :param int workers: The number of processes to make batches of thumbnails with
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Thumbnailer")
+        self._logger.setLevel(log_level)
+        if size < 1:
+            raise ValueError("Thumbnail size must be positive")
+        self._size = size
+        self._percent = percent
+        self._workers = workers
+
+    def thumbnail(self, filename, destination):
+        """
+            Make a single thumbnail in this process
+            :param Path filename: The image
+            :param Path destination: The directory to write the thumbnail to
+            :return Path: The thumbnail
+        """
+        self._logger.debug("Thumbnailing %s", filename)
+        return make_thumbnail(filename, destination, self._size, self._percent)
+
+    @contextmanager
+    def thumbnails(self, filenames):
+        """
+            Make thumbnails of many images in parallel
+            :param List filenames: The images (Path)
+            :return dict: image -> thumbnail (Path), or None if it failed. The thumbnails
+                are removed at the end of the with block
+        """
+        with TemporaryDirectory() as temp_dir:
+            jobs = [
+                (filename, Path(temp_dir, str(index)), self._size, self._percent)
+                for (index, filename) in enumerate(filenames)]
+            results = {}
+            if jobs:
+                self._logger.info(
+                    "Thumbnailing %d images with %d workers", len(jobs), self._workers)
+                with ProcessPoolExecutor(
+                        max_workers=self._workers,
+                        mp_context=multiprocessing.get_context("spawn")) as executor:
+                    for (job, thumbnail) in zip(jobs, executor.map(_thumbnail_job, jobs)):
+                        if thumbnail is None:
+                            self._logger.error("Unable to thumbnail %s", job[0])
+                        results[job[0]] = thumbnail
+            yield results
+
+def make_thumbnail(filename, destination, size=DEFAULT_SIZE, percent=100):
+    """
+        Make a PNG thumbnail of an image
+        :param Path filename: The image
+        :param Path destination: The directory to write the thumbnail to
+        :param int size: The longest side of the thumbnail
+        :param int percent: Show this percentile of the pixel values as white
+        :return Path: The thumbnail, named after the image
+    """
+    image = pyvips.Image.thumbnail(str(filename), size, size="down")
+    if 0 < percent < 100:
+        sample = pyvips.Image.thumbnail(str(filename), PERCENTILE_SAMPLE_SIZE, size="down")
+        upper_limit = max(sample.percent(percent), 1)
+        image = (image * (255 / upper_limit)).cast("uchar") # cast clips to 0-255
+    thumbnail = Path(destination, "{}.png".format(filename.stem))
+    image.write_to_file(str(thumbnail))
+    return thumbnail
+
+def _thumbnail_job(job):
+    """
+        Make a thumbnail in a worker process
+        :param tuple job: filename, destination, size and percent
+        :return Path: The thumbnail, None if it couldn't be made
+    """
+    (filename, destination, size, percent) = job
+    try:
+        destination.mkdir()
+        return make_thumbnail(filename, destination, size, percent)
+    except (pyvips.Error, OSError) as err:
+        logging.getLogger("Thumbnailer").debug(err)
+        return None
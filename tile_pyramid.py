@@ -0,0 +1,196 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Write Deep Zoom tile pyramids of large images so they can be browsed a few tiles at a time.
+
+    The pyramid of an image is written alongside it: <stem>.dzi describes it and
+    <stem>_files/<level>/<column>_<row>.png holds the tiles, level 0 being a single pixel.
+    The tiles are written first and the .dzi renamed into place last, so a pyramid with a
+    .dzi is complete.  Images that aren't 8 bit are scaled to 8 bit for display.
+"""
+import logging
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+from collections import namedtuple
+from math import ceil
+from pathlib import Path
+from sys import stdout, exit
+
+import pyvips
+
+TILE_SIZE = 512 # Pixels along each side of a tile
+TILE_FORMAT = "png"
+MIN_PYRAMID_SIZE = 1024 # Images with no side longer than this are shown whole
+SCALE_SAMPLE_SIZE = 1024 # Longest side of the copy used to scale images to 8 bit
+DZI_SUFFIX = ".dzi"
+TILES_SUFFIX = "_files"
+DZI_NS = {"dz": "http://schemas.microsoft.com/deepzoom/2008"}
+TILE_NAME = re.compile(r"[0-9]+/[0-9]+_[0-9]+\.{}".format(TILE_FORMAT)) # <level>/<column>_<row>
+
+DziInfo = namedtuple("DziInfo", ["width", "height", "tile_size", "overlap", "format"])
+
+def pyramid_dzi(source):
+    """
+        :param Path source: The full size image
+        :return Path: The description of its pyramid
+    """
+    return Path(source.parent, source.stem + DZI_SUFFIX)
+
+def pyramid_tiles(source):
+    """
+        :param Path source: The full size image
+        :return Path: The directory holding the tiles of its pyramid
+    """
+    return Path(source.parent, source.stem + TILES_SUFFIX)
+
+def has_pyramid(source):
+    """
+        :param Path source: The full size image
+        :return boolean: True if a complete pyramid has been written for it
+    """
+    return pyramid_dzi(source).is_file()
+
+def read_dzi(dzi):
+    """
+        :param Path dzi: The description of a pyramid
+        :return DziInfo
+    """
+    root = ET.parse(str(dzi)).getroot()
+    size = root.find("dz:Size", DZI_NS)
+    return DziInfo(
+        int(size.get("Width")),
+        int(size.get("Height")),
+        int(root.get("TileSize")),
+        int(root.get("Overlap")),
+        root.get("Format"))
+
+def overview_tile(info):
+    """
+        Find the tile showing the whole image at the largest size that fits in one tile
+        :param DziInfo info: The pyramid
+        :return string: The tile, relative to the tiles directory
+    """
+    longest = max(info.width, info.height)
+    top_level = (longest - 1).bit_length() # ceil(log2(longest)), the full size level
+    shrink = 0
+    while ceil(longest / 2 ** shrink) > info.tile_size:
+        shrink += 1
+    return "{}/0_0.{}".format(top_level - shrink, info.format)
+
+def make_pyramid(source, tile_size=TILE_SIZE, min_size=MIN_PYRAMID_SIZE):
+    """
+        Write the pyramid of an image, replacing any already there
+        :param Path source: The full size image
+        :param int tile_size: The size of the tiles
+        :param int min_size: Don't write a pyramid unless a side is longer than this
+        :return Path: The description of the pyramid, None if the image is too small
+    """
+    image = pyvips.Image.new_from_file(str(source), access="sequential")
+    if max(image.width, image.height) <= min_size:
+        return None
+    if image.format != "uchar":
+        sample = pyvips.Image.thumbnail(str(source), SCALE_SAMPLE_SIZE, size="down")
+        image = (image * (255 / max(sample.max(), 1))).cast("uchar") # cast clips to 0-255
+        # Otherwise a grey16 or rgb16 image is still saved as 16 bit tiles
+        image = image.copy(interpretation="b-w" if image.bands < 3 else "srgb")
+    partial = Path(source.parent, "." + source.stem)
+    image.dzsave(
+        str(partial), layout="dz", tile_size=tile_size, overlap=0,
+        suffix=".{}".format(TILE_FORMAT))
+    (dzi, tiles) = (pyramid_dzi(source), pyramid_tiles(source))
+    if dzi.exists():
+        dzi.unlink()
+    if tiles.exists():
+        shutil.rmtree(tiles)
+    os.rename(Path(partial.parent, partial.name + TILES_SUFFIX), tiles)
+    os.replace(Path(partial.parent, partial.name + DZI_SUFFIX), dzi)
+    return dzi
+
+class TilePyramidWriter():
+    """
+        Writes tile pyramids of images that are too big to be shown whole
+    """
+
+    def __init__(self, tile_size=TILE_SIZE, min_size=MIN_PYRAMID_SIZE, log_level=logging.WARNING):
+        """
+            :param int tile_size: The size of the tiles
+            :param int min_size: Don't write pyramids of images no bigger than this
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Tile pyramid writer")
+        self._logger.setLevel(log_level)
+        self._tile_size = tile_size
+        self._min_size = min_size
+
+    def write(self, source, replace=False):
+        """
+            Write the pyramid of an image
+            :param Path source: The full size image
+            :param boolean replace: Write it even if there already is one
+            :return Path: The description of the pyramid, None if the image is too small
+                or it couldn't be read
+        """
+        if not replace and has_pyramid(source):
+            self._logger.debug("%s already has a pyramid", source)
+            return pyramid_dzi(source)
+        self._logger.debug("Writing pyramid of %s", source)
+        try:
+            return make_pyramid(source, self._tile_size, self._min_size)
+        except pyvips.Error as err:
+            self._logger.error("Unable to write pyramid of %s: %s", source, err)
+            return None
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(description="Write Deep Zoom tile pyramids of images")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-r",
+        "--replace",
+        action="store_true",
+        help="Rewrite existing pyramids")
+    PARSER.add_argument(
+        "images",
+        action="store",
+        nargs="+",
+        help="The images, each pyramid is written alongside its image")
+    ARGS = PARSER.parse_args()
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    WRITER = TilePyramidWriter(log_level=LOG_LEVEL)
+    for IMAGE in ARGS.images:
+        print("{}: {}".format(IMAGE, WRITER.write(Path(IMAGE), ARGS.replace)))
+    exit(0)
@@ -29,6 +29,22 @@ fi
 source ../xrhms-env/bin/activate
 #apply the database updates needed
 ./manage.py migrate
+#install the tile viewer's javascript alongside the rest of the static content
+OPENSEADRAGON_VERSION=`./manage.py shell -c "from django.conf import settings; print(settings.OPENSEADRAGON_VERSION)"`
+if [ ! -f static/openseadragon/${OPENSEADRAGON_VERSION}/openseadragon.min.js ]
+then
+    OPENSEADRAGON_TMP=`mktemp -d`
+    curl -fsSL -o ${OPENSEADRAGON_TMP}/openseadragon.zip \
+        https://github.com/openseadragon/openseadragon/releases/download/v${OPENSEADRAGON_VERSION}/openseadragon-bin-${OPENSEADRAGON_VERSION}.zip &&
+    unzip -q ${OPENSEADRAGON_TMP}/openseadragon.zip -d ${OPENSEADRAGON_TMP} &&
+    mkdir -p static/openseadragon &&
+    mv ${OPENSEADRAGON_TMP}/openseadragon-bin-${OPENSEADRAGON_VERSION} static/openseadragon/${OPENSEADRAGON_VERSION}
+    if [ $? -ne 0 ]
+    then
+        echo "Unable to install OpenSeadragon, the tile viewer won't work"
+    fi
+    rm -rf ${OPENSEADRAGON_TMP}
+fi
 #collect all the static content into the required folder
 ./manage.py collectstatic
 sudo chgrp www-data -R static
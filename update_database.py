@@ -16,17 +16,28 @@
     See the License for the specific language governing permissions and
     limitations under the License.
 
-    Commandline script to scan a directory.
+    Commandline script to scan one or more directories.
     If a .xtekct or .xtekhelixct file is found then it is processed.
     If it's a new file then it is added into the database and where possible metadata generated
-    If it already exists then the checksum is checked to see if there have been any changes
+    If it already exists then the checksum is checked to see if there have been any changes.
+    The checksum is only recalculated if the size, modification time, inode or device of the
+    file has changed unless --verify-checksums is used
+    With --watch it keeps running and uses inotify to ingest datasets as they are written
+    --timings and --perfdata record where the time went during the run
+    When given several directories they are processed at the same time sharing the workers,
+    --root-workers and --root-limit stop one directory using all of them. --status records
+    the result for each directory so they can be reported separately.
+    --defer-associated-files leaves the slow work of storing the attachments, projections and
+    videos to process_associated_files.py
 """
 
 import logging
 from sys import stdout, exit
 from argparse import ArgumentParser
 from pathlib import Path
-from dataset_processor import DatasetProcessor
+from dataset_processor import DatasetProcessor, DEFAULT_WORKERS
+from ingest_timing import get_ingest_timings
+from ingest_watcher import IngestWatcher, DEFAULT_SETTLE_TIME, DEFAULT_RECONCILE_INTERVAL
 
 
 if __name__ == "__main__":
@@ -45,15 +56,93 @@ if __name__ == "__main__":
         "--verbose",
         action="store_true",
         help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of datasets to process concurrently (default: %(default)s)")
+    PARSER.add_argument(
+        "--root-workers",
+        action="store",
+        type=int,
+        help="Most datasets to process concurrently from any one directory (default: --workers)")
+    PARSER.add_argument(
+        "--root-limit",
+        action="append",
+        default=[],
+        metavar="DIRECTORY=N",
+        help="Override --root-workers for a single directory, can be repeated")
+    PARSER.add_argument(
+        "--status",
+        action="store",
+        help="Write a line per directory: directory<TAB>OK or FAILED<TAB>performance data")
+    PARSER.add_argument(
+        "--verify-checksums",
+        action="store_true",
+        help="Recalculate the checksum of every dataset even if the file appears unchanged")
+    PARSER.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and ingest datasets as they change rather than exiting")
+    PARSER.add_argument(
+        "--settle-time",
+        action="store",
+        type=int,
+        default=DEFAULT_SETTLE_TIME,
+        help="With --watch: seconds without changes before ingesting (default: %(default)s)")
+    PARSER.add_argument(
+        "--reconcile-interval",
+        action="store",
+        type=int,
+        default=DEFAULT_RECONCILE_INTERVAL,
+        help="With --watch: seconds between full passes of the directory (default: %(default)s)")
+    PARSER.add_argument(
+        "--timings",
+        action="store",
+        help="Write a JSON summary of the time spent in each stage to this file")
+    PARSER.add_argument(
+        "--perfdata",
+        action="store",
+        help="Write the time spent in each stage as Icinga performance data to this file")
+    PARSER.add_argument(
+        "--defer-associated-files",
+        action="store_true",
+        help=(
+            "Queue the attachments, projections and videos to be stored by " +
+            "process_associated_files.py rather than storing them now"))
     PARSER.add_argument(
         "directory",
         action="store",
-        help="The directory to scan for datasets")
+        nargs="+",
+        help="The directories to scan for datasets")
     PARSER.add_argument(
         "--version",
         action="version",
         version="%(prog)s 0.1")
     ARGS = PARSER.parse_args()
+    if ARGS.workers < 1:
+        PARSER.error("--workers must be at least 1")
+    DIRECTORIES = [Path(directory) for directory in ARGS.directory]
+    ROOT_WORKERS = {}
+    if ARGS.root_workers is not None:
+        if ARGS.root_workers < 1:
+            PARSER.error("--root-workers must be at least 1")
+        ROOT_WORKERS = {directory: ARGS.root_workers for directory in DIRECTORIES}
+    if ARGS.watch and (ARGS.status or ARGS.timings or ARGS.perfdata):
+        # Written at the end of a run, which --watch never reaches
+        PARSER.error("--status, --timings and --perfdata can't be used with --watch")
+    for LIMIT in ARGS.root_limit:
+        (LIMIT_DIRECTORY, _, LIMIT_WORKERS) = LIMIT.rpartition("=")
+        if Path(LIMIT_DIRECTORY) not in DIRECTORIES:
+            PARSER.error("--root-limit {} isn't one of the directories".format(LIMIT))
+        try:
+            ROOT_WORKERS[Path(LIMIT_DIRECTORY)] = int(LIMIT_WORKERS)
+        except ValueError:
+            PARSER.error("--root-limit must be DIRECTORY=N")
+        if ROOT_WORKERS[Path(LIMIT_DIRECTORY)] < 1:
+            PARSER.error("--root-limit must be at least 1")
     LOG_LEVEL = logging.WARN
     if ARGS.quiet:
         LOG_LEVEL = logging.ERROR
@@ -71,7 +160,40 @@ if __name__ == "__main__":
     logging.getLogger('sh.stream_bufferer').setLevel(logging.ERROR)
     logging.getLogger('sh.streamreader').setLevel(logging.ERROR)
     logging.getLogger('sh.command').setLevel(logging.ERROR)
-    PROCESSOR = DatasetProcessor(LOG_LEVEL)
-    if not PROCESSOR.process_directory(Path(ARGS.directory)):
+    PROCESSOR = DatasetProcessor(LOG_LEVEL, ARGS.defer_associated_files)
+    if ARGS.watch:
+        WATCHER = IngestWatcher(
+            PROCESSOR,
+            DIRECTORIES,
+            settle_time=ARGS.settle_time,
+            reconcile_interval=ARGS.reconcile_interval,
+            workers=ARGS.workers,
+            root_workers=ROOT_WORKERS,
+            verify_checksums=ARGS.verify_checksums,
+            log_level=LOG_LEVEL)
+        WATCHER.run()
+    TIMINGS = get_ingest_timings()
+    TIMINGS.reset()
+    if len(DIRECTORIES) == 1 and not ROOT_WORKERS:
+        PROCESS_OK = PROCESSOR.process_directory(
+            DIRECTORIES[0], ARGS.workers, ARGS.verify_checksums)
+        RESULTS = {DIRECTORIES[0]: (PROCESS_OK, None, None)}
+    else:
+        RESULTS = PROCESSOR.process_directories(
+            DIRECTORIES, ARGS.workers, ROOT_WORKERS, ARGS.verify_checksums)
+        PROCESS_OK = all(result[0] for result in RESULTS.values())
+    if ARGS.status:
+        with open(ARGS.status, "w") as STATUS_FILE:
+            for (DIRECTORY, (DIRECTORY_OK, _, ELAPSED)) in RESULTS.items():
+                STATUS_FILE.write("{}\t{}\t{}\n".format(
+                    DIRECTORY,
+                    "OK" if DIRECTORY_OK else "FAILED",
+                    TIMINGS.perfdata(DIRECTORY, ELAPSED)))
+    if ARGS.timings:
+        TIMINGS.write_json(ARGS.timings)
+    if ARGS.perfdata:
+        with open(ARGS.perfdata, "w") as PERFDATA_FILE:
+            PERFDATA_FILE.write(TIMINGS.perfdata())
+    if not PROCESS_OK:
         print("Errors occured during processing")
         exit(1)
@@ -0,0 +1,409 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Watermark and upload the public videos with pools of workers.
+
+    Encoding (ffmpeg) and uploading run in separate pools so uploads carry on while the
+    next videos are encoded.  Only a few more videos than there are workers are worked on
+    at once so encoded copies don't pile up in the temporary directory.  Each attachment
+    is leased while it is being worked on rather than holding one lock for the whole run,
+    so several runs can share the queue and the attachments of a run that died are picked
+    up again once their leases expire.  The serial uploader (public_video_uploader.py)
+    takes the same leases.  Only the main thread uses the database, the workers just run
+    ffmpeg and the uploads.  Uploading and sharing are retried separately so a failure to
+    share doesn't upload the video again.
+"""
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from pathlib import Path
+
+import ffmpeg
+from django.db.models import Q
+from django.utils import timezone
+
+from scans.models import ScanAttachment
+from xrh_utils import apply_overlay, publically_uploadable_video_type
+
+DEFAULT_ENCODE_WORKERS = 2
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 30 # Seconds before the first retry, doubled for each one after that
+LEASE_SECONDS = 2 * 60 * 60 # Longer than an encode or upload should ever take
+STAGE_ENCODE = "encode"
+STAGE_UPLOAD = "upload"
+
+def lease_owner():
+    """
+        :return string: Identifies this process as the holder of leases
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+def take_lease(pk, owner, **conditions): #pylint: disable=invalid-name
+    """
+        Take an attachment that hasn't been uploaded unless another run has it
+        :param int pk: The attachment
+        :param string owner: Who is taking it, see lease_owner
+        :param conditions: Any further filters the attachment must match
+        :return boolean: True if the lease was taken
+    """
+    now = timezone.now()
+    return bool(ScanAttachment.objects.filter(pk=pk, url__isnull=True, **conditions).filter(
+        Q(upload_lease_expires__isnull=True) | Q(upload_lease_expires__lt=now)).update(
+            upload_lease_owner=owner,
+            upload_lease_expires=now + timedelta(seconds=LEASE_SECONDS)))
+
+def renew_lease(pk, owner): #pylint: disable=invalid-name
+    """
+        Extend a lease before starting something else on the attachment
+        :param int pk: The attachment
+        :param string owner: The holder of the lease
+        :return boolean: False if the lease has been taken by someone else
+    """
+    return bool(ScanAttachment.objects.filter(pk=pk, upload_lease_owner=owner).update(
+        upload_lease_expires=timezone.now() + timedelta(seconds=LEASE_SECONDS)))
+
+def release_lease(pk, owner, **fields): #pylint: disable=invalid-name
+    """
+        Give up a lease, only if it is still held
+        :param int pk: The attachment
+        :param string owner: The holder of the lease
+        :param fields: Other fields to set at the same time (eg. url or to_upload)
+        :return boolean: False if the lease had been taken by someone else so nothing
+            was changed
+    """
+    return bool(ScanAttachment.objects.filter(pk=pk, upload_lease_owner=owner).update(
+        upload_lease_owner=None, upload_lease_expires=None, **fields))
+
+def overlay_corner(attachment):
+    """
+        :param ScanAttachment attachment: The attachment
+        :return (boolean, boolean): Whether the watermark goes at the top and the left,
+            None if it doesn't have one
+    """
+    if attachment.overlay_position == ScanAttachment.NONE:
+        return None
+    top = attachment.overlay_position not in [
+        ScanAttachment.BOTTOM_LEFT, ScanAttachment.BOTTOM_RIGHT]
+    left = attachment.overlay_position not in [
+        ScanAttachment.TOP_RIGHT, ScanAttachment.BOTTOM_RIGHT]
+    return (top, left)
+
+class _Item():
+    """
+        A leased attachment moving through the pipeline
+    """
+    def __init__(self, attachment, video, corner, info):
+        self.pk = attachment.pk #pylint: disable=invalid-name
+        self.title = attachment.name
+        self.video = video
+        self.corner = corner
+        self.info = info
+        self.attempts = 0 # Failed attempts at the current stage
+        self.temp_dir = None # Holds the watermarked copy
+        self.upload_file = None
+        self.file_id = None # Once uploaded, so a failure to share doesn't upload it again
+        self.upload_bytes = 0
+        self.encode_seconds = 0.0
+        self.upload_seconds = 0.0
+
+    def cleanup(self):
+        """
+            Remove the watermarked copy
+        """
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
+class UploadPipeline():
+    """
+        Watermarks and uploads the attachments waiting to be made public
+    """
+
+    def __init__(
+            self, drive_factory, overlay_image, encode_workers=DEFAULT_ENCODE_WORKERS,
+            upload_workers=DEFAULT_UPLOAD_WORKERS, retries=DEFAULT_RETRIES,
+            backoff=DEFAULT_BACKOFF, log_level=logging.WARNING):
+        """
+            :param function drive_factory: Returns an authenticated DriveUploader (or
+                LocalDriveUploader), each upload worker gets its own
+            :param Path overlay_image: The watermark
+            :param int encode_workers: The number of videos to watermark at once
+            :param int upload_workers: The number of videos to upload at once
+            :param int retries: How many times to retry each stage of a video
+            :param float backoff: Seconds to wait before the first retry
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Upload pipeline")
+        self._logger.setLevel(log_level)
+        if encode_workers < 1 or upload_workers < 1:
+            raise ValueError("Need at least one encode and one upload worker")
+        self._drive_factory = drive_factory
+        self._overlay_image = overlay_image
+        self._encode_workers = encode_workers
+        self._upload_workers = upload_workers
+        self._retries = retries
+        self._backoff = backoff
+        self._owner = lease_owner()
+        self._local = threading.local()
+        self._drive_lock = threading.Lock() # Authentication writes the credentials file
+        self._running = {} # future -> (stage, _Item)
+        self._delayed = [] # heap of (when, sequence, stage, _Item) waiting to retry
+        self._sequence = itertools.count()
+        self._metrics = {}
+
+    def run(self, records=None):
+        """
+            Upload everything waiting
+            :param List records: The primary keys of the attachments to upload
+                (default: all of those waiting)
+            :return dict: The metrics of the run
+        """
+        if records is None:
+            records = list(ScanAttachment.objects.filter(
+                url__isnull=True, to_upload=True).values_list("pk", flat=True))
+        queue = deque(records)
+        self._running = {}
+        self._delayed = []
+        self._metrics = {
+            "queued": len(records), "uploaded": 0, "failed": 0, "disabled": 0, "skipped": 0,
+            "retries": 0, "bytes": 0, "encode_seconds": 0.0, "upload_seconds": 0.0}
+        self._logger.info(
+            "Uploading %d videos with %d encode and %d upload workers",
+            len(records), self._encode_workers, self._upload_workers)
+        started = time.perf_counter()
+        capacity = self._encode_workers + self._upload_workers
+        in_flight = 0
+        with ThreadPoolExecutor(self._encode_workers) as encoders, \
+                ThreadPoolExecutor(self._upload_workers) as uploaders:
+            pools = {STAGE_ENCODE: encoders, STAGE_UPLOAD: uploaders}
+            while queue or self._running or self._delayed:
+                while self._delayed and self._delayed[0][0] <= time.monotonic():
+                    (_, _, stage, item) = heapq.heappop(self._delayed)
+                    self._submit(pools, stage, item)
+                while queue and in_flight < capacity:
+                    item = self._lease(queue.popleft())
+                    if item is not None:
+                        in_flight += 1
+                        self._submit(pools, STAGE_ENCODE, item)
+                timeout = None
+                if self._delayed:
+                    timeout = max(0, self._delayed[0][0] - time.monotonic())
+                if not self._running:
+                    if timeout is not None:
+                        time.sleep(timeout)
+                    continue
+                (done, _) = wait(list(self._running), timeout, FIRST_COMPLETED)
+                for future in done:
+                    (stage, item) = self._running.pop(future)
+                    if self._finished(future, stage, item, pools):
+                        in_flight -= 1
+        self._metrics["elapsed"] = time.perf_counter() - started
+        self._log_metrics()
+        return dict(self._metrics)
+
+    def _submit(self, pools, stage, item):
+        """
+            :param dict pools: stage -> ThreadPoolExecutor
+            :param string stage: The stage to run
+            :param _Item item: The attachment
+        """
+        work = self._encode if stage == STAGE_ENCODE else self._upload
+        self._running[pools[stage].submit(work, item)] = (stage, item)
+
+    def _finished(self, future, stage, item, pools):
+        """
+            Move an attachment on once a stage has finished
+            :param Future future: The stage
+            :param string stage: Which stage it was
+            :param _Item item: The attachment
+            :param dict pools: stage -> ThreadPoolExecutor
+            :return boolean: True if the attachment has left the pipeline
+        """
+        try:
+            result = future.result()
+        except (ValueError, FileNotFoundError) as err:
+            self._logger.error("Invalid value passed into uploader for %d", item.pk)
+            self._logger.warning(err)
+            self._release(item, disable=True) # Stop attempting it again
+            self._metrics["disabled"] += 1
+            return True
+        except Exception as err: #pylint: disable=broad-except
+            item.attempts += 1
+            if item.attempts > self._retries:
+                self._logger.error("Giving up on %d after %d attempts", item.pk, item.attempts)
+                self._logger.warning(err)
+                self._release(item)
+                self._metrics["failed"] += 1
+                return True
+            delay = self._backoff * 2 ** (item.attempts - 1)
+            self._logger.warning(
+                "Failed to %s %d (%s), retrying in %ds", stage, item.pk, err, delay)
+            self._renew(item)
+            heapq.heappush(
+                self._delayed, (time.monotonic() + delay, next(self._sequence), stage, item))
+            self._metrics["retries"] += 1
+            return False
+        item.attempts = 0
+        if stage == STAGE_ENCODE:
+            self._renew(item)
+            self._submit(pools, STAGE_UPLOAD, item)
+            return False
+        self._store_url(item, result)
+        return True
+
+    def _encode(self, item):
+        """
+            Watermark a video, run in an encode worker
+            :param _Item item: The attachment
+        """
+        started = time.perf_counter()
+        item.cleanup()
+        if item.corner is None:
+            item.upload_file = item.video
+        else:
+            self._logger.debug("Watermarking %s", item.video)
+            (top, left) = item.corner
+            (item.temp_dir, name) = apply_overlay(
+                item.video, self._overlay_image, top, left, info=item.info)
+            item.upload_file = Path(item.temp_dir.name, name)
+        item.encode_seconds += time.perf_counter() - started
+
+    def _upload(self, item):
+        """
+            Upload and share a video, run in an upload worker.  If it has already been
+            uploaded (and sharing it failed) it is only shared.
+            :param _Item item: The attachment
+            :return string: The public URL
+        """
+        drive = getattr(self._local, "drive", None)
+        if drive is None:
+            with self._drive_lock:
+                drive = self._drive_factory()
+            self._local.drive = drive
+        started = time.perf_counter()
+        try:
+            if item.file_id is None:
+                self._logger.debug("Uploading %s", item.upload_file)
+                item.file_id = drive.upload_file(item.title, item.upload_file)
+                item.upload_bytes = item.upload_file.stat().st_size
+            return drive.share(item.file_id)
+        finally:
+            item.upload_seconds += time.perf_counter() - started
+
+    def _lease(self, pk): #pylint: disable=invalid-name
+        """
+            Take an attachment for this run unless another run has it
+            :param int pk: The attachment
+            :return _Item: The attachment, None if it isn't available or can't be uploaded
+        """
+        if not take_lease(pk, self._owner, to_upload=True):
+            self._logger.debug("%d is already uploaded or leased", pk)
+            self._metrics["skipped"] += 1
+            return None
+        attachment = ScanAttachment.objects.get(pk=pk)
+        video = Path(attachment.attachment.path)
+        item = _Item(attachment, video, overlay_corner(attachment), None)
+        if not video.exists() or not publically_uploadable_video_type(video):
+            self._logger.error("%s is missing or not a video", video)
+            self._release(item, disable=True)
+            self._metrics["disabled"] += 1
+            return None
+        if item.corner is not None:
+            try:
+                item.info = attachment.video_info()
+            except (ffmpeg.Error, ValueError) as err:
+                self._logger.debug(err) # apply_overlay will report it
+        return item
+
+    def _renew(self, item):
+        """
+            Extend the lease on an attachment before starting something else on it
+            :param _Item item: The attachment
+        """
+        if not renew_lease(item.pk, self._owner):
+            self._logger.warning("Lease on %d has been taken by another run", item.pk)
+
+    def _release(self, item, disable=False):
+        """
+            Give up an attachment without uploading it
+            :param _Item item: The attachment
+            :param boolean disable: Clear to_upload so it isn't tried again
+        """
+        item.cleanup()
+        if item.file_id is not None:
+            self._logger.warning("Uploaded copy of %d (%s) not shared", item.pk, item.file_id)
+        if disable:
+            release_lease(item.pk, self._owner, to_upload=False)
+        else:
+            release_lease(item.pk, self._owner)
+
+    def _store_url(self, item, url):
+        """
+            Record the public URL of an uploaded attachment and release it
+            :param _Item item: The attachment
+            :param string url: The public URL
+        """
+        item.cleanup()
+        if not release_lease(item.pk, self._owner, url=url):
+            # Another run took over, it may have uploaded it as well
+            self._logger.error("Lost the lease on %d, not storing %s", item.pk, url)
+            self._metrics["failed"] += 1
+            return
+        self._logger.info("Uploaded %d to %s", item.pk, url)
+        self._metrics["uploaded"] += 1
+        self._metrics["bytes"] += item.upload_bytes
+        self._metrics["encode_seconds"] += item.encode_seconds
+        self._metrics["upload_seconds"] += item.upload_seconds
+
+    def _log_metrics(self):
+        """
+            Log the throughput of the run
+        """
+        metrics = self._metrics
+        elapsed = max(metrics["elapsed"], 1e-6)
+        metrics["videos_per_hour"] = metrics["uploaded"] * 3600 / elapsed
+        metrics["upload_bytes_per_second"] = metrics["bytes"] / elapsed
+        self._logger.info(
+            "Uploaded %d of %d videos (%d failed, %d disabled, %d skipped, %d retries) "
+            "in %.1fs: %.1f videos/hour, %.1f MiB/s",
+            metrics["uploaded"], metrics["queued"], metrics["failed"], metrics["disabled"],
+            metrics["skipped"], metrics["retries"], metrics["elapsed"],
+            metrics["videos_per_hour"], metrics["upload_bytes_per_second"] / (1024 * 1024))
+
+def perfdata(metrics):
+    """
+        Format the metrics of a run as Icinga/Nagios performance data
+        :param dict metrics: See UploadPipeline.run
+        :return string
+    """
+    return " ".join([
+        "'elapsed'={:.3f}s".format(metrics["elapsed"]),
+        "'uploaded'={:d}".format(metrics["uploaded"]),
+        "'failed'={:d}".format(metrics["failed"]),
+        "'retries'={:d}c".format(metrics["retries"]),
+        "'bytes'={:d}B".format(metrics["bytes"]),
+        "'encode_time'={:.3f}s".format(metrics["encode_seconds"]),
+        "'upload_time'={:.3f}s".format(metrics["upload_seconds"]),
+        "'videos_per_hour'={:.1f}".format(metrics["videos_per_hour"])])
@@ -24,7 +24,7 @@ source ../xrhms-env/bin/activate
 source /opt/xrh-scripts/icinga_submit.sh
 
 #update the database
-output=`./public_video_uploader.py -v  --scan --all 2>>/opt/xrhms-venv/logs/video_uploader.err | tee -a /opt/xrhms-venv/logs/video_uploader.log`
+output=`./public_video_uploader.py -v  --scan --all --pipeline 2>>/opt/xrhms-venv/logs/video_uploader.err | tee -a /opt/xrhms-venv/logs/video_uploader.log`
 update_status=$?
 echo $output
 icinga_submit $update_status "Video Upload" "$output"
@@ -0,0 +1,166 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Keep the thumbnails of videos so each video is only decoded once.
+
+    Thumbnails are named after a hash of what identifies the video (its checksum or
+    fingerprint), the position in the video and the size, so a changed video gets a new
+    thumbnail and the old one is left to be evicted.  Each thumbnail's modification time
+    is updated whenever it is used, and the least recently used are removed once the store
+    grows beyond its budget.  Thumbnails are written under a temporary name and renamed
+    so several processes can share the store.
+"""
+import hashlib
+import logging
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from xrh_utils import video2thumbnail
+
+DEFAULT_SIZE = 1024 # Longest side of the thumbnails (pixels)
+DEFAULT_POSITION = 0.5
+DEFAULT_BUDGET = 10 * 1024 * 1024 * 1024 # bytes
+EVICT_TO = 0.9 # Fraction of the budget to evict down to, so eviction isn't run every time
+THUMBNAIL_SUFFIX = ".png"
+
+def thumbnail_key(identity, position=DEFAULT_POSITION, size=DEFAULT_SIZE):
+    """
+        :param string identity: The checksum or fingerprint of the video
+        :param float position: 0 < position <= 1 position through the video
+        :param int size: The longest side of the thumbnail
+        :return string: The name of the thumbnail in the store
+    """
+    return hashlib.sha256(
+        "{}:{:.6f}:{}".format(identity, position, size).encode()).hexdigest()
+
+class VideoThumbnailStore():
+    """
+        A directory of video thumbnails with least recently used eviction
+    """
+
+    def __init__(self, root, budget=DEFAULT_BUDGET, log_level=logging.WARNING):
+        """
+            :param Path root: The directory holding the thumbnails
+            :param int budget: The most bytes the thumbnails may use
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Video thumbnail store")
+        self._logger.setLevel(log_level)
+        self._root = Path(root)
+        self._budget = budget
+        self._usage = None # Bytes used, found when first needed
+
+    def path(self, key):
+        """
+            :param string key: The name of the thumbnail (see thumbnail_key)
+            :return Path: Where the thumbnail is kept, spread over directories by the
+                start of the key
+        """
+        if len(key) < 3 or not all(char in "0123456789abcdef" for char in key):
+            raise ValueError("Invalid thumbnail key {}".format(key))
+        return Path(self._root, key[:2], key + THUMBNAIL_SUFFIX)
+
+    def lookup(self, key):
+        """
+            Find a thumbnail without making it
+            :param string key: The name of the thumbnail
+            :return Path: The thumbnail, None if it isn't in the store
+        """
+        thumbnail = self.path(key)
+        try:
+            os.utime(thumbnail) # Mark as recently used
+        except FileNotFoundError:
+            return None
+        return thumbnail
+
+    def get(self, video, identity, position=DEFAULT_POSITION, size=DEFAULT_SIZE, info=None):
+        """
+            Find a thumbnail, making it if it isn't in the store
+            :param Path video: The video
+            :param string identity: The checksum or fingerprint of the video
+            :param float position: 0 < position <= 1 position through the video
+            :param int size: The longest side of the thumbnail
+            :param VideoInfo info: The video's details if already known
+            :return Path: The thumbnail
+        """
+        key = thumbnail_key(identity, position, size)
+        thumbnail = self.lookup(key)
+        if thumbnail is not None:
+            self._logger.debug("Found thumbnail of %s", video)
+            return thumbnail
+        thumbnail = self.path(key)
+        thumbnail.parent.mkdir(parents=True, exist_ok=True)
+        self._logger.debug("Making thumbnail of %s", video)
+        with TemporaryDirectory(prefix=".", dir=str(self._root)) as temp_dir:
+            made = video2thumbnail(video, Path(temp_dir), position, info, size)
+            added = made.stat().st_size
+            os.replace(made, thumbnail)
+        self._added(added)
+        return thumbnail
+
+    def _added(self, nbytes):
+        """
+            Count a new thumbnail and evict the least recently used if over budget
+            :param int nbytes: The size of the new thumbnail
+        """
+        if self._usage is None:
+            self._usage = sum(size for (_, size, _) in self._thumbnails())
+        else:
+            self._usage += nbytes
+        if self._usage > self._budget:
+            self.evict()
+
+    def _thumbnails(self):
+        """
+            :return generator: (Path, size, last used) of every thumbnail in the store
+        """
+        for (dirpath, dirnames, filenames) in os.walk(str(self._root)):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")] # being made
+            for fname in filenames:
+                if not fname.endswith(THUMBNAIL_SUFFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, fname))
+                except FileNotFoundError:
+                    continue # Evicted by another process
+                yield (Path(dirpath, fname), stat.st_size, stat.st_mtime)
+
+    def evict(self, target=None):
+        """
+            Remove the least recently used thumbnails until the store is within its budget.
+            The whole store is listed so thumbnails added by other processes are counted.
+            :param int target: The most bytes to leave (default: EVICT_TO of the budget)
+            :return int: The number of thumbnails removed
+        """
+        if target is None:
+            target = int(self._budget * EVICT_TO)
+        thumbnails = sorted(self._thumbnails(), key=lambda thumbnail: thumbnail[2])
+        usage = sum(size for (_, size, _) in thumbnails)
+        removed = 0
+        for (thumbnail, size, _) in thumbnails:
+            if usage <= target:
+                break
+            try:
+                thumbnail.unlink()
+            except FileNotFoundError:
+                pass
+            usage -= size
+            removed += 1
+        self._logger.info("Evicted %d thumbnails, %d bytes used", removed, usage)
+        self._usage = usage
+        return removed
@@ -0,0 +1,567 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Read parts of a reconstructed volume (.vol/.raw) without loading all of it.
+
+    The volume is memory mapped so only the pages holding the voxels asked for are read.
+    The file is stored a slice (z) at a time, each slice a row (y) at a time, so XY slices
+    and slabs are contiguous, XZ slices need one row from every slice and YZ slices touch
+    every page.  Anything spanning many slices is read in chunks of slices so the memory
+    used doesn't depend on the size of the volume.
+    Volumes converted to a chunked store (see chunked_volume.py) are read the same way,
+    only the chunks holding the slices needed are read and decompressed.
+"""
+import logging
+import multiprocessing
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from math import floor
+from pathlib import Path
+from sys import stdout, exit
+
+import numpy
+import pyvips
+
+from chunked_volume import ChunkedArray, is_chunked_store
+from xrh_utils import read_vgi_bitdepth, read_vgi_size, vgi_from_vol
+
+AXIS_X = "x"
+AXIS_Y = "y"
+AXIS_Z = "z"
+AXES = [AXIS_X, AXIS_Y, AXIS_Z]
+
+PROJECTION_MIP = "mip"
+PROJECTION_MEAN = "mean"
+PROJECTION_STD = "std"
+PROJECTIONS = [PROJECTION_MIP, PROJECTION_MEAN, PROJECTION_STD]
+
+BITDEPTHS = { # bitdepth -> (numpy type, vips format)
+    8: (numpy.uint8, "uchar"),
+    16: (numpy.uint16, "ushort"),
+    32: (numpy.float32, "float"),
+}
+CHUNK_BYTES = 256 * 1024 * 1024 # Read at most this much of the volume at once
+STATS_CHUNK_BYTES = 16 * 1024 * 1024 # Smaller as counting needs several times this in memory
+DEFAULT_STATS_WORKERS = 4
+RANGES_PER_WORKER = 4 # Split the volume into this many ranges of slices per worker
+FLOAT_BINS = 65536 # Bins used to find the percentiles of float volumes
+FLOAT_SAMPLE_SLICES = 16 # Slices read to estimate the range of a float volume
+HISTOGRAM_BINS = 256 # Bins in the histogram returned
+WINDOW_PERCENTILES = (0.5, 99.5) # Percentiles used as black and white for previews
+
+class VolumeReader():
+    """
+        Memory mapped access to a reconstructed volume
+    """
+
+    def __init__(
+            self, filename, pixels_x=None, pixels_y=None, pixels_z=None, bitdepth=None,
+            header=0, log_level=logging.WARNING):
+        """
+            Anything not specified is read from the .vgi file alongside the volume, for a
+            chunked store everything is read from the store.
+            :param Path filename: The volume or chunked store
+            :param int pixels_x: Width of the volume
+            :param int pixels_y: Height of the volume
+            :param int pixels_z: Number of slices in the volume
+            :param int bitdepth: Bits per voxel (8, 16 or 32)
+            :param int header: Number of bytes before the first voxel
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Volume reader")
+        self._logger.setLevel(log_level)
+        self.filename = filename
+        self._header = header
+        store = None
+        if is_chunked_store(filename):
+            store = ChunkedArray(filename)
+            (pixels_z, pixels_y, pixels_x) = store.shape
+            bitdepth = store.dtype.itemsize * 8
+        elif bitdepth is None or None in (pixels_x, pixels_y, pixels_z):
+            vgi_file = vgi_from_vol(filename)
+            if bitdepth is None:
+                bitdepth = read_vgi_bitdepth(vgi_file)
+            if None in (pixels_x, pixels_y, pixels_z):
+                size = read_vgi_size(vgi_file)
+                if size is None:
+                    raise ValueError("Unable to find the size of {}".format(filename))
+                (pixels_x, pixels_y, pixels_z) = size
+        try:
+            (self.dtype, self.vips_format) = BITDEPTHS[bitdepth]
+        except KeyError:
+            self._logger.error("Unsupported bitdepth %r", bitdepth)
+            raise ValueError("Unsupported bitdepth {}".format(bitdepth))
+        self.bitdepth = bitdepth
+        (self.pixels_x, self.pixels_y, self.pixels_z) = (pixels_x, pixels_y, pixels_z)
+        self.bytes_per_slice = pixels_x * pixels_y * numpy.dtype(self.dtype).itemsize
+        if store is not None:
+            self.slices_available = pixels_z # stores are only created from complete volumes
+            self._volume = store
+        else:
+            # Reconstructions are written a slice at a time so only map the slices written
+            available = (filename.stat().st_size - header) // self.bytes_per_slice
+            self.slices_available = min(pixels_z, available)
+            if self.slices_available < 1:
+                raise ValueError("volume not yet complete")
+            self._volume = _open_volume(
+                filename, self.dtype, header, (self.slices_available, pixels_y, pixels_x))
+        self._logger.debug(
+            "Mapped %s %dx%dx%d (%d slices available) %d bit",
+            filename, pixels_x, pixels_y, pixels_z, self.slices_available, bitdepth)
+
+    def is_complete(self):
+        """
+            :return boolean: True if all of the slices have been written
+        """
+        return self.slices_available == self.pixels_z
+
+    def size(self, axis):
+        """
+            :param string axis: AXIS_X, AXIS_Y or AXIS_Z
+            :return int: The number of voxels along the axis
+        """
+        return {AXIS_X: self.pixels_x, AXIS_Y: self.pixels_y, AXIS_Z: self.pixels_z}[axis]
+
+    def index(self, axis, position):
+        """
+            Work out which slice is at a fractional position along an axis
+            :param string axis: AXIS_X, AXIS_Y or AXIS_Z
+            :param float position: value between 0 & 1
+            :return int: The slice
+        """
+        if not 0 <= position <= 1:
+            raise ValueError("Position {:02f} must be between 0 and 1".format(position))
+        size = self.size(axis)
+        return min(floor(position * size), size - 1)
+
+    def _check(self, axis, start, stop=None):
+        """
+            Check a range of slices can be read
+        """
+        if stop is None:
+            stop = start + 1
+        if not 0 <= start < stop <= self.size(axis):
+            raise ValueError("{}:{} is outside the volume along {}".format(start, stop, axis))
+        if axis == AXIS_Z and stop > self.slices_available:
+            self._logger.warning("Slice %d hasn't been reconstructed yet", stop - 1)
+            raise ValueError("volume not yet complete")
+        if axis != AXIS_Z and not self.is_complete():
+            raise ValueError("volume not yet complete")
+
+    def _z_chunk(self, bytes_per_slice):
+        """
+            :param int bytes_per_slice: The bytes needed from each slice
+            :return int: How many slices to read at once
+        """
+        return self._align(max(1, CHUNK_BYTES // max(1, bytes_per_slice)))
+
+    def _align(self, slices):
+        """
+            Round a number of slices up to whole chunks for a chunked store, so each chunk
+            is only decompressed once when reading through the volume
+            :param int slices: The number of slices
+            :return int
+        """
+        if isinstance(self._volume, ChunkedArray):
+            depth = self._volume.chunks[0]
+            return -(-slices // depth) * depth
+        return slices
+
+    def xy_slice(self, z):
+        """
+            :param int z: The slice
+            :return numpy.ndarray: The slice (y, x)
+        """
+        self._check(AXIS_Z, z)
+        return numpy.array(self._volume[z])
+
+    def xy_slab(self, start, stop):
+        """
+            For a raw volume the slices are mapped not read, only the pages used are read
+            :param int start: The first slice
+            :param int stop: The slice after the last one
+            :return numpy.ndarray: The slices (z, y, x)
+        """
+        self._check(AXIS_Z, start, stop)
+        return self._volume[start:stop]
+
+    def xz_slice(self, y):
+        """
+            :param int y: The row
+            :return numpy.ndarray: The row from every slice (z, x)
+        """
+        self._check(AXIS_Y, y)
+        return self._read_by_chunk(lambda chunk: chunk[:, y, :], (self.pixels_z, self.pixels_x))
+
+    def yz_slice(self, x):
+        """
+            :param int x: The column
+            :return numpy.ndarray: The column from every slice (z, y)
+        """
+        self._check(AXIS_X, x)
+        return self._read_by_chunk(lambda chunk: chunk[:, :, x], (self.pixels_z, self.pixels_y))
+
+    def slice(self, axis, position=0.5):
+        """
+            Get the slice at a fractional position along an axis
+            :param string axis: AXIS_X (YZ slice), AXIS_Y (XZ slice) or AXIS_Z (XY slice)
+            :param float position: value between 0 & 1
+            :return numpy.ndarray
+        """
+        index = self.index(axis, position)
+        if axis == AXIS_Z:
+            return self.xy_slice(index)
+        if axis == AXIS_Y:
+            return self.xz_slice(index)
+        return self.yz_slice(index)
+
+    def _read_by_chunk(self, select, shape, dtype=None):
+        """
+            Fill an array from each chunk of slices in turn
+            :param function select: Takes the chunk (z, y, x) and returns the part wanted
+            :param tuple shape: The shape of the result, the first dimension must be z
+            :param dtype: The type of the result (default: the type of the volume)
+            :return numpy.ndarray
+        """
+        result = numpy.empty(shape, dtype=dtype or self.dtype)
+        step = self._z_chunk(self.bytes_per_slice)
+        for start in range(0, self.pixels_z, step):
+            stop = min(start + step, self.pixels_z)
+            result[start:stop] = select(self._volume[start:stop])
+        return result
+
+    def slab(self, axis, start, stop, projection=PROJECTION_MIP):
+        """
+            Project a thick slab of the volume down to a single image
+            :param string axis: The axis to project along
+            :param int start: The first slice of the slab
+            :param int stop: The slice after the end of the slab
+            :param string projection: PROJECTION_MIP, PROJECTION_MEAN or PROJECTION_STD
+            :return numpy.ndarray: The type of the volume for MIP, float64 otherwise
+        """
+        if axis not in AXES:
+            raise ValueError("Unknown axis {}".format(axis))
+        if projection not in PROJECTIONS:
+            raise ValueError("Unknown projection {}".format(projection))
+        self._check(axis, start, stop)
+        if axis == AXIS_Z:
+            return self._z_slab(start, stop, projection)
+        reduce_axis = 1 if axis == AXIS_Y else 2
+        (length, size) = (
+            (self.pixels_y, self.pixels_x) if axis == AXIS_Y else (self.pixels_x, self.pixels_y))
+        dtype = self.dtype if projection == PROJECTION_MIP else numpy.float64
+
+        def select(chunk):
+            if axis == AXIS_Y:
+                chunk = chunk[:, start:stop, :]
+            else:
+                chunk = chunk[:, :, start:stop]
+            return _project(chunk, reduce_axis, projection)
+
+        self._logger.debug("%s slab along %s %d:%d of %d", projection, axis, start, stop, length)
+        return self._read_by_chunk(select, (self.pixels_z, size), dtype)
+
+    def _z_slab(self, start, stop, projection):
+        """
+            A slab of XY slices, the slices are combined a chunk at a time
+        """
+        shape = (self.pixels_y, self.pixels_x)
+        if projection == PROJECTION_MIP:
+            result = numpy.zeros(shape, dtype=self.dtype)
+            if self.dtype == numpy.float32:
+                result.fill(-numpy.inf)
+        else:
+            total = numpy.zeros(shape, dtype=numpy.float64)
+            total_sq = numpy.zeros(shape, dtype=numpy.float64)
+        step = self._z_chunk(self.bytes_per_slice)
+        for chunk_start in range(start, stop, step):
+            chunk = self._volume[chunk_start:min(chunk_start + step, stop)]
+            if projection == PROJECTION_MIP:
+                numpy.maximum(result, chunk.max(axis=0), out=result)
+            else:
+                chunk = chunk.astype(numpy.float64)
+                total += chunk.sum(axis=0)
+                if projection == PROJECTION_STD:
+                    total_sq += numpy.square(chunk).sum(axis=0)
+        if projection == PROJECTION_MIP:
+            return result
+        count = stop - start
+        mean = total / count
+        if projection == PROJECTION_MEAN:
+            return mean
+        return numpy.sqrt(numpy.maximum(total_sq / count - numpy.square(mean), 0))
+
+    def statistics(self, workers=DEFAULT_STATS_WORKERS, percentiles=WINDOW_PERCENTILES):
+        """
+            Work out the statistics of the whole volume in a single read through it.
+            Each worker process counts the values in its own range of slices, a chunk at a
+            time, and the counts are combined.  Integer volumes are counted exactly, float
+            volumes are counted in FLOAT_BINS bins over a range estimated from a sample of
+            the slices (anything outside is counted in the end bins).
+            :param int workers: The number of processes to read the volume with
+            :param tuple percentiles: The percentiles to find (0 - 100)
+            :return dict: min, max, mean, std, percentiles (percentile -> value) and
+                histogram (HISTOGRAM_BINS counts from min to max)
+        """
+        if not self.is_complete():
+            raise ValueError("volume not yet complete")
+        if self.dtype == numpy.float32:
+            (low, high) = self._sample_range()
+            bins = FLOAT_BINS
+        else:
+            (low, high) = (0, 2 ** self.bitdepth)
+            bins = 2 ** self.bitdepth
+        step = max(1, -(-self.pixels_z // (workers * RANGES_PER_WORKER)))
+        step = self._align(step)
+        jobs = [
+            (
+                str(self.filename), numpy.dtype(self.dtype).str, self._header,
+                (self.pixels_z, self.pixels_y, self.pixels_x), start,
+                min(start + step, self.pixels_z), (low, high), bins)
+            for start in range(0, self.pixels_z, step)]
+        counts = numpy.zeros(bins, dtype=numpy.int64)
+        (minimum, maximum, total, total_sq) = (None, None, 0.0, 0.0)
+        # Spawned rather than forked so they don't share the caller's DB connection
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            for result in executor.map(_count_values, jobs):
+                counts += result["counts"]
+                minimum = result["min"] if minimum is None else min(minimum, result["min"])
+                maximum = result["max"] if maximum is None else max(maximum, result["max"])
+                total += result["sum"]
+                total_sq += result["sum_sq"]
+        count = int(counts.sum())
+        edges = numpy.linspace(low, high, bins + 1)
+        if self.dtype != numpy.float32:
+            # Integer values are counted exactly so the sums can come from the counts
+            values = numpy.arange(bins, dtype=numpy.float64)
+            total = float((counts * values).sum())
+            total_sq = float((counts * numpy.square(values)).sum())
+        mean = total / count
+        stats = {
+            "min": float(minimum),
+            "max": float(maximum),
+            "mean": mean,
+            "std": float(numpy.sqrt(max(total_sq / count - mean * mean, 0))),
+            "percentiles": {
+                percentile: _percentile(counts, edges, percentile, minimum, maximum)
+                for percentile in percentiles},
+            "histogram": _rebin(counts, edges, minimum, maximum, HISTOGRAM_BINS),
+        }
+        self._logger.debug(
+            "Volume statistics min %f max %f mean %f", stats["min"], stats["max"], stats["mean"])
+        return stats
+
+    def _sample_range(self):
+        """
+            Estimate the range of values in a float volume from a few slices
+            :return (float, float)
+        """
+        sample = numpy.linspace(0, self.pixels_z - 1, FLOAT_SAMPLE_SLICES).astype(int)
+        (low, high) = (numpy.inf, -numpy.inf)
+        for z in numpy.unique(sample):
+            data = self._volume[z]
+            data = data[numpy.isfinite(data)]
+            if data.size:
+                (low, high) = (min(low, float(data.min())), max(high, float(data.max())))
+        if not numpy.isfinite(low):
+            return (0.0, 1.0)
+        if high <= low:
+            high = low + 1
+        return (low, high)
+
+    def to_vips(self, data):
+        """
+            Convert a slice or projection into a vips image
+            :param numpy.ndarray data: 2D array from this reader
+            :return pyvips.Image
+        """
+        if data.dtype == numpy.float64:
+            data = data.astype(numpy.float32)
+            vips_format = "float"
+        else:
+            vips_format = self.vips_format
+        data = numpy.ascontiguousarray(data)
+        (height, width) = data.shape
+        return pyvips.Image.new_from_memory(data.data, width, height, 1, vips_format)
+
+def _count_values(job):
+    """
+        Count the values in a range of slices, run in a worker process
+        :param tuple job: filename, dtype, header, shape, start, stop, (low, high), bins
+        :return dict: counts, min, max, sum and sum_sq (float volumes only)
+    """
+    (filename, dtype, header, shape, start, stop, value_range, bins) = job
+    volume = _open_volume(Path(filename), numpy.dtype(dtype), header, shape)
+    is_float = volume.dtype == numpy.float32
+    counts = numpy.zeros(bins, dtype=numpy.int64)
+    result = {"min": None, "max": None, "sum": 0.0, "sum_sq": 0.0}
+    bytes_per_slice = shape[1] * shape[2] * volume.dtype.itemsize
+    step = max(1, STATS_CHUNK_BYTES // bytes_per_slice)
+    if isinstance(volume, ChunkedArray):
+        step = -(-step // volume.chunks[0]) * volume.chunks[0] # Decompress each chunk once
+    for chunk_start in range(start, stop, step):
+        chunk = volume[chunk_start:min(chunk_start + step, stop)].ravel()
+        if is_float:
+            chunk = chunk[numpy.isfinite(chunk)]
+            if not chunk.size:
+                continue
+            values = chunk.astype(numpy.float64)
+            result["sum"] += float(values.sum())
+            result["sum_sq"] += float(numpy.square(values).sum())
+            counts += numpy.histogram(
+                numpy.clip(values, value_range[0], value_range[1]),
+                bins=bins,
+                range=value_range)[0]
+        else:
+            counts += numpy.bincount(chunk, minlength=bins)
+        (low, high) = (chunk.min(), chunk.max())
+        result["min"] = low if result["min"] is None else min(result["min"], low)
+        result["max"] = high if result["max"] is None else max(result["max"], high)
+    result["counts"] = counts
+    return result
+
+def _open_volume(filename, dtype, header, shape):
+    """
+        :param Path filename: The volume or chunked store
+        :param dtype: The type of the voxels
+        :param int header: Number of bytes before the first voxel
+        :param tuple shape: The slices to map (z, y, x)
+        :return: Something indexed along z that returns numpy arrays
+    """
+    if is_chunked_store(filename):
+        return ChunkedArray(filename)
+    return numpy.memmap(str(filename), dtype=dtype, mode="r", offset=header, shape=shape)
+
+def _percentile(counts, edges, percentile, minimum, maximum):
+    """
+        Find a percentile from the counts
+        :param numpy.ndarray counts: The number of values in each bin
+        :param numpy.ndarray edges: The edges of the bins
+        :param float percentile: The percentile to find (0 - 100)
+        :param float minimum: The smallest value
+        :param float maximum: The largest value
+        :return float
+    """
+    cumulative = numpy.cumsum(counts)
+    target = percentile / 100 * cumulative[-1]
+    index = min(int(numpy.searchsorted(cumulative, target)), len(counts) - 1)
+    return float(min(max(edges[index], minimum), maximum))
+
+def _rebin(counts, edges, minimum, maximum, bins):
+    """
+        Reduce the counts to fewer bins spanning just the values present
+        :param numpy.ndarray counts: The number of values in each bin
+        :param numpy.ndarray edges: The edges of the bins
+        :param float minimum: The smallest value
+        :param float maximum: The largest value
+        :param int bins: The number of bins wanted
+        :return List: The counts
+    """
+    if maximum <= minimum:
+        return [int(counts.sum())] + [0] * (bins - 1)
+    centres = numpy.clip((edges[:-1] + edges[1:]) / 2, minimum, maximum)
+    index = numpy.minimum(
+        ((centres - minimum) / (maximum - minimum) * bins).astype(int), bins - 1)
+    return [int(value) for value in numpy.bincount(index, weights=counts, minlength=bins)]
+
+def _project(chunk, axis, projection):
+    """
+        Project a chunk of the volume along an axis
+        :param numpy.ndarray chunk: Part of the volume
+        :param int axis: The numpy axis to project along
+        :param string projection: PROJECTION_MIP, PROJECTION_MEAN or PROJECTION_STD
+        :return numpy.ndarray
+    """
+    if projection == PROJECTION_MIP:
+        return chunk.max(axis=axis)
+    if projection == PROJECTION_MEAN:
+        return chunk.mean(axis=axis, dtype=numpy.float64)
+    return chunk.std(axis=axis, dtype=numpy.float64)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Extract a slice or slab projection from a reconstructed volume")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-a",
+        "--axis",
+        action="store",
+        choices=AXES,
+        default=AXIS_Z,
+        help="The axis to slice along, z gives an XY slice (default: %(default)s)")
+    PARSER.add_argument(
+        "-p",
+        "--position",
+        action="store",
+        type=float,
+        default=0.5,
+        help="Position of the slice along the axis, 0 to 1 (default: %(default)s)")
+    PARSER.add_argument(
+        "-t",
+        "--thickness",
+        action="store",
+        type=int,
+        default=1,
+        help="Thickness of the slab centred on the position in voxels (default: %(default)s)")
+    PARSER.add_argument(
+        "--projection",
+        action="store",
+        choices=PROJECTIONS,
+        default=PROJECTION_MIP,
+        help="How to project slabs thicker than one voxel (default: %(default)s)")
+    PARSER.add_argument(
+        "volume",
+        action="store",
+        help="The volume (.vol) with its .vgi alongside")
+    PARSER.add_argument(
+        "output",
+        action="store",
+        help="The image to write, the format is chosen from the extension")
+    ARGS = PARSER.parse_args()
+    if ARGS.thickness < 1:
+        PARSER.error("--thickness must be at least 1")
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    READER = VolumeReader(Path(ARGS.volume), log_level=LOG_LEVEL)
+    CENTRE = READER.index(ARGS.axis, ARGS.position)
+    if ARGS.thickness == 1:
+        DATA = READER.slice(ARGS.axis, ARGS.position)
+    else:
+        START = max(0, CENTRE - ARGS.thickness // 2)
+        STOP = min(READER.size(ARGS.axis), START + ARGS.thickness)
+        DATA = READER.slab(ARGS.axis, START, STOP, ARGS.projection)
+    READER.to_vips(DATA).write_to_file(ARGS.output)
+    exit(0)
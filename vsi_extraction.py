@@ -0,0 +1,285 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Extract the OME-XML, plane TIFFs and preview images from a VSI file.
+
+    The metadata is read first and the work split into one job per channel of each image
+    (plus the macro image).  The jobs run in a pool of processes, each one converting its
+    plane straight to TIFF with bfconvert and then making the previews from that TIFF, so
+    previews appear as soon as each plane is done rather than at the end.  A marker is
+    written for each finished plane so a conversion that is interrupted only redoes the
+    planes that weren't finished.  Each plane also gets a tile pyramid (see tile_pyramid.py)
+    for browsing it at full resolution.  The XML is moved into place last, its existence
+    means the whole file has been extracted.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from sys import stdout, exit
+
+import pyvips
+
+from ome_index import OmeIndex
+from tile_pyramid import make_pyramid
+
+SHOWINF_COMMAND = "/opt/bftools/showinf"
+BFCONVERT_COMMAND = "/opt/bftools/bfconvert"
+DEFAULT_WORKERS = 4
+PREVIEW_SIZE = 1024 # Longest side of the preview images (pixels)
+MACRO_IMAGE = "macro image"
+EXTRACTION_SUFFIX = "_extraction"
+MARKER_DIR = ".{}" + EXTRACTION_SUFFIX # Holds the metadata and markers while extracting
+METADATA_FILE = "metadata.xml"
+MARKER_SUFFIX = ".done"
+
+# One plane to extract: the series in the VSI file, the channel (None for all), the
+# TIFF to write, the previews to make from it and whether to make a tile pyramid of it
+Plane = namedtuple("Plane", ["series", "channel", "tiff", "previews", "pyramid"])
+
+def main_images(index):
+    """
+        Find the full resolution images in a file.
+        This works on the basis that each new image is the start of a new size pyramid
+        and therefore is larger in pixel count that the previous image found
+        :param OmeIndex index: The metadata of the VSI file
+        :return List: (series, ImageSummary) for each image, the macro image isn't included
+    """
+    images = []
+    last_size = 0
+    for (series, image) in enumerate(index.images):
+        size = image.size_x * image.size_y
+        if size > last_size:
+            if image.name == MACRO_IMAGE:
+                continue    #Handle this image seperately anyway
+            images.append((series, image))
+        last_size = size
+    return images
+
+class VsiExtractor():
+    """
+        Extracts the contents of VSI files a plane at a time on a process pool
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, preview_size=PREVIEW_SIZE,
+                 log_level=logging.WARNING):
+        """
+            :param int workers: The number of planes to extract at once
+            :param int preview_size: The longest side of the preview images
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("VSI extractor")
+        self._logger.setLevel(log_level)
+        self._workers = workers
+        self._preview_size = preview_size
+
+    @staticmethod
+    def marker_dir(dataset):
+        """
+            :param Path dataset: The VSI file
+            :return Path: The directory holding the progress of an extraction
+        """
+        return Path(dataset.parent, MARKER_DIR.format(dataset.stem))
+
+    def extract(self, dataset, xmlfile):
+        """
+            Extract everything that hasn't already been extracted
+            :param Path dataset: The VSI file
+            :param Path xmlfile: Where to write the OME-XML once everything else is done
+        """
+        markers = self.marker_dir(dataset)
+        markers.mkdir(exist_ok=True)
+        metadata = Path(markers, METADATA_FILE)
+        if not metadata.exists():
+            self._write_metadata(dataset, metadata)
+        planes = self._find_planes(dataset, OmeIndex.from_file(metadata, self._logger.level))
+        remaining = [plane for plane in planes if not self._marker(markers, plane).exists()]
+        self._logger.info(
+            "Extracting %d of %d planes from %s with %d workers",
+            len(remaining), len(planes), dataset, self._workers)
+        failed = 0
+        # Spawned rather than forked so they don't share the caller's DB connection
+        with ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            jobs = {
+                executor.submit(_extract_plane, dataset, plane, self._preview_size): plane
+                for plane in remaining}
+            for job in as_completed(jobs):
+                plane = jobs[job]
+                try:
+                    job.result()
+                except subprocess.CalledProcessError as output:
+                    self._logger.error("Failed to extract series %d of %s", plane.series, dataset)
+                    self._logger.debug("STDOUT: %s", output.stdout)
+                    self._logger.debug("STDERR: %s", output.stderr)
+                    failed += 1
+                    continue
+                except (pyvips.Error, OSError) as err:
+                    self._logger.error(
+                        "Failed to make previews or pyramid of %s: %s", plane.tiff, err)
+                    failed += 1
+                    continue
+                self._marker(markers, plane).touch()
+                self._logger.debug("Extracted %s", plane.tiff.name)
+        if failed:
+            raise ValueError("Failed to extract {} planes from {}".format(failed, dataset))
+        os.replace(metadata, xmlfile)
+        shutil.rmtree(markers)
+        self._logger.info("Extracted %s", dataset)
+
+    def _write_metadata(self, dataset, metadata):
+        """
+            Read the OME-XML from the VSI file without reading any pixels
+            :param Path dataset: The VSI file
+            :param Path metadata: Where to write it
+        """
+        self._logger.debug("Reading metadata from %s", dataset)
+        partial = Path(metadata.parent, metadata.name + ".part")
+        with open(partial, "wb") as fhandle:
+            subprocess.run(
+                [SHOWINF_COMMAND, "-nopix", "-omexml-only", "-no-upgrade", str(dataset)],
+                check=True,
+                stdout=fhandle,
+                stderr=subprocess.PIPE)
+        os.replace(partial, metadata)
+
+    def _find_planes(self, dataset, index):
+        """
+            Split the file into planes, named as VsiParser expects to find them
+            :param Path dataset: The VSI file
+            :param OmeIndex index: The metadata of the VSI file
+            :return List: Plane
+        """
+        directory = dataset.parent
+        stem = dataset.stem
+        planes = []
+        names = set()
+        for (series, image) in main_images(index):
+            if image.name in names:
+                continue # Only the first image with a name is stored
+            names.add(image.name)
+            base = "{}_{}".format(stem, image.name)
+            for channel in range(max(1, image.channels)):
+                previews = [Path(directory, "{}_ch{}_preview.png".format(base, channel))]
+                if channel == 0:
+                    previews.append(Path(directory, "{}_preview.png".format(base)))
+                planes.append(Plane(
+                    series,
+                    channel,
+                    Path(directory, "{}_{}_{}_ch{}.tif".format(
+                        base, image.size_x, image.size_y, channel)),
+                    previews,
+                    True))
+        for (series, image) in enumerate(index.images):
+            if image.name == MACRO_IMAGE:
+                planes.append(Plane(
+                    series,
+                    None,
+                    Path(self.marker_dir(dataset), "macro.tif"),
+                    [Path(directory, "{}_macro.png".format(stem))],
+                    False))
+                break
+        return planes
+
+    @staticmethod
+    def _marker(markers, plane):
+        """
+            :param Path markers: The directory holding the progress of an extraction
+            :param Plane plane: A plane
+            :return Path: The file that shows the plane has been extracted
+        """
+        channel = "all" if plane.channel is None else plane.channel
+        return Path(markers, "{}_{}{}".format(plane.series, channel, MARKER_SUFFIX))
+
+def _extract_plane(dataset, plane, preview_size):
+    """
+        Write a plane to TIFF and make its previews and pyramid, run in a worker process.
+        Everything is written under a temporary name and renamed once complete.
+        :param Path dataset: The VSI file
+        :param Plane plane: The plane to extract
+        :param int preview_size: The longest side of the previews
+    """
+    command = [BFCONVERT_COMMAND, "-no-upgrade", "-overwrite", "-bigtiff", "-series",
+               str(plane.series)]
+    if plane.channel is not None:
+        command += ["-channel", str(plane.channel)]
+    partial = Path(plane.tiff.parent, "." + plane.tiff.name) # Keeps the .tif for bfconvert
+    subprocess.run(
+        command + [str(dataset), str(partial)],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    os.replace(partial, plane.tiff)
+    image = pyvips.Image.thumbnail(str(plane.tiff), preview_size, size="down")
+    if image.format != "uchar":
+        image = image.scaleimage()
+    for preview in plane.previews:
+        partial = Path(preview.parent, "." + preview.name)
+        image.write_to_file(str(partial))
+        os.replace(partial, preview)
+    if plane.pyramid:
+        make_pyramid(plane.tiff)
+
+if __name__ == "__main__":
+    PARSER = ArgumentParser(
+        description="Extract the OME-XML, plane TIFFs and previews from a VSI file")
+    LOGGING_OUTPUT = PARSER.add_mutually_exclusive_group()
+    LOGGING_OUTPUT.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress most ouput")
+    LOGGING_OUTPUT.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Maximum verbosity output on command line")
+    PARSER.add_argument(
+        "-w",
+        "--workers",
+        action="store",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="The number of planes to extract at once (default: {})".format(DEFAULT_WORKERS))
+    PARSER.add_argument(
+        "dataset",
+        action="store",
+        help="The VSI file, the outputs are written alongside it")
+    ARGS = PARSER.parse_args()
+    LOG_LEVEL = logging.INFO
+    if ARGS.quiet:
+        LOG_LEVEL = logging.ERROR
+    elif ARGS.verbose:
+        LOG_LEVEL = logging.DEBUG
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        stream=stdout,
+        format='%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s')
+    DATASET = Path(ARGS.dataset)
+    try:
+        VsiExtractor(ARGS.workers, log_level=LOG_LEVEL).extract(
+            DATASET, Path(DATASET.parent, DATASET.stem + ".xml"))
+    except (ValueError, subprocess.CalledProcessError) as ERR:
+        logging.error(ERR)
+        exit(1)
+    exit(0)
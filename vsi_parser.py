@@ -19,14 +19,17 @@
     Handle VSI files from the microscopes
 """
 import logging
-import xml.etree.ElementTree as ET
 from pathlib import Path
 import subprocess
 from datetime import datetime
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.files import File
+from django.db import transaction
 
 from xrh_utils import (
     calculate_file_hash,
+    file_fingerprint,
 )
 
 
@@ -43,9 +46,19 @@ from scans.models import (
 
 
 from dataset_parser import DatasetParser
-
-NS = {"ome":"http://www.openmicroscopy.org/Schemas/OME/2016-06"} # namespace within the XML to us
-CONVERTER_COMMAND = "/opt/xrh-scripts/vsi_extractor.py"
+from scans.bulk_resolver import BulkRecordResolver
+from ome_index import NS, OmeIndex, stream_images
+from vsi_extraction import VsiExtractor, main_images
+from tile_pyramid import TilePyramidWriter
+from ingest_timing import (
+    STAGE_ATTACHMENTS,
+    STAGE_DB_WRITE,
+    STAGE_HASHING,
+    STAGE_PREVIEWS,
+    STAGE_TILE_PYRAMIDS,
+    STAGE_VSI_EXTRACTION,
+    STAGE_XML_PARSING,
+)
 
 
 class VsiParser(DatasetParser):
@@ -54,14 +67,42 @@ class VsiParser(DatasetParser):
         Handle VSI files
     """
     EXTENSIONS = [".vsi"]
+    ASSOCIATED_TASKS = {
+        "overview": 10,
+        "attachments": 20,
+        "tile_pyramids": 30,
+    }
 
     def __init__(self, log_level=logging.WARN):
         super().__init__(log_level)
         self._logger = logging.getLogger("Vsi Parser")
         self._logger.level = log_level
-        self._detectors = {}
-        self._objectives = {}
-        self._xml_root = None
+        self._detectors = {} # ID in the XML -> OmeDetector
+        self._objectives = {} # ID in the XML -> OmeObjective
+        self._ome_index = None
+        self._extractor = VsiExtractor(settings.VSI_EXTRACTION_WORKERS, log_level=log_level)
+        self._pyramids = TilePyramidWriter(log_level=log_level)
+        # The same few detectors, objectives and channels are used for every file so keep
+        # them for the whole run, there are too many planes to be worth keeping
+        self._detector_resolver = BulkRecordResolver(
+            OmeDetector,
+            ["manufacturer", "model", "gain", "serial_number", "detector_type"],
+            log_level=log_level)
+        self._objective_resolver = BulkRecordResolver(
+            OmeObjective,
+            ["lens_na", "model", "nominal_magnification", "working_distance"],
+            log_level=log_level)
+        self._channel_resolver = BulkRecordResolver(
+            OmeChannel,
+            [
+                "name", "channel_id", "emission_wavelength", "binning", "detector_id",
+                "detector_gain", "samples_per_pixel"],
+            log_level=log_level)
+        self._plane_resolver = BulkRecordResolver(
+            OmePlane,
+            ["image_id", "channel_id", "exposure", "position_x", "position_y", "z", "t"],
+            cache=False,
+            log_level=log_level)
 
     def extensions(self):
         return self.EXTENSIONS
@@ -90,23 +131,15 @@ class VsiParser(DatasetParser):
             This works on the basis that each new image is the start of a new size pyramid
             and therefore is larger in pixel count that the previous image found
         """
-        images = []
-        last_size = 0
-        for image in self._xml_root.findall("ome:Image", NS):
-            pixels = image.find("ome:Pixels", NS)
-            size_x = int(pixels.get("SizeX"))
-            size_y = int(pixels.get("SizeY"))
-            size = size_x * size_y
-            if size > last_size:
-                img_name = image.get("Name")
-                if img_name == "macro image":
-                    continue    #Handle this image seperately anyway
-                images.append(image.get("Name"))
-            last_size = size
-        return images
+        return [image.name for (_, image) in main_images(self._ome_index)]
 
     def _process_instruments(self):
-        for instrument in self._xml_root.findall("ome:Instrument", NS):
+        """
+            Find the detectors and objectives used, creating any that are new
+        """
+        (detector_ids, detectors) = ([], [])
+        (objective_ids, objectives) = ([], [])
+        for instrument in self._ome_index.instruments:
             for detector_xml in instrument.findall("ome:Detector", NS):
                 detector_id = detector_xml.attrib["ID"]
                 try:
@@ -126,10 +159,13 @@ class VsiParser(DatasetParser):
                 except KeyError:
                     detector_type = None
                     self._logger.warning("No detector type found")
-                detector = self._find_detector(
-                    detector_manufacturer, detector_model, gain=detector_gain,
-                    serial_number=detector_serialno, detector_type=detector_type)
-                self._detectors[detector_id] = detector
+                detector_ids.append(detector_id)
+                detectors.append({
+                    "manufacturer": detector_manufacturer,
+                    "model": detector_model,
+                    "gain": detector_gain,
+                    "serial_number": detector_serialno,
+                    "detector_type": detector_type})
             for objective_xml in instrument.findall("ome:Objective", NS):
                 objective_model = objective_xml.attrib["Model"]
                 objective_id = objective_xml.attrib["ID"]
@@ -154,37 +190,30 @@ class VsiParser(DatasetParser):
                 except KeyError:
                     self._logger.warning("No nominal magnification found")
                     objective_nominal_magnification = None
-                objective = self._find_objective(
-                    objective_lens_na, objective_model,
-                    objective_nominal_magnification, objective_working_distance)
-                self._objectives[objective_id] = objective
+                objective_ids.append(objective_id)
+                objectives.append({
+                    "lens_na": objective_lens_na,
+                    "model": objective_model,
+                    "nominal_magnification": objective_nominal_magnification,
+                    "working_distance": objective_working_distance})
+        self._detectors = dict(zip(detector_ids, self._detector_resolver.resolve(detectors)))
+        self._objectives = dict(zip(objective_ids, self._objective_resolver.resolve(objectives)))
 
     def _find_scanning_time(self, name=None):
-        annotations = self._xml_root.find(
-            "ome:StructuredAnnotations", NS).findall("ome:XMLAnnotation", NS)
         if name:
             self._logger.debug("Looking for scanning time for image %s", name)
             search_term = "{} Scanning Time (seconds)".format(name)
             self._logger.debug("Search term = %s", search_term)
-            for annotation in annotations:
-                if (
-                        annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS)
-                        .find("ome:Key", NS).text.startswith(search_term)):
-                    return float(
-                        annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS).
-                        find("ome:Value", NS).text.strip("[]"))
+            found = self._ome_index.metadata_prefix(search_term)
+            if found:
+                return float(found[1].strip("[]"))
             self._logger.warning("Failed to find scan time for %s", name)
             return -1
         self._logger.debug("Looking for scanning time")
-        count = 0
-        for annotation in annotations:
-            count += 1
-            if annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS) \
-                    .find("ome:Key", NS).text == "Scanning Time (seconds)":
-                return float(
-                    annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS).
-                    find("ome:Value", NS).text.strip("[]"))
-        self._logger.warning("Failed to find scan time for file in %d annotations", count)
+        value = self._ome_index.metadata("Scanning Time (seconds)")
+        if value is not None:
+            return float(value.strip("[]"))
+        self._logger.warning("Failed to find scan time for file")
         return -1
 
     def _find_channel_exposure_time_fix(self, image, channel=None):
@@ -194,44 +223,31 @@ class VsiParser(DatasetParser):
             :param string channel: The nameof the channel to find the exposure time for
             :return int: The exposure time (s)(negative if unable to find it)
         """
-        annotations = self._xml_root.find("ome:StructuredAnnotations", NS) \
-            .findall("ome:XMLAnnotation", NS)
         exposure = None
         if not channel or channel == "":
             search_string = "{} Microscope Exposure time (microseconds)".format(image)
             self._logger.debug("No channel name specified, searching for %s", search_string)
-            for annotation in annotations:
-                if (annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS)
-                        .find("ome:Key", NS).text.startswith(search_string)):
-                    exposure = float(annotation.find("ome:Value", NS) \
-                        .find("ome:OriginalMetadata", NS)
-                    .find("ome:Value", NS).text)
-                    break
+            found = self._ome_index.metadata_prefix(search_string)
+            if found:
+                exposure = float(found[1])
         else:
             self._logger.debug(
                 "Looking for exposure time for channel %s in image %s", channel, image)
             search_string = "{} Channel name".format(image)
             self._logger.debug("Search string: %s", search_string)
             target_id = None
-            for annotation in annotations:
-                if(annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS)
-                        .find("ome:Value", NS).text == channel):
-                    key = annotation.find("ome:Value", NS).find(
-                        "ome:OriginalMetadata", NS).find("ome:Key", NS).text
-                    if search_string in key:
-                        target_id = key.split()[-1]
-                        break
+            for key in self._ome_index.keys_with_value(channel):
+                if search_string in key:
+                    target_id = key.split()[-1]
+                    break
             if not target_id:
                 self._logger.warning("Failed to find exposure time for %s", search_string)
                 return -2
             search_string = "{} Microscope Exposure time (microseconds) {}".format(image, target_id)
             self._logger.debug("Search string: %s", search_string)
-            for annotation in annotations:
-                if (annotation.find("ome:Value", NS).find("ome:OriginalMetadata", NS)
-                        .find("ome:Key", NS).text == search_string):
-                    exposure = float(annotation.find("ome:Value", NS) \
-                        .find("ome:OriginalMetadata", NS)
-                        .find("ome:Value", NS).text)
+            value = self._ome_index.metadata(search_string)
+            if value is not None:
+                exposure = float(value)
         if exposure:
             self._logger.debug("Found exposure %d microseconds", exposure)
             return exposure / 1000000
@@ -239,7 +255,14 @@ class VsiParser(DatasetParser):
         return -3
 
 
-    def _process_image(self, name, scan_data):
+    def _process_image(self, image_xml, scan_data):
+        """
+            Create or update the records for an image along with its channels and planes
+            :param Element image_xml: The Image element
+            :param OmeData scan_data: The scan the image is part of
+            :return OmeImage
+        """
+        name = image_xml.get("Name")
         try:
             image_obj = OmeImage.objects.get(scan=scan_data, name=name)
             self._logger.debug("Found existing object (%d)", image_obj.pk)
@@ -247,13 +270,6 @@ class VsiParser(DatasetParser):
             image_obj = OmeImage()
             image_obj.scan = scan_data
             image_obj.name = name
-        image_xml = None
-        for image in self._xml_root.findall("ome:Image", NS):
-            if image.get("Name") == name:
-                image_xml = image
-                break
-        if image_xml is None:
-            raise ValueError("Unable to find image with required name")
         image_obj.image_id = image_xml.get("ID")
         image_obj.objective = self._objectives[
             image_xml.find("ome:ObjectiveSettings", NS).attrib["ID"]]
@@ -284,7 +300,7 @@ class VsiParser(DatasetParser):
             image_obj.pixels_y)
         image_obj.scan_time = self._find_scanning_time(name)
         image_obj.save()    #generate PK for image object so other things can link to it
-        channels = {}
+        (channel_ids, channel_values) = ([], [])
         for channel_xml in pixels_xml.findall("ome:Channel", NS):
             try:
                 channel_name = channel_xml.attrib["Name"]
@@ -300,26 +316,33 @@ class VsiParser(DatasetParser):
                 channel_emmision_wavelength = None
             channel_detector_settings = channel_xml.find("ome:DetectorSettings", NS).attrib
             channel_binning = channel_detector_settings["Binning"]
-            channel_detector = self._detectors[channel_detector_settings["ID"]]
+            channel_detector = self._detectors[channel_detector_settings["ID"]].pk
             try:
                 channel_detector_gain = float(channel_detector_settings["Gain"])
             except KeyError:
                 channel_detector_gain = None
             channel_samples_per_pixel = int(channel_xml.attrib["SamplesPerPixel"])
-            channel = self._find_channel(
-                channel_name, channel_id, channel_emmision_wavelength,
-                channel_binning, channel_detector, channel_detector_gain, channel_samples_per_pixel)
-            channels[channel_id.split(":")[-1]] = channel
+            channel_ids.append(channel_id.split(":")[-1])
+            channel_values.append({
+                "name": channel_name,
+                "channel_id": channel_id,
+                "emission_wavelength": channel_emmision_wavelength,
+                "binning": channel_binning,
+                "detector_id": channel_detector,
+                "detector_gain": channel_detector_gain,
+                "samples_per_pixel": channel_samples_per_pixel})
+        channels = dict(zip(channel_ids, self._channel_resolver.resolve(channel_values)))
         self._logger.info("Processed %d channels", len(channels))
+        exposures = {} # channel name -> exposure
+        (plane_channels, plane_values) = ([], [])
         for plane_xml in pixels_xml.findall("ome:Plane", NS):
             plane_channel = channels[plane_xml.attrib["TheC"]]
             channel_name = plane_channel.name
             self._logger.debug("Plane channel name %s", channel_name)
-            image_name = image_obj.name
-            self._logger.debug("Image name %s", image_name)
-            plane_exposure = self._find_channel_exposure_time_fix(image_name, channel_name)
-            if plane_exposure < 0:
-                plane_exposure = None
+            if channel_name not in exposures:
+                exposure = self._find_channel_exposure_time_fix(image_obj.name, channel_name)
+                exposures[channel_name] = exposure if exposure >= 0 else None
+            plane_exposure = exposures[channel_name]
             if (
                     plane_xml.attrib["PositionXUnit"] != "µm" or
                     plane_xml.attrib["PositionYUnit"] != "µm"):
@@ -329,15 +352,37 @@ class VsiParser(DatasetParser):
             plane_position_y = float(plane_xml.attrib["PositionY"])
             plane_z = int(plane_xml.attrib["TheZ"])
             plane_t = int(plane_xml.attrib["TheT"])
-            plane = self._find_plane(
-                plane_channel, plane_exposure, plane_position_x,
-                plane_position_y, plane_z, plane_t, image_obj)
-            self._save_plane_images(plane)
+            plane_channels.append(plane_channel)
+            plane_values.append({
+                "image_id": image_obj.pk,
+                "channel_id": plane_channel.pk,
+                "exposure": plane_exposure,
+                "position_x": plane_position_x,
+                "position_y": plane_position_y,
+                "z": plane_z,
+                "t": plane_t})
+        planes = self._plane_resolver.resolve(plane_values)
+        changed = []
+        with self._timings.stage(STAGE_PREVIEWS):
+            for (plane, plane_channel) in zip(planes, plane_channels):
+                plane.image = image_obj # Already have these so don't look them up again
+                plane.channel = plane_channel
+                if self._store_plane_images(plane):
+                    changed.append(plane)
+        OmePlane.objects.bulk_update(changed, ["preview", "filename"])
+        self._logger.info("Processed %d planes", len(planes))
         image_obj.save()
         return image_obj
 
-    def _save_plane_images(self, plane):
+    def _store_plane_images(self, plane):
+        """
+            Store the preview and tiff filename for a plane if it doesn't already have them.
+            The plane isn't saved.
+            :param OmePlane plane: The plane
+            :return boolean: True if the plane has been changed
+        """
         self._logger.debug("Saving images for plane %s", plane)
+        changed = False
         image_obj = plane.image
         channel_no = int(plane.channel.channel_id.split(":")[-1][0])
         self._logger.debug("Channel number %d", channel_no)
@@ -348,7 +393,9 @@ class VsiParser(DatasetParser):
         if not bool(plane.preview):
             preview_fname = "{}_ch{}_preview.png".format(fname_base, channel_no)
             self._logger.debug("Preview filename: %s", preview_fname)
-            plane.preview.save(preview_fname, open(Path(path, preview_fname), "rb"))
+            with open(Path(path, preview_fname), "rb") as preview:
+                plane.preview.save(preview_fname, File(preview), save=False)
+            changed = True
         if not bool(plane.filename):
             tiff_fname = "{}_{}_{}_ch{}.tif".format(
                 fname_base,
@@ -357,11 +404,14 @@ class VsiParser(DatasetParser):
                 channel_no)
             self._logger.debug("Tif filename: %s", tiff_fname)
             plane.filename = tiff_fname
-        plane.save()
+            changed = True
+        return changed
 
-    def process_file(self, dataset, scan_data=None):
+    def process_file(self, dataset, scan_data=None, checksum=None, fingerprint=None):
         if not scan_data:
             raise ValueError("scan_data must be passed in")
+        if checksum is None:
+            fingerprint = file_fingerprint(dataset)
         self._logger.debug("Reading VSI file: %s", dataset)
         dirname = dataset.parent
         self._logger.debug("Directory name: %s", dirname)
@@ -370,174 +420,81 @@ class VsiParser(DatasetParser):
         if not xmlfile.exists():
             self._logger.info("Need to generate XML file and tiffs")
             try:
-                subprocess.run(
-                    "{} {}".format(CONVERTER_COMMAND, str(dataset)),
-                    shell=True,
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
+                with self._timings.stage(STAGE_VSI_EXTRACTION, dataset.stat().st_size):
+                    self._extractor.extract(dataset, xmlfile)
                 self._logger.debug("VSI extracted")
             except subprocess.CalledProcessError as output:
                 self._logger.error("Failed to process VSI file")
                 self._logger.debug("STDOUT: %s", output.stdout)
                 self._logger.debug("STDERR: %s", output.stderr)
                 raise output
-        self._xml_root = ET.parse(xmlfile).getroot()
-        self._process_instruments()
+        with self._timings.stage(STAGE_XML_PARSING, xmlfile.stat().st_size):
+            self._ome_index = OmeIndex.from_file(xmlfile, self._logger.level)
+        if checksum is None:
+            with self._timings.stage(STAGE_HASHING, dataset.stat().st_size):
+                checksum = calculate_file_hash(dataset)
+        self._logger.debug("File checksum: %s", checksum)
+        with transaction.atomic(): # Write all of the records for the file together
+            self._store_records(dataset, xmlfile, scan_data, checksum, fingerprint)
+        return scan_data
+
+    def _store_records(self, dataset, xmlfile, scan_data, checksum, fingerprint):
+        """
+            Create or update the records for the scan and all of its images
+            :param Path dataset: The VSI file
+            :param Path xmlfile: The OME-XML extracted from it
+            :param OmeData scan_data: The scan
+            :param string checksum: The checksum of the VSI file
+            :param string fingerprint: The fingerprint of the VSI file
+        """
+        with self._timings.stage(STAGE_DB_WRITE):
+            self._process_instruments()
         scan_data.name = dataset.stem
-        for image_xml in self._xml_root.findall("ome:Image", NS):
-            try:
+        for image in self._ome_index.images:
+            if image.acquisition_date is not None:
                 scan_data.scan_date = datetime.strptime(
-                    image_xml.find("ome:AcquisitionDate", NS).text,
-                    "%Y-%m-%dT%H:%M:%S")
+                    image.acquisition_date, "%Y-%m-%dT%H:%M:%S")
                 break
-            except AttributeError:
-                pass
         if not scan_data.scan_date:
             raise ValueError("Unable to find acquisition date")
-        checksum = calculate_file_hash(dataset)
-        self._logger.debug("File checksum: %s", checksum)
         scan_time = self._find_scanning_time()
         self._logger.debug("Found scanning time %f", scan_time)
         scan_data.scan_time = scan_time
         scan_data.checksum = checksum
-        scan_data.save()
+        scan_data.fingerprint = fingerprint
+        with self._timings.stage(STAGE_DB_WRITE):
+            scan_data.save()
         img_names = self._find_image_names()
         self._logger.info("Found %d images to process", len(img_names))
         self._logger.debug("Images: %r", img_names)
-        for name in img_names:
-            self._logger.debug("Processing %s", name)
-            img_obj = self._process_image(name, scan_data)
-            self._store_preview(img_obj)
-        return scan_data
+        found = 0
+        images = stream_images(xmlfile, img_names)
+        while True:
+            with self._timings.stage(STAGE_XML_PARSING):
+                image_xml = next(images, None)
+            if image_xml is None:
+                break
+            found += 1
+            self._logger.debug("Processing %s", image_xml.get("Name"))
+            with self._timings.stage(STAGE_DB_WRITE):
+                img_obj = self._process_image(image_xml, scan_data)
+            with self._timings.stage(STAGE_PREVIEWS):
+                self._store_preview(img_obj)
+        if found != len(set(img_names)):
+            raise ValueError("Unable to find image with required name")
 
-    def _find_plane(#pylint: disable=invalid-name
-            self, channel, exposure, position_x, position_y, z, t, img):
-        """
-            Find the plane object for with the required specs, create it if it doesn't exist
-            :param OmeChannel channel: details about the channel used for imaging
-            :param float exposure length of exposure for the image
-            :param float position_x: x axis position
-            :param float position_y: y axis position
-            :param int z: Z position of plane
-            :param int t: T position of plane
-            :param OmeImage img, the image to look for the plane in
-            :return OmePlane: Object with the required params
-        """
-        try:
-            plane = img.omeplane_set.get(
-                channel=channel,
-                exposure=exposure,
-                position_x=position_x,
-                position_y=position_y,
-                z=z,
-                t=t)
-            self._logger.debug("Found plane (%d)", plane.pk)
-        except ObjectDoesNotExist:
-            self._logger.debug("Failed to find plane")
-            plane = OmePlane()
-            plane.channel = channel
-            plane.exposure = exposure
-            plane.position_x = position_x
-            plane.position_y = position_y
-            plane.z = z
-            plane.t = t
-            plane.image = img
-            plane.save()
-            self._logger.debug("New plane saved (%d)", plane.pk)
-        return plane
-
-    def _find_objective(
-            self, lens_na=None, model=None,
-            nominal_magnification=None, working_distance=None):
-        """
-            Find the objective with the required params
-            :param float len_na: (Default: None)
-            :param string model: (Default:None)
-            :param float nominal_magnification: (Default: None)
-            :param float working_distance: (Default:None)
-            :return OmeObjective: Object with the required params
-        """
-        try:
-            objective = OmeObjective.objects.get(
-                lens_na=lens_na,
-                model=model,
-                nominal_magnification=nominal_magnification,
-                working_distance=working_distance)
-            self._logger.debug("Found objective (%d)", objective.pk)
-        except ObjectDoesNotExist:
-            self._logger.warning("Failed to find objective")
-            objective = OmeObjective(
-                lens_na=lens_na,
-                model=model,
-                nominal_magnification=nominal_magnification,
-                working_distance=working_distance)
-            objective.save()
-            self._logger.debug("New objective saved (%d)", objective.pk)
-        return objective
-
-
-    def _find_channel(
-            self, name, channel_id, emission_wavelength,
-            binning, detector, gain, samples_per_pixel=None):
-        """
-            Find the the specified channel in the DB create if it doesn't exist
-            :param string name: The Channel name
-            :param string channel_id: The Channel ID
-            :param float emission_wavelength: wavelength of light used
-            :param string binning: Details of the binning used eg. 1x1
-            :param OmeDetector detector: The detector object used
-            :param float gain: The gain used
-            :param int samples_per_pixel: Number of samples taken
-        """
-        try:
-            channel = OmeChannel.objects.get(
-                name=name, channel_id=channel_id, emission_wavelength=emission_wavelength,
-                samples_per_pixel=samples_per_pixel, detector=detector, detector_gain=gain,
-                binning=binning)
-            self._logger.debug("Found channel (%d)", channel.pk)
-        except ObjectDoesNotExist:
-            self._logger.warning("Failed to find channel")
-            channel = OmeChannel(
-                name=name, emission_wavelength=emission_wavelength,
-                samples_per_pixel=samples_per_pixel, channel_id=channel_id, detector=detector,
-                detector_gain=gain, binning=binning)
-            channel.save()
-            self._logger.debug("Created channel (%d)", channel.pk)
-        return channel
-
-
-    def _find_detector(
-            self, manufacturer, model, gain,
-            serial_number=None, detector_type=None):
-        """
-            Find the detector record create it if it doesn't exist
-            :param string manufacturer:
-            :param string model:
-            :param float gain:
-            :param string serial_number:
-            :param string detector_type:
-            :returns OmeDetector
-        """
-        try:
-            detector = OmeDetector.objects.get(
-                manufacturer=manufacturer, model=model, gain=gain,
-                serial_number=serial_number, detector_type=detector_type)
-            self._logger.debug("Found detector (%d)", detector.pk)
-        except ObjectDoesNotExist:
-            self._logger.warning("Failed to find detector")
-            detector = OmeDetector(
-                manufacturer=manufacturer, model=model, gain=gain,
-                serial_number=serial_number, detector_type=detector_type)
-            detector.save()
-            self._logger.debug("Created detector (%d)", detector.pk)
-        return detector
-
-    def process_associated_files(self, db_entry):
-        self._logger.debug("Processing associated files")
-        self._store_overview(db_entry)
-        self._store_vsi(db_entry)
-        self._store_xml(db_entry)
+    def _task_overview(self, db_entry):
+        with self._timings.stage(STAGE_PREVIEWS):
+            self._store_overview(db_entry)
+
+    def _task_tile_pyramids(self, db_entry):
+        with self._timings.stage(STAGE_TILE_PYRAMIDS):
+            self._store_pyramids(db_entry)
+
+    def _task_attachments(self, db_entry):
+        with self._timings.stage(STAGE_ATTACHMENTS):
+            self._store_vsi(db_entry)
+            self._store_xml(db_entry)
 
     def _store_vsi(self, scan_entry):
         """
@@ -624,8 +581,25 @@ class VsiParser(DatasetParser):
                 self._logger.error("Overview file doesn't exist")
                 return
             self._logger.debug("Found overview file")
-            scan_entry.overview.save(overview_fname.name, open(overview_fname, "rb"))
+            scan_entry.overview.save(overview_fname.name, open(overview_fname, "rb"), save=False)
+            scan_entry.save(update_fields=["overview"]) # Other tasks for the scan may be running
+
 
+    def _store_pyramids(self, scan_entry):
+        """
+            Write the tile pyramids of the planes and overview that don't have one.
+            Planes extracted by VsiExtractor already have them, this catches the rest.
+            :param OmeData scan_entry: The db record for the scan entry
+        """
+        path = scan_entry.full_path().parent
+        filenames = OmePlane.objects.filter(image__scan=scan_entry).values_list(
+            "filename", flat=True)
+        for filename in filenames:
+            tiff = Path(path, filename)
+            if tiff.exists():
+                self._pyramids.write(tiff)
+        if scan_entry.overview:
+            self._pyramids.write(Path(scan_entry.overview.path))
 
     def _store_preview(self, image_entry):
         """
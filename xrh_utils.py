@@ -19,6 +19,7 @@
 """
 import sys
 import re
+from collections import namedtuple
 import subprocess
 import hashlib
 from tempfile import TemporaryDirectory, NamedTemporaryFile
@@ -29,6 +30,7 @@ import logging
 import os
 import os.path
 import zipfile
+import xml.etree.ElementTree as ET
 import numpy
 import pyvips
 import pyqrcode
@@ -38,6 +40,8 @@ import ffmpeg
 import magic
 from django.conf import settings
 
+from chunked_volume import ChunkedArray, is_chunked_store
+
 TYPES_TO_UPLOAD = [
     'video/x-msvideo',
     "video/mp4",
@@ -63,38 +67,28 @@ def calculate_file_hash(filename, buf_size=65536):
             sha.update(data)
     return sha.hexdigest()
 
-def tiff2png(filename, percent=100):
+def file_fingerprint(filename):
     """
-        use pyvips to create a png from a tiff
-        :param Path: filename - the tiff to convert
-        :param int percent: Only save the bottom X percent of the pixel values
-        :return (temp_dir, filename)
+        Generate a fingerprint for a file from its metadata.
+        This is much cheaper than a checksum and if it hasn't changed then neither has the file
+        :param Path filename: The file to fingerprint
+        :return string: size:mtime_ns:inode:device
     """
-    logger = logging.getLogger("tiff2png")
-    logger.debug("Converting: %s", filename)
-    temp_dir = TemporaryDirectory()
-    logger.debug("Working dir: %s", temp_dir.name)
-    image = pyvips.Image.new_from_file(str(filename))
-    if  0 < percent < 100:
-        logger.debug("Thresholding image")
-        upper_limit = image.percent(percent)
-        image = image * 255 / upper_limit
-
-    new_filename = "{}.png".format(filename.stem)
-    logger.debug("New filename: %s", new_filename)
-    image.write_to_file(str(Path(temp_dir.name, new_filename)))
-    return (temp_dir, new_filename)
+    stat = os.stat(filename)
+    return "{}:{}:{}:{}".format(stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
 
-
-def stack2xyslice(filename, pixels_x, pixels_y, pixels_z, bitdepth=None, position=0.5):
+def stack2xyslice(
+        filename, pixels_x, pixels_y, pixels_z, bitdepth=None, position=0.5, window=None):
     """
         Go from a full stack to a single xy slice
-        :param path filename: The full filename for the stack to process
+        :param path filename: The full filename for the stack, or chunked store, to process
         :param int pixels_x: Number of x pixels
         :param int pixels_y: Number of y pixels
         :param int pixels_z: total number of slices:
         :param int bitdepth: How many bits per pixel
         :param float position: value between 0 & 1 position in stack of slice
+        :param (float, float) window: The values to show as black and white, both images are
+            8 bit if given (see NikonCTScan.volume_window)
         :return (temp_dir, tiff_filename, png_filename)
     """
     logger = logging.getLogger("stack2xyslice")
@@ -104,7 +98,10 @@ def stack2xyslice(filename, pixels_x, pixels_y, pixels_z, bitdepth=None, positio
     if position > 1:
         logger.error("Position (%f) cannot be greater than 1.", position)
         raise ValueError("Position {:02f} cannot be greater than 1.".format(position))
-    if bitdepth is None:
+    store = ChunkedArray(filename) if is_chunked_store(filename) else None
+    if store is not None:
+        bitdepth = store.dtype.itemsize * 8
+    elif bitdepth is None:
         vgi_file = vgi_from_vol(filename)
         bitdepth = read_vgi_bitdepth(vgi_file)
     logger.debug("Bitdepth = %d", bitdepth)
@@ -136,16 +133,23 @@ def stack2xyslice(filename, pixels_x, pixels_y, pixels_z, bitdepth=None, positio
     logger.debug("Number of slices to skip: %d", slices_into_stack)
     bytes_to_skip = int(slices_into_stack * bytes_per_slice)
     logger.debug("Bytes to skip: %d", bytes_to_skip)
-    filesize = file_size(filename)
-    if filesize < (bytes_to_skip + bytes_per_slice):
-        logger.warning("Don't have even reconstructed yet to get the middle slice")
-        raise ValueError("volume not yet complete")
-    data = numpy.fromfile(
-        filename,
-        dtype=dtype,
-        count=bytes_per_slice,
-        offset=bytes_to_skip)
+    if store is not None:
+        data = store[min(slices_into_stack, pixels_z - 1)]
+    else:
+        filesize = file_size(filename)
+        if filesize < (bytes_to_skip + bytes_per_slice):
+            logger.warning("Don't have even reconstructed yet to get the middle slice")
+            raise ValueError("volume not yet complete")
+        data = numpy.fromfile(
+            filename,
+            dtype=dtype,
+            count=bytes_per_slice,
+            offset=bytes_to_skip)
     image = pyvips.Image.new_from_memory(data, pixels_x, pixels_y, 1, fmt)
+    if window is not None:
+        (low, high) = window
+        logger.debug("Windowing from %f to %f", low, high)
+        image = ((image - low) * (255.0 / (high - low))).cast("uchar") # cast clips to 0-255
     temp_dir = TemporaryDirectory()
     logger.debug("Working dir: %s", temp_dir.name)
     new_filename = "{}_xyslice".format(filename.stem)
@@ -303,13 +307,19 @@ def list_xtekhelixct_files(path):
         raise ValueError("Path must exist")
     return list(path.glob("**/*.xtekhelixct"))
 
-def video2thumbnail(video, output_dir, position=0.5):
+VideoInfo = namedtuple(
+    "VideoInfo", ["width", "height", "frames", "frame_rate", "duration", "codec"])
+
+def video2thumbnail(video, output_dir, position=0.5, info=None, size=None):
 
     """
         Take a video and use ffmpeg to generate a thumbnail of the specified time
         :param Path video: Path to the video to be processed
         :param Path output_dir: Path to the directory in which to save the thumbnail
         :param float position: 0 < position <=1 position through the stack to use for the thumbnail
+        :param VideoInfo info: The video's details if already known (default: probe it)
+        :param int size: Shrink the thumbnail so its longest side is no more than this
+            (default: full size)
         :return Path: Path to the thumbnail
     """
     logger = logging.getLogger("video2thumbnail")
@@ -317,7 +327,9 @@ def video2thumbnail(video, output_dir, position=0.5):
         raise ValueError("Position value ({}) too low.".format(position))
     if position > 1:
         raise ValueError("Position value ({}) too high.".format(position))
-    (total_frames, frame_rate) = video_frame_count(video)
+    if info is None:
+        info = probe_video(video)
+    (total_frames, frame_rate) = (info.frames, info.frame_rate)
     logger.debug("Total frames: %d", total_frames)
     logger.debug("Frame rate: %f", frame_rate)
     target_frame = int(total_frames * position)
@@ -326,9 +338,13 @@ def video2thumbnail(video, output_dir, position=0.5):
     logger.debug("Target seconds: %f", target_seconds)
     video_name = video.stem
     output_fname = Path(output_dir, "{}_thumbnail.png".format(video_name))
+    stream = ffmpeg.input(str(video), ss=target_seconds)
+    if size is not None and max(info.width, info.height) > size:
+        scale = size / max(info.width, info.height)
+        stream = stream.filter(
+            "scale", max(1, round(info.width * scale)), max(1, round(info.height * scale)))
     (
-        ffmpeg
-        .input(str(video), ss=target_seconds)
+        stream
         .output(str(output_fname), vframes=1)
         .global_args('-loglevel', 'error')
         .run()
@@ -336,12 +352,12 @@ def video2thumbnail(video, output_dir, position=0.5):
     return output_fname
 
 
-def video_frame_count(video):
+def probe_video(video):
     """
-        Work out how many frames a video has
+        Read everything needed about a video stream with a single ffprobe
         Based on https://github.com/kkroening/ffmpeg-python/blob/master/examples/video_info.py
         :param Path video: The video file to examine
-        :return ( total_frames, frame_rate)
+        :return VideoInfo
     """
     if not video.exists():
         raise FileNotFoundError("{} does not exist".format(str(video)))
@@ -350,29 +366,35 @@ def video_frame_count(video):
         (stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
     if video_stream is None:
         raise ValueError("Unable to find video in file")
-    total_frames = int(video_stream["nb_frames"])
-    frame_rate_str = video_stream["r_frame_rate"]
-    frame_rate_arr = frame_rate_str.split("/")
+    frame_rate_arr = video_stream["r_frame_rate"].split("/")
     frame_rate = float(frame_rate_arr[0]) / float(frame_rate_arr[1])
-    return (total_frames, frame_rate)
+    total_frames = int(video_stream["nb_frames"])
+    duration = video_stream.get("duration", probe.get("format", {}).get("duration"))
+    return VideoInfo(
+        width=int(video_stream['width']),
+        height=int(video_stream['height']),
+        frames=total_frames,
+        frame_rate=frame_rate,
+        duration=float(duration) if duration is not None else total_frames / frame_rate,
+        codec=video_stream.get("codec_name"))
+
+def video_frame_count(video):
+    """
+        Work out how many frames a video has
+        :param Path video: The video file to examine
+        :return ( total_frames, frame_rate)
+    """
+    info = probe_video(video)
+    return (info.frames, info.frame_rate)
 
 def video_dimensions(video):
     """
         Work out the dimensions in pixels of a video stream
-        Based on https://github.com/kkroening/ffmpeg-python/blob/master/examples/video_info.py
         :param Path video: The video file to examine
         :return (width, height)
     """
-    if not video.exists():
-        raise FileNotFoundError("{} does not exist".format(str(video)))
-    probe = ffmpeg.probe(str(video))
-    video_stream = next(
-        (stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-    if video_stream is None:
-        raise ValueError("Unable to find video in file")
-    width = int(video_stream['width'])
-    height = int(video_stream['height'])
-    return (width, height)
+    info = probe_video(video)
+    return (info.width, info.height)
 
 def image_dimensions(image):
     """
@@ -387,7 +409,7 @@ def image_dimensions(image):
 
 def apply_overlay(
         video, image, top=True, left=True,
-        transparency=0.375, rel_height=0.1, margin=25, video_bitrate=5120000):
+        transparency=0.375, rel_height=0.1, margin=25, video_bitrate=5120000, info=None):
     """
         Overlay the specified image onto the video in the specified position
         :param Path video: The video to add the image to
@@ -398,6 +420,7 @@ def apply_overlay(
         :param float rel_height: Default=0.1 size of the overlay relative to the height of the video #pylint: disable=line-to-long
         :param int margin: Default=25 gap to between image and edge of frame
         :param int video_bitrate Bits per second to target the video encode at
+        :param VideoInfo info: The video's details if already known (default: probe it)
         :return (temp_dir, filename)
     """
     logger = logging.getLogger("Video Overlay")
@@ -409,9 +432,11 @@ def apply_overlay(
         raise ValueError("rel_height value ({}) must be betwen 0 and 1".format(rel_height))
     if transparency < 0 or transparency > 1:
         raise ValueError("tranparency value ({}) must be betwen 0 and 1".format(transparency))
-    (video_width, video_height) = video_dimensions(video)
+    if info is None:
+        info = probe_video(video)
+    (video_width, video_height) = (info.width, info.height)
     logger.debug("Video dimensions %dx%d", video_width, video_height)
-    frame_rate = video_frame_count(video)[1]
+    frame_rate = info.frame_rate
     logger.debug("Source frame rate %d", frame_rate)
     margin = int(margin)
     if margin < 0 or margin > video_width/2:
@@ -575,6 +600,36 @@ def strip_ansi_codes(string):
     """
     return re.sub(r'\x1b\[([0-9,A-Z]{1,2}(;[0-9]{1,2})?(;[0-9]{3})?)?[m|K]?', '', string)
 
+def stream_xml_elements(source, tags, depth=None):
+    """
+        Parse an XML file incrementally yielding the elements with the specified tags once
+        they are complete.  Everything else is discarded as soon as it has been parsed, and
+        each element yielded is discarded when the next one is requested, so memory use
+        doesn't grow with the size of the file.  Take a copy of anything to be kept.
+        Elements with the tags shouldn't be nested inside each other.
+        :param Path source: The XML file
+        :param set tags: The tags to return (including the namespace, eg. {ns}Image)
+        :param int depth: Only return elements this far below the root (children are 1)
+        :return generator: Element
+    """
+    stack = []
+    wanted = [] # The elements being built that will be returned
+    for (event, elem) in ET.iterparse(str(source), events=("start", "end")):
+        if event == "start":
+            if elem.tag in tags and (depth is None or len(stack) == depth):
+                wanted.append(elem)
+            stack.append(elem)
+            continue
+        stack.pop()
+        if wanted and wanted[-1] is elem:
+            wanted.pop()
+            yield elem
+        elif wanted:
+            continue # Part of an element to be returned, keep it until that is complete
+        if stack:
+            stack[-1].remove(elem)
+        elem.clear()
+
 def read_vgi_bitdepth(vgi_file):
     """
         Reads a vgi file and returns the specified bit depth
@@ -590,6 +645,23 @@ def read_vgi_bitdepth(vgi_file):
             arr = line.split("=")
             return int(arr[1])
 
+def read_vgi_size(vgi_file):
+    """
+        Reads a vgi file and returns the size of the volume
+        :param Path vgi_file: The path to the vgi file to read
+        :return (int, int, int): x, y and z size in voxels, None if not specified
+    """
+    if not isinstance(vgi_file, Path):
+        raise ValueError("Must be a path")
+    if not vgi_file.exists():
+        raise ValueError("File must exist")
+    for line in open(vgi_file).readlines():
+        if line.lower().startswith("size"):
+            arr = line.split("=")
+            (size_x, size_y, size_z) = (int(value) for value in arr[1].split())
+            return (size_x, size_y, size_z)
+    return None
+
 def vgi_from_vol(vol_file):
     """
         Work out the vgi filename for the specified vol file
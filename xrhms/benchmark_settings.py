@@ -0,0 +1,31 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Settings used by benchmark_ingest.py.
+    Files that would normally be copied into private storage are kept under the
+    benchmark root (XRHMS_BENCHMARK_ROOT) instead so benchmarks never touch the real shares.
+"""
+import os
+from tempfile import gettempdir
+
+from .settings import * #pylint: disable=unused-wildcard-import, wildcard-import
+
+BENCHMARK_ROOT = os.environ.get(
+    "XRHMS_BENCHMARK_ROOT", os.path.join(gettempdir(), "xrhms-benchmark"))
+PRIVATE_STORAGE_ROOT = os.path.join(BENCHMARK_ROOT, "private")
+USER_DATA_FOLDER = os.path.join(BENCHMARK_ROOT, "users")
+VIDEO_THUMBNAIL_ROOT = os.path.join(PRIVATE_STORAGE_ROOT, "video-thumbnails")
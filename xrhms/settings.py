@@ -201,6 +201,17 @@ USER_COPY_SCAN_README = "static/SCAN_README.txt"
 
 EXTRA_FOLDER = "extra"
 VIDEO_FOLDER = "videos"
+PREVIEW_FOLDER = "preview"
+PROJECTION_PNG_SIZE = 2048 # Longest side of the projection thumbnails (pixels)
+VSI_EXTRACTION_WORKERS = 4 # Planes of a VSI file extracted at once
+TILE_CACHE_SECONDS = 7 * 24 * 60 * 60 # How long browsers may keep pyramid tiles
+OPENSEADRAGON_VERSION = "4.1.0"
+OPENSEADRAGON_URL = "{}openseadragon/{}/".format( # Installed into static/ by update.sh
+    STATIC_URL, OPENSEADRAGON_VERSION)
+VIDEO_THUMBNAIL_ROOT = os.path.join(PRIVATE_STORAGE_ROOT, "video-thumbnails")
+VIDEO_THUMBNAIL_BUDGET = 10 * 1024 * 1024 * 1024 # Most bytes the video thumbnails may use
+VIDEO_THUMBNAIL_SIZE = 1024 # Longest side of the video thumbnails (pixels)
+VIDEO_THUMBNAIL_CACHE_SECONDS = 24 * 60 * 60 # How long browsers may keep video thumbnails
 
 SCAN_VIDEO_EXTENSION = [
     "mp4",
@@ -38,6 +38,8 @@ from django.conf import settings
 
 import private_storage.urls
 
+from scans.views import tile_pyramid_file, tile_viewer, video_thumbnail
+
 admin.site.site_header = "XRH Management System"
 if settings.DEV_SITE:
     admin.site.site_header += " DEVELOPMENT VERSION"
@@ -61,4 +63,10 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', redirect_index),
     path('private-media/', include(private_storage.urls)),
+    path('tiles/<str:model>/<int:pk>/<str:field>/', tile_viewer, name="tile_viewer"),
+    path(
+        'tiles/<str:model>/<int:pk>/<str:field>/<path:name>',
+        tile_pyramid_file,
+        name="tile_pyramid"),
+    path('video-thumbnails/<int:pk>/', video_thumbnail, name="video_thumbnail"),
 ]
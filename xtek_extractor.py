@@ -0,0 +1,212 @@
+"""
+    Copyright 2023 University of Southampton
+    Dr Philip Basford
+    μ-VIS X-Ray Imaging Centre
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Read the parameters listed in xtek_parameters.py from xtekct/xtekhelixct files.
+
+    The parameter list is compiled once into a table of (section, option) -> (target,
+    converter) so each file is read in a single pass over its lines rather than looking every
+    parameter up through ConfigParser.  Values are converted the same way ConfigParser's
+    getint/getfloat/getboolean do.  This doesn't use django so read_many can parse the files
+    in a pool of processes.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from configparser import ConfigParser
+
+from xrhms_exceptions import XrhmsIgnore
+from xtek_parameters import (
+    CT_SECTION,
+    HELIX_SECTION,
+    XTEKCT_MODE,
+    XTEKHELIX_MODE,
+    get_xtek_param_list,
+)
+
+SOTON_SECTION = "soton"
+IGNORE_OPTION = "XrhmsIgnore"
+COMMENT_PREFIXES = ("#", ";")
+DEFAULT_SECTION = "DEFAULT" # As ConfigParser, its options are in every other section
+DEFAULT_BATCH_WORKERS = 4
+BATCH_CHUNKSIZE = 16 # Files sent to each worker process at a time
+
+def _to_string(value):
+    return value if value != "" else None
+
+def _to_bool(value):
+    try:
+        return ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: {}".format(value))
+
+CONVERTERS = {
+    "int": int,
+    "float": float,
+    "string": _to_string,
+    "bool": _to_bool,
+    "boolean": _to_bool,
+}
+
+def compile_param_table(mode):
+    """
+        Build the lookup table for a mode
+        :param int mode: XTEKCT_MODE or XTEKHELIX_MODE
+        :return dict: (section, option) -> (target, converter)
+    """
+    table = {}
+    for (target, param_type, section, source) in get_xtek_param_list(mode):
+        try:
+            converter = CONVERTERS[param_type]
+        except KeyError:
+            raise ValueError("Unknown parameter type {}".format(param_type))
+        table[(section, source)] = (target, converter)
+    return table
+
+PARAM_TABLES = {
+    XTEKCT_MODE: compile_param_table(XTEKCT_MODE),
+    XTEKHELIX_MODE: compile_param_table(XTEKHELIX_MODE),
+}
+
+def read_sections(dataset):
+    """
+        Read all the options in an xtek file in one pass.
+        Follows the ConfigParser rules the parser used to be set up with: sections and options
+        are case sensitive, options can be repeated with the last one winning, values can
+        be continued onto indented lines and the options in [DEFAULT] apply to every section
+        that doesn't set them itself.
+        :param Path dataset: The xtek file
+        :return dict: section -> {option: value}, not including DEFAULT
+    """
+    sections = {}
+    current = None
+    option = None
+    indent = 0
+    with open(dataset) as fhandle:
+        for line in fhandle:
+            stripped = line.strip()
+            if not stripped or stripped.startswith(COMMENT_PREFIXES):
+                option = None
+                continue
+            line_indent = len(line) - len(line.lstrip())
+            if current is not None and option is not None and line_indent > indent:
+                current[option] += "\n" + stripped
+                continue
+            option = None
+            if stripped.startswith("[") and stripped.endswith("]"):
+                current = sections.setdefault(stripped[1:-1], {})
+                continue
+            if current is None:
+                raise ValueError("{} has options before the first section".format(dataset))
+            split = min(
+                (index for index in (stripped.find("="), stripped.find(":")) if index > 0),
+                default=-1)
+            if split < 0:
+                continue # ConfigParser would reject the file, just skip the line
+            option = stripped[:split].rstrip()
+            current[option] = stripped[split + 1:].lstrip()
+            indent = line_indent
+    defaults = sections.pop(DEFAULT_SECTION, {})
+    if defaults:
+        for (name, options) in sections.items():
+            sections[name] = dict(defaults, **options)
+    return sections
+
+def read_xtek(dataset):
+    """
+        Read the parameters from an xtek file
+        :param Path dataset: The xtek file
+        :return (int, dict): The mode and target -> value for the parameters found
+    """
+    sections = read_sections(dataset)
+    if CT_SECTION in sections:
+        mode = XTEKCT_MODE
+    elif HELIX_SECTION in sections:
+        mode = XTEKHELIX_MODE
+    else:
+        raise ValueError("Cannot find either XTekCT or XTekHelixCT section in file")
+    soton = sections.get(SOTON_SECTION, {})
+    if IGNORE_OPTION in soton and _to_bool(soton[IGNORE_OPTION]):
+        raise XrhmsIgnore("Ignoring xtekct file due to specificied value")
+    values = {}
+    for ((section, source), (target, converter)) in PARAM_TABLES[mode].items():
+        try:
+            value = sections[section][source]
+        except KeyError:
+            continue
+        values[target] = converter(value)
+    return (mode, values)
+
+def _read_xtek_safe(dataset):
+    """
+        read_xtek for a worker process, exceptions are returned rather than raised so one
+        bad file doesn't lose the results of the rest of the chunk
+    """
+    try:
+        return (dataset, read_xtek(dataset))
+    except Exception as exp: #pylint: disable=broad-except
+        return (dataset, exp)
+
+class XtekExtractor():
+    """
+        Read the parameters from xtek files and apply them to scans
+    """
+
+    def __init__(self, log_level=logging.WARNING):
+        """
+            :param int log_level: How verbose to be
+        """
+        self._logger = logging.getLogger("Xtek extractor")
+        self._logger.setLevel(log_level)
+
+    def read(self, dataset):
+        """
+            Read the parameters from an xtek file
+            :param Path dataset: The xtek file
+            :return (int, dict): The mode and target -> value for the parameters found
+        """
+        self._logger.debug("Reading XTek file: %s", dataset)
+        (mode, values) = read_xtek(dataset)
+        self._logger.debug("Read %d parameters in mode %d", len(values), mode)
+        return (mode, values)
+
+    def apply(self, values, scan_data):
+        """
+            Store the values read on a scan
+            :param dict values: target -> value, see read
+            :param NikonCTScan scan_data: Where to store them
+        """
+        for (target, value) in values.items():
+            setattr(scan_data, target, value)
+
+    def read_many(self, datasets, workers=DEFAULT_BATCH_WORKERS):
+        """
+            Read many xtek files in a pool of processes.
+        The processes are spawned rather than forked so they don't share the caller's DB
+        connection (and the ingest lock held on it).
+            :param iterable datasets: The xtek files (Path)
+            :param int workers: The number of processes to use
+            :return generator: (dataset, result) in the same order as datasets, result is
+                (mode, values) as returned by read or the exception raised reading the file
+        """
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            for (dataset, result) in executor.map(
+                    _read_xtek_safe, datasets, chunksize=BATCH_CHUNKSIZE):
+                if isinstance(result, Exception):
+                    self._logger.warning("Unable to read %s: %s", dataset, result)
+                yield (dataset, result)
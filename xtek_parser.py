@@ -21,29 +21,41 @@
     October 2020
 """
 import os
+import copy
+import json
 import logging
 import xml.etree.ElementTree as ET
-from configparser import ConfigParser
+from itertools import islice
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
 import shutil
+import ffmpeg
 import sh
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 
-from xrhms_exceptions import XrhmsIgnore
-from xtek_parameters import  XTEKCT_MODE, XTEKHELIX_MODE, get_xtek_param_list
+from xtek_extractor import XtekExtractor, DEFAULT_BATCH_WORKERS
+from volume_reader import VolumeReader, WINDOW_PERCENTILES
+from preview_volume import PreviewVolumeWriter, preview_name, write_vgi
+from chunked_volume import STORE_SUFFIX, export_volume, is_chunked_store
+from thumbnailer import Thumbnailer, DEFAULT_WORKERS as DEFAULT_THUMBNAIL_WORKERS
+from projection_stack import ProjectionStackAnalyser, find_stack
+from tile_pyramid import TilePyramidWriter
 
 from xrh_utils import (
     calculate_file_hash,
     convert_filesize,
+    directory_size,
+    file_fingerprint,
     find_mount_point,
     free_space,
     get_file_modified_time,
     stack2xyslice,
+    stream_xml_elements,
     strip_ansi_codes,
-    tiff2png,
+    vgi_from_vol,
 )
 
 from scans.models import (
@@ -57,9 +69,56 @@ from scans.models import (
 )
 from scans.reports import generate_basic_report_tasks
 
-from dataset_parser import DatasetParser
+from dataset_parser import DatasetParser, EA_DIR
+from ingest_timing import (
+    STAGE_ATTACHMENTS,
+    STAGE_DB_WRITE,
+    STAGE_EXTRA_LISTING,
+    STAGE_HASHING,
+    STAGE_METADATA,
+    STAGE_PREVIEW_VOLUMES,
+    STAGE_PROJECTIONS,
+    STAGE_PROJECTION_STACK,
+    STAGE_REFINED_FILES,
+    STAGE_REPORTS,
+    STAGE_TIFF2PNG,
+    STAGE_TILE_PYRAMIDS,
+    STAGE_VIDEOS,
+    STAGE_VOLUME_STATS,
+    STAGE_XML_PARSING,
+    STAGE_XYSLICE,
+)
 
-RECON_EXTENSIONS = ["vol", "raw"]
+RECON_EXTENSIONS = ["vol", "raw", STORE_SUFFIX.lstrip(".")] # Chunked store last
+STORE_ATTRIBUTES = [ # Fields of NikonCTScan copied into a chunked store's metadata
+    "voxels_x",
+    "voxels_y",
+    "voxels_z",
+    "voxel_size_x",
+    "voxel_size_y",
+    "voxel_size_z",
+    "offset_x",
+    "offset_y",
+    "offset_z",
+    "units",
+    "output_units",
+    "output_type",
+    "scaling",
+    "scaling_minimum",
+    "scaling_maximum",
+    "volume_window_low",
+    "volume_window_high",
+]
+PROJECTION_FIELDS = ["projection0deg", "projection90deg"]
+BACKFILL_BATCH = 64 # Scans to thumbnail the projections of at once
+CTPROFILE_TAGS = {
+    "ImagingSettings",
+    "XrayHead",
+    "FramesPerProjection",
+    "MaxPixelsToShuttle",
+    "HelicalScan",
+    "HelicalParameters",
+}
 
 class XtekParser(DatasetParser):
     """
@@ -68,10 +127,23 @@ class XtekParser(DatasetParser):
     """
 
     EXTENSIONS = [".xtekct", ".xtekhelixct"]
+    ASSOCIATED_TASKS = {
+        "attachments": 10,
+        "extra_listing": 20,
+        "refined_files": 30,
+        "projections": 40,
+        "projection_stack": 45,
+        "xy_slice": 50,
+        "preview_volumes": 55,
+        "videos": 60, # copies the largest files so do it last
+    }
     def __init__(self, log_level=logging.WARN):
         super().__init__(log_level)
         self._log_level = log_level
         self._logger = logging.getLogger("Xtek Parser")
+        self._xtek_extractor = XtekExtractor(log_level)
+        self._thumbnailer = Thumbnailer(settings.PROJECTION_PNG_SIZE, log_level=log_level)
+        self._pyramids = TilePyramidWriter(log_level=log_level)
 
     def extensions(self):
         return self.EXTENSIONS
@@ -82,126 +154,168 @@ class XtekParser(DatasetParser):
     def list_files(self, directory):
         return super()._list_files(directory, self.EXTENSIONS)
 
-    def process_file(self, dataset, scan_data=None):
+    def process_file(self, dataset, scan_data=None, checksum=None, fingerprint=None):
         if not scan_data:
             raise ValueError("scan_data must be passed in")
-        self._logger.debug("Reading XTek file: %s", dataset)
-        #setup parser using options suggested by Nick Hale
-        #allows duplicates of the same section / options
-        xtekct_parser = ConfigParser(strict=False)
-        #allows case sensitivity
-        xtekct_parser.optionxform = str
-
-        xtekct_parser.read(dataset)
-        if xtekct_parser.has_section("XTekCT"):
-            mode = XTEKCT_MODE
-            self._logger.info("Using XTekCT mode")
-        elif xtekct_parser.has_section("XTekHelixCT"):
-            mode = XTEKHELIX_MODE
-            self._logger.info("Using XTekHelixCT mode")
-        else:
-            self._logger.error("Cannot find either XTekCT or XTekHelixCT section in file")
-            raise ValueError("Cannot find either XTekCT or XTekHelixCT section in file")
-        if xtekct_parser.has_section("soton"):
-            self._logger.debug("Has southampton specific setting")
-            if xtekct_parser.getboolean("soton", "XrhmsIgnore"):
-                raise XrhmsIgnore("Ignoring xtekct file due to specificied value")
-        #Helix and CT mode have different section headings but largely the same fields
-        self._logger.debug("Getting data from xtek file")
-        for (target, mode, section, source) in get_xtek_param_list(mode):
-            if xtekct_parser.has_option(section, source):
-                if mode == "int":
-                    setattr(scan_data, target, xtekct_parser.getint(section, source))
-                elif mode == "float":
-                    setattr(scan_data, target, xtekct_parser.getfloat(section, source))
-                elif mode == "string":
-                    value = xtekct_parser.get(section, source)
-                    if value == "":
-                        value = None
-                    setattr(scan_data, target, value)
-                elif mode in ("bool", "boolean"):
-                    setattr(scan_data, target, xtekct_parser.getboolean(section, source))
-                else:
-                    self._logger.error("Unknown parameter type %s", mode)
-                    raise ValueError("Unknown parameter type {}".format(mode))
-                self._logger.debug(
-                    "Read value %s from %s to %s",
-                    xtekct_parser.get(section, source), source, target)
-            else:
-                self._logger.debug("Option %s not found in file", source)
-
-        self._logger.debug("Getting data from xml file")
+        if checksum is None:
+            fingerprint = file_fingerprint(dataset)
         ctprofile_filename = Path(
             dataset.parent,
             "{}.ctprofile.xml".format(dataset.stem))
+        with self._timings.stage(STAGE_METADATA, dataset.stat().st_size):
+            self._read_xtek_file(dataset, scan_data)
         if ctprofile_filename.exists():
-            ctprofile_data = ET.parse(ctprofile_filename).getroot()
-            imaging_settings = ctprofile_data.find("ImagingSettings").attrib
-            scan_data.binning = int(imaging_settings["binning"])
-            scan_data.exposure = int(imaging_settings["exposure"])
-            scan_data.gain = int(imaging_settings["gain"])
-            scan_data.xray_head = ctprofile_data.find("XrayHead").text
-            try:
-                scan_data.brightness = int(imaging_settings["brightness"])
-            except KeyError:
-                #This is no longer in files from IX6
-                pass
-            scan_data.digital_gain = int(imaging_settings["digitalGain"])
-            scan_data.accumulation = int(imaging_settings["accumulation"])
-            scan_data.white_to_black_latency = int(imaging_settings["WhiteToBlackLatency"])
-            scan_data.black_to_white_latency = int(imaging_settings["BlackToWhiteLatency"])
-            scan_data.white_to_white_latency = int(imaging_settings["WhiteToWhiteLatency"])
-            scan_data.lines = int(imaging_settings["lines"])
-            scan_data.frames_per_projection = int(ctprofile_data.find("FramesPerProjection").text)
-            scan_data.max_pixels_to_shuttle = int(ctprofile_data.find("MaxPixelsToShuttle").text)
-            if ctprofile_data.find("HelicalScan").text == "true":
-                self._logger.debug("Parsing helical params from CTProfile")
-                helical_params = ctprofile_data.find("HelicalParameters")
-                scan_data.helical_continuous_scan = \
-                    (helical_params.find("ContinuousScan").text == "true")
-                scan_data.helical_derivative_type = helical_params.find("DerivativeType").text
-                scan_data.helical_sample_top = float(helical_params.find("SampleTop").text)
-                scan_data.helical_sample_bottom = float(helical_params.find("SampleBottom").text)
-                scan_data.helical_projections_per_rotation = int(
-                    helical_params.find("ProjectionsPerRotation").text)
-                range_check = helical_params.find("VerticalRangeCheck")
-                scan_data.helical_upper_position_checked = (
-                    range_check.find("UpperPositionChecked").text == "true")
-                scan_data.helical_lower_position_checked = (
-                    range_check.find("LowerPositionChecked").text == "true")
-                scan_data.helical_upper_check_position = float(
-                    range_check.find("UpperCheckPosition").text)
-                range_check = helical_params.find("VerticalRangeCheck")
-                scan_data.helical_lower_check_position = float(
-                    range_check.find("LowerCheckPosition").text)
-                scan_data.helical_upper_magnification_position = float(
-                    range_check.find("UpperMagnificationPosition").text)
-                scan_data.helical_lower_magnification_position = float(
-                    range_check.find("LowerMagnificationPosition").text)
+            with self._timings.stage(STAGE_XML_PARSING, ctprofile_filename.stat().st_size):
+                self._read_ctprofile_file(ctprofile_filename, scan_data)
         else:
             self._logger.debug("no CTprofile file found")
-        checksum = calculate_file_hash(dataset)
+        if checksum is None:
+            with self._timings.stage(STAGE_HASHING, dataset.stat().st_size):
+                checksum = calculate_file_hash(dataset)
         self._logger.debug("File checksum: %s", checksum)
         scan_data.checksum = checksum
-        scan_data.save()
+        scan_data.fingerprint = fingerprint
+        with self._timings.stage(STAGE_DB_WRITE):
+            scan_data.save()
         scan_data.save_sidecar()
         return scan_data
 
-    def process_associated_files(self, db_entry):
-        self._store_ctprofile_file(db_entry)
-        self._store_xtek_file(db_entry)
-        self._store_ang_file(db_entry)
-        self._store_refined_files(db_entry)
-        self._generate_extra_listing(db_entry)
-        self._process_videos(db_entry)
-        if (
-                db_entry.sample is None or
-                not db_entry.sample.is_confidential()):
+    def _read_xtek_file(self, dataset, scan_data):
+        """
+            Read the scan parameters from the xtek file
+            :param Path dataset: The xtek file
+            :param NikonCTScan scan_data: Where to store the values read
+        """
+        (_mode, values) = self._xtek_extractor.read(dataset)
+        self._xtek_extractor.apply(values, scan_data)
+
+    def reread_parameters(self, scans, workers=DEFAULT_BATCH_WORKERS):
+        """
+            Read the xtek files for existing scans again and store the parameters, for when
+            parameters have been added to xtek_parameters.py.  The files are parsed in a pool
+            of processes.
+            :param iterable scans: The scans (NikonCTScan) to update
+            :param int workers: The number of processes to parse the files with
+            :return (int, int): The number of scans updated and the number that failed
+        """
+        scans = {scan.full_path(): scan for scan in scans}
+        (updated, failed) = (0, 0)
+        for (dataset, result) in self._xtek_extractor.read_many(scans.keys(), workers):
+            if isinstance(result, Exception):
+                failed += 1
+                continue
+            (_mode, values) = result
+            scan_data = scans[dataset]
+            self._xtek_extractor.apply(values, scan_data)
+            with self._timings.stage(STAGE_DB_WRITE):
+                scan_data.save(update_fields=list(values.keys()))
+            updated += 1
+        self._logger.info("Updated %d scans, %d failed", updated, failed)
+        return (updated, failed)
+
+    def _read_ctprofile_file(self, ctprofile_filename, scan_data):
+        """
+            Read the scan parameters from the ctprofile file
+            :param Path ctprofile_filename: The ctprofile xml file
+            :param NikonCTScan scan_data: Where to store the values read
+        """
+        self._logger.debug("Getting data from xml file")
+        # Only the top level settings are used, stream past anything else (eg. per
+        # projection data) rather than holding all of it in memory
+        ctprofile_data = ET.Element("CTProfile")
+        for elem in stream_xml_elements(ctprofile_filename, CTPROFILE_TAGS, depth=1):
+            ctprofile_data.append(copy.deepcopy(elem))
+        imaging_settings = ctprofile_data.find("ImagingSettings").attrib
+        scan_data.binning = int(imaging_settings["binning"])
+        scan_data.exposure = int(imaging_settings["exposure"])
+        scan_data.gain = int(imaging_settings["gain"])
+        scan_data.xray_head = ctprofile_data.find("XrayHead").text
+        try:
+            scan_data.brightness = int(imaging_settings["brightness"])
+        except KeyError:
+            #This is no longer in files from IX6
+            pass
+        scan_data.digital_gain = int(imaging_settings["digitalGain"])
+        scan_data.accumulation = int(imaging_settings["accumulation"])
+        scan_data.white_to_black_latency = int(imaging_settings["WhiteToBlackLatency"])
+        scan_data.black_to_white_latency = int(imaging_settings["BlackToWhiteLatency"])
+        scan_data.white_to_white_latency = int(imaging_settings["WhiteToWhiteLatency"])
+        scan_data.lines = int(imaging_settings["lines"])
+        scan_data.frames_per_projection = int(ctprofile_data.find("FramesPerProjection").text)
+        scan_data.max_pixels_to_shuttle = int(ctprofile_data.find("MaxPixelsToShuttle").text)
+        if ctprofile_data.find("HelicalScan").text == "true":
+            self._logger.debug("Parsing helical params from CTProfile")
+            helical_params = ctprofile_data.find("HelicalParameters")
+            scan_data.helical_continuous_scan = \
+                (helical_params.find("ContinuousScan").text == "true")
+            scan_data.helical_derivative_type = helical_params.find("DerivativeType").text
+            scan_data.helical_sample_top = float(helical_params.find("SampleTop").text)
+            scan_data.helical_sample_bottom = float(helical_params.find("SampleBottom").text)
+            scan_data.helical_projections_per_rotation = int(
+                helical_params.find("ProjectionsPerRotation").text)
+            range_check = helical_params.find("VerticalRangeCheck")
+            scan_data.helical_upper_position_checked = (
+                range_check.find("UpperPositionChecked").text == "true")
+            scan_data.helical_lower_position_checked = (
+                range_check.find("LowerPositionChecked").text == "true")
+            scan_data.helical_upper_check_position = float(
+                range_check.find("UpperCheckPosition").text)
+            range_check = helical_params.find("VerticalRangeCheck")
+            scan_data.helical_lower_check_position = float(
+                range_check.find("LowerCheckPosition").text)
+            scan_data.helical_upper_magnification_position = float(
+                range_check.find("UpperMagnificationPosition").text)
+            scan_data.helical_lower_magnification_position = float(
+                range_check.find("LowerMagnificationPosition").text)
+
+    def _task_attachments(self, db_entry):
+        with self._timings.stage(STAGE_ATTACHMENTS):
+            self._store_ctprofile_file(db_entry)
+            self._store_xtek_file(db_entry)
+            self._store_ang_file(db_entry)
+
+    def _task_refined_files(self, db_entry):
+        with self._timings.stage(STAGE_REFINED_FILES):
+            self._store_refined_files(db_entry)
+
+    def _task_extra_listing(self, db_entry):
+        with self._timings.stage(STAGE_EXTRA_LISTING):
+            self._generate_extra_listing(db_entry)
+
+    def _task_videos(self, db_entry):
+        with self._timings.stage(STAGE_VIDEOS):
+            self._process_videos(db_entry)
+
+    def _task_projections(self, db_entry):
+        if not self._can_store_images(db_entry):
+            return
+        with self._timings.stage(STAGE_PROJECTIONS):
             self._store_0_deg_projection(db_entry)
             self._store_90_deg_projection(db_entry)
-            self._store_xy_slice(db_entry)
-        else:
-            self._logger.info("Commerical sample not processing projections")
+
+    def _task_projection_stack(self, db_entry):
+        with self._timings.stage(STAGE_PROJECTION_STACK):
+            self._store_projection_stack(db_entry)
+
+    def _task_xy_slice(self, db_entry):
+        if not self._can_store_images(db_entry):
+            return
+        self._store_xy_slice(db_entry)
+
+    def _task_preview_volumes(self, db_entry):
+        with self._timings.stage(STAGE_PREVIEW_VOLUMES):
+            self._store_preview_volumes(db_entry)
+
+    def _can_store_images(self, db_entry):
+        """
+            Images of commercial samples aren't stored
+            :param Scan db_entry: The scan to check
+            :return boolean
+        """
+        if db_entry.sample is None or not db_entry.sample.is_confidential():
+            return True
+        self._logger.info("Commerical sample not processing projections")
+        return False
 
 
     def _store_ctprofile_file(self, scan_entry):
@@ -309,25 +423,28 @@ class XtekParser(DatasetParser):
             pixels_x = scan_entry.voxels_x
             pixels_y = scan_entry.voxels_y
             pixels_z = scan_entry.voxels_z
-            xtek_file = scan_entry.full_path()
             recon_dir = scan_entry.recon_directory()
             if recon_dir.is_dir():
-                for extension in RECON_EXTENSIONS:
-                    recon_file = Path(recon_dir, "{}.{}".format(xtek_file.stem, extension))
-                    if recon_file.exists():
-                        break
-                if os.path.exists(recon_file):
+                recon_file = self._find_recon_file(scan_entry)
+                if recon_file.exists():
                     self._logger.debug("Found recon file: %s", recon_file)
                     try:
-                        (temp_dir, tiff, png) = stack2xyslice(
-                            recon_file, pixels_x, pixels_y, pixels_z)
-                        scan_entry.xyslice.save(tiff, open(Path(temp_dir.name, tiff), "rb"))
-                        scan_entry.xyslice_png.save(png, open(Path(temp_dir.name, png), "rb"))
+                        window = self._volume_window(scan_entry, recon_file)
+                        with self._timings.stage(STAGE_XYSLICE, recon_file.stat().st_size):
+                            (temp_dir, tiff, png) = stack2xyslice(
+                                recon_file, pixels_x, pixels_y, pixels_z, window=window)
+                        # Only these fields, other tasks for the scan may be running
+                        scan_entry.xyslice.save(
+                            tiff, open(Path(temp_dir.name, tiff), "rb"), save=False)
+                        scan_entry.xyslice_png.save(
+                            png, open(Path(temp_dir.name, png), "rb"), save=False)
+                        scan_entry.save(update_fields=["xyslice", "xyslice_png"])
                     except ValueError:
                         self._logger.error("Unable to generate xy slice")
                         return
                     try:
-                        generate_basic_report_tasks(scan_entry, self._log_level)
+                        with self._timings.stage(STAGE_REPORTS):
+                            generate_basic_report_tasks(scan_entry, self._log_level)
                         self._logger.debug("Basic report tasks queued")
                     except ValueError:
                         self._logger.error("Unable to queue report tasks")
@@ -338,6 +455,71 @@ class XtekParser(DatasetParser):
         else:
             self._logger.debug("XY slice already stored")
 
+    def _find_recon_file(self, scan_entry): #pylint: disable=no-self-use
+        """
+            Work out which file in the recon directory is the reconstructed volume
+            :param NikonCTScan scan_entry: The db record for the scan entry
+            :return Path: The volume, or the last name tried if none of them exist
+        """
+        recon_dir = scan_entry.recon_directory()
+        for extension in RECON_EXTENSIONS:
+            recon_file = Path(recon_dir, "{}.{}".format(Path(scan_entry.filename).stem, extension))
+            if recon_file.exists():
+                break
+        return recon_file
+
+    def _store_preview_volumes(self, scan_entry):
+        """
+            Write the binned preview volumes for the reconstruction and record them as
+            refined raw data
+            :param NikonCTScan scan_entry: The db record for the scan entry
+        """
+        recon_file = self._find_recon_file(scan_entry)
+        if not recon_file.exists():
+            self._logger.info("No recon file therefore no preview volumes")
+            return
+        writer = PreviewVolumeWriter(scan_entry.recon_preview_dir(), log_level=self._log_level)
+        try:
+            previews = writer.write(
+                recon_file, scan_entry.voxels_x, scan_entry.voxels_y, scan_entry.voxels_z)
+        except (ValueError, OSError) as err:
+            self._logger.error("Unable to generate preview volumes")
+            self._logger.debug(err)
+            return
+        recon_parent = scan_entry.recon_directory().parent
+        with self._timings.stage(STAGE_DB_WRITE):
+            for (_, preview) in previews:
+                for fname in (preview, vgi_from_vol(preview)):
+                    self._store_refined_file(scan_entry, fname, recon_parent)
+
+    def _volume_window(self, scan_entry, recon_file):
+        """
+            Work out the statistics of the volume if they haven't been already and use them to
+            get the window for the previews
+            :param NikonCTScan scan_entry: The db record for the scan entry
+            :param Path recon_file: The reconstructed volume
+            :return (float, float): The window, or None if the volume has no contrast
+        """
+        if scan_entry.volume_max is None:
+            with self._timings.stage(STAGE_VOLUME_STATS, recon_file.stat().st_size):
+                reader = VolumeReader(
+                    recon_file, scan_entry.voxels_x, scan_entry.voxels_y, scan_entry.voxels_z,
+                    log_level=self._log_level)
+                stats = reader.statistics()
+            (low_percentile, high_percentile) = WINDOW_PERCENTILES
+            scan_entry.volume_min = stats["min"]
+            scan_entry.volume_max = stats["max"]
+            scan_entry.volume_mean = stats["mean"]
+            scan_entry.volume_std = stats["std"]
+            scan_entry.volume_window_low = stats["percentiles"][low_percentile]
+            scan_entry.volume_window_high = stats["percentiles"][high_percentile]
+            scan_entry.volume_histogram = json.dumps(stats["histogram"])
+            with self._timings.stage(STAGE_DB_WRITE):
+                scan_entry.save(update_fields=[
+                    "volume_min", "volume_max", "volume_mean", "volume_std",
+                    "volume_window_low", "volume_window_high", "volume_histogram"])
+        return scan_entry.volume_window()
+
     def _store_0_deg_projection(self, scan_entry):
         """
             Store the 0 degree projection from the scan
@@ -345,14 +527,13 @@ class XtekParser(DatasetParser):
         """
         if scan_entry.projection0deg.name is None or scan_entry.projection0deg.name == '':
             self._logger.debug("No 0 degree projection currently stored")
-            xtek_file = scan_entry.full_path()
-            proj = Path(xtek_file.parent, "{}_{:04d}.tif".format(xtek_file.stem, 1))
-            self._logger.debug("looking for %s", proj)
-            if os.path.exists(proj):
+            proj = self._find_projection(scan_entry, "projection0deg")
+            if proj is not None:
                 self._logger.debug("Found 0 degree projection")
-                scan_entry.projection0deg.save(proj.name, open(proj, "rb"))
-                (temp_dir, png) = tiff2png(proj)
-                scan_entry.projection0deg_png.save(png, open(Path(temp_dir.name, png), "rb"))
+                with TemporaryDirectory() as temp_dir:
+                    with self._timings.stage(STAGE_TIFF2PNG, proj.stat().st_size):
+                        png = self._thumbnailer.thumbnail(proj, Path(temp_dir))
+                    self._save_projection(scan_entry, "projection0deg", proj, png)
             else:
                 self._logger.info("0 degree projection not found")
         else:
@@ -365,24 +546,157 @@ class XtekParser(DatasetParser):
         """
         if scan_entry.projection90deg.name is None or scan_entry.projection90deg.name == '':
             self._logger.debug("No 90 degree projection currently stored")
-            proj_number = scan_entry.proj90_index()
-            if proj_number:
-                self._logger.info("Projection index %4d", proj_number)
-                xtek_file = scan_entry.full_path()
-                proj = Path(xtek_file.parent, "{}_{:04d}.tif".format(xtek_file.stem, proj_number))
-                self._logger.debug("looking for %s", proj)
-                if os.path.exists(proj):
-                    self._logger.debug("Found 90 degree projection")
-                    scan_entry.projection90deg.save(proj.name, open(proj, "rb"))
-                    (temp_dir, png) = tiff2png(proj)
-                    scan_entry.projection90deg_png.save(png, open(Path(temp_dir.name, png), "rb"))
-                else:
-                    self._logger.info("90 degree projection not found")
+            proj = self._find_projection(scan_entry, "projection90deg")
+            if proj is not None:
+                self._logger.debug("Found 90 degree projection")
+                with TemporaryDirectory() as temp_dir:
+                    with self._timings.stage(STAGE_TIFF2PNG, proj.stat().st_size):
+                        png = self._thumbnailer.thumbnail(proj, Path(temp_dir))
+                    self._save_projection(scan_entry, "projection90deg", proj, png)
             else:
-                self._logger.warning("No projection number calculated")
+                self._logger.info("90 degree projection not found")
         else:
             self._logger.debug("90 degree projection already stored")
 
+    def _store_projection_stack(self, scan_entry):
+        """
+            Read every projection to get the time series of their statistics and, unless
+            it's a commercial sample, a contact sheet of them
+            :param NikonCTScan scan_entry: The db record for the scan entry
+        """
+        if not scan_entry.projections:
+            self._logger.info("Number of projections unknown")
+            return
+        xtek_file = scan_entry.full_path()
+        (projections, source) = find_stack([
+            Path(xtek_file.parent, "{}_{:04d}.tif".format(xtek_file.stem, proj_number))
+            for proj_number in range(1, scan_entry.projections + 1)])
+        if (
+                scan_entry.projection_stats is not None and
+                scan_entry.projection_stats_source == source and
+                not scan_entry.missing_projections):
+            self._logger.debug("Projection statistics already stored")
+            return
+        if not any(projections):
+            self._logger.info("No projections found")
+            return
+        with TemporaryDirectory() as temp_dir:
+            sheet_file = None
+            if self._can_store_images(scan_entry):
+                sheet_file = Path(temp_dir, "{}_contact_sheet.png".format(xtek_file.stem))
+            analyser = ProjectionStackAnalyser(log_level=self._log_level)
+            result = analyser.analyse(projections, sheet_file)
+            with self._timings.stage(STAGE_DB_WRITE):
+                scan_entry.set_projection_series(result)
+                scan_entry.missing_projections = len(result["missing"])
+                scan_entry.projection_stats_source = source
+                scan_entry.save(update_fields=[
+                    "projection_stats", "missing_projections", "projection_stats_source"])
+                if sheet_file is not None and sheet_file.exists():
+                    self._store_contact_sheet(scan_entry, sheet_file)
+
+    def _store_contact_sheet(self, scan_entry, sheet_file):
+        """
+            Store the contact sheet as an attachment, replacing any earlier one
+            :param NikonCTScan scan_entry: The db record for the scan entry
+            :param Path sheet_file: The contact sheet
+        """
+        sheet_type = ScanAttachmentType.objects.get(name="Projection contact sheet")
+        try:
+            sheet_entry = ScanAttachment.objects.get(
+                scan=scan_entry,
+                attachment_type=sheet_type)
+            sheet_entry.attachment.delete(save=False)
+        except ObjectDoesNotExist:
+            sheet_entry = ScanAttachment(
+                scan=scan_entry,
+                name=sheet_file.name,
+                attachment_type=sheet_type)
+        sheet_entry.editable = False
+        with open(sheet_file, "rb") as fhandle:
+            sheet_entry.attachment.save(sheet_file.name, fhandle)
+
+    def _find_projection(self, scan_entry, field):
+        """
+            Work out which projection is stored in a field
+            :param NikonCTScan scan_entry: The db record for the scan entry
+            :param string field: One of PROJECTION_FIELDS
+            :return Path: The projection, None if it can't be found
+        """
+        if field == "projection0deg":
+            proj_number = 1
+        else:
+            proj_number = scan_entry.proj90_index()
+            if not proj_number:
+                self._logger.warning("No projection number calculated")
+                return None
+            self._logger.info("Projection index %4d", proj_number)
+        xtek_file = scan_entry.full_path()
+        proj = Path(xtek_file.parent, "{}_{:04d}.tif".format(xtek_file.stem, proj_number))
+        self._logger.debug("looking for %s", proj)
+        if not os.path.exists(proj):
+            return None
+        return proj
+
+    def _save_projection(self, scan_entry, field, proj, png):
+        """
+            Store a projection, its PNG thumbnail and its tile pyramid, the projection is
+            only stored if it hasn't been already
+            :param NikonCTScan scan_entry: The db record for the scan entry
+            :param string field: One of PROJECTION_FIELDS
+            :param Path proj: The projection
+            :param Path png: The thumbnail of it
+        """
+        png_field = "{}_png".format(field)
+        update_fields = [png_field]
+        if not getattr(scan_entry, field).name:
+            with open(proj, "rb") as fhandle:
+                getattr(scan_entry, field).save(proj.name, fhandle, save=False)
+            update_fields.append(field)
+        with open(png, "rb") as fhandle:
+            getattr(scan_entry, png_field).save(png.name, fhandle, save=False)
+        # Only these fields, other tasks for the scan may be running
+        scan_entry.save(update_fields=update_fields)
+        with self._timings.stage(STAGE_TILE_PYRAMIDS):
+            self._pyramids.write(Path(getattr(scan_entry, field).path))
+
+    def backfill_projections(self, scans, workers=DEFAULT_THUMBNAIL_WORKERS):
+        """
+            Store the missing projection thumbnails of many scans, the thumbnails are made
+            in parallel a batch of scans at a time
+            :param iterable scans: The NikonCTScans to check
+            :param int workers: The number of processes to make the thumbnails with
+            :return (int, int): The number of thumbnails stored and the number that failed
+        """
+        thumbnailer = Thumbnailer(
+            settings.PROJECTION_PNG_SIZE, workers=workers, log_level=self._log_level)
+        (stored, failed) = (0, 0)
+        scans = iter(scans)
+        while True:
+            batch = list(islice(scans, BACKFILL_BATCH))
+            if not batch:
+                break
+            wanted = []
+            for scan_entry in batch:
+                if not self._can_store_images(scan_entry):
+                    continue
+                for field in PROJECTION_FIELDS:
+                    if getattr(scan_entry, "{}_png".format(field)).name:
+                        continue
+                    proj = self._find_projection(scan_entry, field)
+                    if proj is not None:
+                        wanted.append((scan_entry, field, proj))
+            with thumbnailer.thumbnails([proj for (_, _, proj) in wanted]) as thumbnails:
+                for (scan_entry, field, proj) in wanted:
+                    png = thumbnails[proj]
+                    if png is None:
+                        failed += 1
+                        continue
+                    self._save_projection(scan_entry, field, proj, png)
+                    stored += 1
+            self._logger.info("%d thumbnails stored, %d failed", stored, failed)
+        return (stored, failed)
+
     def copy_raw(self, scan, destination):
         if not destination.exists():
             return (False, "Destination must exist\n")
@@ -400,6 +714,59 @@ class XtekParser(DatasetParser):
             shutil.copy(fname, destination, follow_symlinks=False)
         return (True, "")
 
+    def convert_recon(self, scan, writer, remove_original=False):
+        """
+            Rewrite the reconstructed volume as a chunked store alongside it
+            :param NikonCTScan scan: The scan to convert
+            :param ChunkedVolumeWriter writer: Writes the store
+            :param boolean remove_original: Delete the original volume once the store has
+                been checked against it, even if the store was written by an earlier run
+            :return (status, output)
+        """
+        recon_file = self._find_recon_file(scan)
+        if not recon_file.exists():
+            return (False, "Cannot find reconstructed volume for scan\n")
+        if is_chunked_store(recon_file):
+            return (True, "Already converted\n") # The original has already been removed
+        store = recon_file.with_suffix(STORE_SUFFIX)
+        output = ""
+        try:
+            source = VolumeReader(
+                recon_file, scan.voxels_x, scan.voxels_y, scan.voxels_z,
+                log_level=self._log_level)
+            if is_chunked_store(store):
+                output = "Already converted\n"
+            else:
+                attributes = {"name": scan.name}
+                for field in STORE_ATTRIBUTES:
+                    attributes[field] = getattr(scan, field)
+                writer.convert(source, store, attributes)
+            if remove_original:
+                if not writer.verify(source, VolumeReader(store, log_level=self._log_level)):
+                    return (False, "Store doesn't match the original, not removing it\n")
+                self._remove_original(scan, recon_file)
+        except (ValueError, OSError) as err:
+            self._logger.error("Unable to convert %s", recon_file)
+            self._logger.debug(err)
+            return (False, "Unable to convert {}: {}\n".format(recon_file.name, err))
+        return (True, output)
+
+    def _remove_original(self, scan, recon_file):
+        """
+            Delete a volume that has been converted, along with its .vgi which no longer
+            describes anything, and the records of them as refined raw data. The store isn't
+            a file so it isn't recorded in their place, a .vgi is written for it if it is
+            exported, see copy_recon
+            :param NikonCTScan scan: The scan the volume is from
+            :param Path recon_file: The original volume
+        """
+        path = recon_file.parent.relative_to(scan.recon_directory().parent)
+        for fname in (recon_file, vgi_from_vol(recon_file)):
+            if fname.exists():
+                self._logger.info("Removing %s", fname)
+                fname.unlink()
+            RefinedRawData.objects.filter(scan=scan, name=fname.name, path=path).delete()
+
     def copy_recon(self, scan, destination, include_metadata=False):
         if not destination.exists():
             return (False, "Destination must exist\n")
@@ -407,7 +774,20 @@ class XtekParser(DatasetParser):
         self._logger.debug("Reconstruction directory: %s", recon_dir)
         if not recon_dir.exists():
             return (False, "Cannot find reconstruction directory for scan\n")
+        recon_file = self._find_recon_file(scan)
+        # The preview volumes can be copied separately, see copy_preview
+        ignored = [settings.PREVIEW_FOLDER]
         dir_size = scan.recon_size()
+        store = None
+        if is_chunked_store(recon_file):
+            # Copied as a raw volume as that is what the other software expects
+            try:
+                store = VolumeReader(recon_file, log_level=self._log_level)
+            except (ValueError, OSError) as err:
+                self._logger.debug(err)
+                return (False, "Unable to read {}: {}\n".format(recon_file.name, err))
+            ignored.append(recon_file.name)
+            dir_size += store.bytes_per_slice * store.pixels_z - directory_size(recon_file)
         available_space = free_space(find_mount_point(destination))
         self._logger.debug(
             "Space needed: %s, Space available: %s",
@@ -415,22 +795,71 @@ class XtekParser(DatasetParser):
             convert_filesize(available_space))
         if dir_size >= available_space:
             return (False, "Not enough space left on destination\n")
-        shutil.copytree(recon_dir, Path(destination, recon_dir.name))
+        copied_dir = Path(destination, recon_dir.name)
+        shutil.copytree(
+            recon_dir, copied_dir,
+            ignore=lambda directory, names: [
+                name for name in names if name in ignored and Path(directory) == recon_dir])
+        if store is not None:
+            volume = Path(copied_dir, "{}.vol".format(recon_file.stem))
+            self._logger.debug("Exporting %s to %s", recon_file, volume)
+            try:
+                export_volume(store, volume)
+            except (ValueError, OSError) as err:
+                self._logger.error("Unable to export %s", recon_file)
+                self._logger.debug(err)
+                return (False, "Unable to export {}: {}\n".format(recon_file.name, err))
+            write_vgi(
+                vgi_from_vol(volume), volume.name,
+                (store.pixels_x, store.pixels_y, store.pixels_z), store.bitdepth)
         self._logger.debug("Copying complete")
         if include_metadata:
-            self._logger.debug("Also including metadata files")
-            shutil.copy(scan.full_path(), destination, follow_symlinks=False)
-            ctprofile_filename = Path(
-            Path(scan.path).name,
-            "{}.ctprofile.xml".format(Path(scan.name).stem))
-            if ctprofile_filename.exists():
-                self._logger.debug("CT profile found")
-                shutil.copy(ctprofile_filename, destination, follow_symlinks=False)
-            else:
-                self._logger.debug("CT profile file not found")
+            self._copy_metadata(scan, destination)
+        return (True, "")
 
+    def copy_preview(self, scan, destination, factor, include_metadata=False):
+        if not destination.exists():
+            return (False, "Destination must exist\n")
+        recon_file = self._find_recon_file(scan)
+        preview = Path(scan.recon_preview_dir(), preview_name(recon_file, factor))
+        files = [preview, vgi_from_vol(preview)]
+        self._logger.debug("Preview volume: %s", preview)
+        if not all(fname.exists() for fname in files):
+            return (False, "Cannot find {}x preview volume for scan\n".format(factor))
+        file_size = sum(fname.stat().st_size for fname in files)
+        available_space = free_space(find_mount_point(destination))
+        self._logger.debug(
+            "Space needed: %s, Space available: %s",
+            convert_filesize(file_size),
+            convert_filesize(available_space))
+        if file_size >= available_space:
+            return (False, "Not enough space left on destination\n")
+        preview_dir = Path(destination, scan.recon_directory().name)
+        preview_dir.mkdir()
+        for fname in files:
+            shutil.copy(fname, preview_dir, follow_symlinks=False)
+        self._logger.debug("Copying complete")
+        if include_metadata:
+            self._copy_metadata(scan, destination)
         return (True, "")
 
+    def _copy_metadata(self, scan, destination):
+        """
+            Copy the xtek and ctprofile files alongside the copied volume
+            :param Scan scan: The scan being copied
+            :param Path destination: Where to copy to
+        """
+        self._logger.debug("Also including metadata files")
+        shutil.copy(scan.full_path(), destination, follow_symlinks=False)
+        ctprofile_filename = Path(
+        Path(scan.path).name,
+        "{}.ctprofile.xml".format(Path(scan.name).stem))
+        if ctprofile_filename.exists():
+            self._logger.debug("CT profile found")
+            shutil.copy(ctprofile_filename, destination, follow_symlinks=False)
+        else:
+            self._logger.debug("CT profile file not found")
+
     def _store_refined_files(self, scan_entry):
         """
             Store the refined files for the scan entry
@@ -442,14 +871,13 @@ class XtekParser(DatasetParser):
             return
         extensions = [".{}".format(ext.extension) for ext in RefinedRawExtension.objects.all()]
         self._logger.debug("Looking for %r files in %s", extensions, recon_dir)
-        excluded_dirs = [settings.VIDEO_FOLDER, settings.EXTRA_FOLDER]
+        excluded_dirs = [settings.VIDEO_FOLDER, settings.EXTRA_FOLDER, settings.PREVIEW_FOLDER]
         self._logger.debug("Excluding files in %r", excluded_dirs)
-        files = super()._list_files(recon_dir, extensions)
+        files = super()._list_files(recon_dir, extensions, (EA_DIR,))
         self._logger.debug("Found %d files", len(files))
         for f_name in files:
             self._logger.debug("Processing %s", f_name)
             f_path = Path(f_name).parent
-            name = f_name.name
             rel_path = f_path.relative_to(recon_dir.parent)
             path_parts = rel_path.parts
             if (
@@ -457,20 +885,31 @@ class XtekParser(DatasetParser):
                     path_parts[1] in excluded_dirs):  #it's in an excluded dir
                 self._logger.debug("Skipping file %s", f_name)
                 continue
-            try:
-                data_obj = RefinedRawData.objects.get(name=name, path=rel_path, scan=scan_entry)
-            except ObjectDoesNotExist:
-                data_obj = RefinedRawData(name=name, path=rel_path, scan=scan_entry)
-                self._logger.debug("Adding entry")
-                if scan_entry.sample is not  None and scan_entry.sample.is_confidential():
-                    data_obj.shareable = False # if it's confidential it can't be shared publically
-            modified_time = get_file_modified_time(f_name)
-            self._logger.debug("Last modified: %s", modified_time)
-            if not data_obj.file_modified or data_obj.file_modified < modified_time:
-                self._logger.debug("Updating modified time")
-                data_obj.file_modified = modified_time
-                data_obj.last_updated = timezone.now()
-                data_obj.save()
+            self._store_refined_file(scan_entry, f_name, recon_dir.parent)
+
+    def _store_refined_file(self, scan_entry, f_name, base_dir):
+        """
+            Add or update the record for a refined file
+            :param Scan scan_entry: The db record the file belongs to
+            :param Path f_name: The file
+            :param Path base_dir: The directory the recorded path is relative to
+        """
+        name = f_name.name
+        rel_path = f_name.parent.relative_to(base_dir)
+        try:
+            data_obj = RefinedRawData.objects.get(name=name, path=rel_path, scan=scan_entry)
+        except ObjectDoesNotExist:
+            data_obj = RefinedRawData(name=name, path=rel_path, scan=scan_entry)
+            self._logger.debug("Adding entry")
+            if scan_entry.sample is not  None and scan_entry.sample.is_confidential():
+                data_obj.shareable = False # if it's confidential it can't be shared publically
+        modified_time = get_file_modified_time(f_name)
+        self._logger.debug("Last modified: %s", modified_time)
+        if not data_obj.file_modified or data_obj.file_modified < modified_time:
+            self._logger.debug("Updating modified time")
+            data_obj.file_modified = modified_time
+            data_obj.last_updated = timezone.now()
+            data_obj.save()
 
     def _generate_extra_listing(self, scan_entry):
         """
@@ -491,7 +930,7 @@ class XtekParser(DatasetParser):
             self._logger.info("Extra folder does not exist")
             scan_entry.extra_listing = ""
         scan_entry.extra_listing_last_updated = timezone.now()
-        scan_entry.save()
+        scan_entry.save(update_fields=["extra_listing", "extra_listing_last_updated"])
 
     def _process_videos(self, scan_entry):
         """
@@ -526,4 +965,9 @@ class XtekParser(DatasetParser):
                         attachment.scan = scan_entry
                         attachment.attachment.save(fname.name, open(fname, "rb"))
                         attachment.save()
+                        try:
+                            attachment.update_video_info() # Probed once, read from the record
+                            attachment.thumbnail() # Ready for the reports and admin
+                        except (ffmpeg.Error, ValueError, OSError) as err:
+                            self._logger.warning("Unable to probe %s: %s", fname, err)
                         break # found the suffix so no need to look further